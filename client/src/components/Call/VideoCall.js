@@ -131,12 +131,20 @@ function VideoCall({ recipientId, isVideo, onEndCall }) {
 
         await peerConnection.setRemoteDescription(new RTCSessionDescription(data.data));
         setCallStatus('connected');
-      } else if (data.type === 'ice-candidate' && data.sender_id === recipientId) {
-        // Handle ICE candidate
+      } else if (data.type === 'ice-candidates' && data.sender_id === recipientId) {
+        // The server batches trickled ICE candidates
         const peerConnection = peerConnectionRef.current;
         if (!peerConnection) return;
 
-        await peerConnection.addIceCandidate(new RTCIceCandidate(data.data));
+        for (const candidate of data.candidates) {
+          await peerConnection.addIceCandidate(new RTCIceCandidate(candidate));
+        }
+      } else if (data.type === 'call-busy' && data.user_id === recipientId) {
+        alert('User is already in another call.');
+        onEndCall();
+      } else if (data.type === 'call-unavailable' && data.user_id === recipientId) {
+        alert('User is not available for a call.');
+        onEndCall();
       } else if (data.type === 'call-end' && data.sender_id === recipientId) {
         // Remote peer ended call
         onEndCall();
@@ -0,0 +1,67 @@
+import React, { useState, useEffect } from 'react';
+
+const formatSize = (bytes) => {
+  if (bytes < 1024) return `${bytes} B`;
+  if (bytes < 1024 * 1024) return `${(bytes / 1024).toFixed(1)} KB`;
+  return `${(bytes / (1024 * 1024)).toFixed(1)} MB`;
+};
+
+// Downloads need the auth header, so files are fetched and shown from blob URLs
+function Attachment({ attachment, token }) {
+  const [url, setUrl] = useState(null);
+  const isImage = attachment.content_type.startsWith('image/');
+
+  useEffect(() => {
+    if (!isImage) return undefined;
+    let objectUrl = null;
+    let cancelled = false;
+    fetch(`http://localhost:8000/api/attachments/${attachment.id}`, {
+      headers: {
+        'Authorization': `Bearer ${token}`,
+      },
+    })
+      .then(response => (response.ok ? response.blob() : null))
+      .then(blob => {
+        if (blob && !cancelled) {
+          objectUrl = URL.createObjectURL(blob);
+          setUrl(objectUrl);
+        }
+      })
+      .catch(error => console.error('Error loading attachment:', error));
+    return () => {
+      cancelled = true;
+      if (objectUrl) URL.revokeObjectURL(objectUrl);
+    };
+  }, [attachment.id, isImage, token]);
+
+  const handleDownload = async () => {
+    try {
+      const response = await fetch(`http://localhost:8000/api/attachments/${attachment.id}`, {
+        headers: {
+          'Authorization': `Bearer ${token}`,
+        },
+      });
+      if (!response.ok) return;
+      const objectUrl = URL.createObjectURL(await response.blob());
+      const link = document.createElement('a');
+      link.href = objectUrl;
+      link.download = attachment.filename;
+      link.click();
+      URL.revokeObjectURL(objectUrl);
+    } catch (error) {
+      console.error('Error downloading attachment:', error);
+    }
+  };
+
+  if (isImage && url) {
+    return <img className="message-attachment-image" src={url} alt={attachment.filename} />;
+  }
+
+  return (
+    <button className="message-attachment-file" onClick={handleDownload}>
+      📎 {attachment.filename} <span>({formatSize(attachment.size)})</span>
+    </button>
+  );
+}
+
+export default Attachment;
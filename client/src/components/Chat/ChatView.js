@@ -1,8 +1,30 @@
 import React, { useState, useEffect, useRef } from 'react';
 import { useAuth } from '../../contexts/AuthContext';
 import { useWebSocket } from '../../contexts/WebSocketContext';
+import Attachment from './Attachment';
 import './ChatView.css';
 
+function newClientMessageId() {
+  if (window.crypto && window.crypto.randomUUID) {
+    return window.crypto.randomUUID();
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+// History pages in column form repeat far less per message, see server/wire_format.py
+const COLUMNS_TYPE = 'application/vnd.chatterbox.columns+json';
+
+function rowsFromColumns({ count, columns, dictionary, constant }) {
+  const rows = [];
+  for (let i = 0; i < count; i++) {
+    const row = { ...constant };
+    Object.entries(columns).forEach(([field, values]) => { row[field] = values[i]; });
+    Object.entries(dictionary).forEach(([field, { values, index }]) => { row[field] = values[index[i]]; });
+    rows.push(row);
+  }
+  return rows;
+}
+
 function ChatView({ chat, onStartCall }) {
   const { token, user } = useAuth();
   const { sendMessage, registerHandler, unregisterHandler, sendTypingIndicator } = useWebSocket();
@@ -10,6 +32,8 @@ function ChatView({ chat, onStartCall }) {
   const [inputValue, setInputValue] = useState('');
   const [isTyping, setIsTyping] = useState(false);
   const [otherUserTyping, setOtherUserTyping] = useState(false);
+  const [pendingAttachments, setPendingAttachments] = useState([]);
+  const [uploading, setUploading] = useState(false);
   const messagesEndRef = useRef(null);
   const typingTimeoutRef = useRef(null);
 
@@ -44,35 +68,58 @@ function ChatView({ chat, onStartCall }) {
       const response = await fetch(endpoint, {
         headers: {
           'Authorization': `Bearer ${token}`,
+          'Accept': `${COLUMNS_TYPE}, application/json;q=0.5`,
         },
       });
 
       if (response.ok) {
-        const data = await response.json();
+        const body = await response.json();
+        const data = response.headers.get('Content-Type')?.startsWith(COLUMNS_TYPE) ? rowsFromColumns(body) : body;
         setMessages(data);
+        if (data.length > 0) {
+          markGroupRead(data[data.length - 1].id);
+        }
       }
     } catch (error) {
       console.error('Error loading messages:', error);
     }
   };
 
+  // Group chats keep one read position per member instead of per-message status
+  const markGroupRead = (messageId) => {
+    if (chat.type !== 'group' || !messageId) return;
+    fetch(`http://localhost:8000/api/messages/group/${chat.id}/read?message_id=${messageId}`, {
+      method: 'PUT',
+      headers: {
+        'Authorization': `Bearer ${token}`,
+      },
+    }).catch((error) => console.error('Error updating read position:', error));
+  };
+
   const handleIncomingMessage = (data) => {
     if (data.type === 'message') {
+      const fromMe = data.sender_id === user?.id;
       if (
-        (chat.type === 'user' && data.sender_id === chat.id) ||
+        (chat.type === 'user' && !data.group_id && (data.sender_id === chat.id || (fromMe && data.recipient_id === chat.id))) ||
         (chat.type === 'group' && data.group_id === chat.id)
       ) {
-        setMessages(prev => [...prev, {
+        // Replayed messages after a reconnect may already be on screen
+        setMessages(prev => prev.some(msg => data.message_id && msg.id === data.message_id) ? prev : [...prev, {
           id: data.message_id || Date.now().toString(),
           sender_id: data.sender_id,
           sender_username: data.sender_username,
           content: data.content,
+          attachments: data.attachments || [],
           timestamp: data.timestamp,
-          status: 'delivered'
+          status: fromMe ? 'sent' : 'delivered'
         }]);
 
+        if (chat.type === 'group' && !fromMe) {
+          markGroupRead(data.message_id);
+        }
+
         // Send delivery status
-        if (data.message_id) {
+        if (data.message_id && !fromMe) {
           sendMessage({
             type: 'status',
             recipient_id: data.sender_id,
@@ -81,6 +128,9 @@ function ChatView({ chat, onStartCall }) {
           });
         }
       }
+    } else if (data.type === 'resumed' && !data.complete) {
+      // Missed too much while away to replay; reload the chat instead
+      loadMessages();
     } else if (data.type === 'typing' && data.user_id === chat.id) {
       setOtherUserTyping(data.is_typing);
     } else if (data.type === 'status') {
@@ -90,29 +140,78 @@ function ChatView({ chat, onStartCall }) {
     }
   };
 
+  const postMessage = async (messageData, attempts = 3) => {
+    // Retry on network errors and server errors; the client_message_id
+    // makes the server return the original message for a repeat
+    for (let attempt = 1; ; attempt++) {
+      try {
+        const response = await fetch('http://localhost:8000/api/messages/', {
+          method: 'POST',
+          headers: {
+            'Authorization': `Bearer ${token}`,
+            'Content-Type': 'application/json',
+          },
+          body: JSON.stringify(messageData),
+        });
+        if (response.status < 500 || attempt >= attempts) return response;
+      } catch (error) {
+        if (attempt >= attempts) throw error;
+      }
+      await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+    }
+  };
+
+  // The file is the request body, so the browser streams it from disk
+  const uploadAttachment = async (file) => {
+    setUploading(true);
+    try {
+      const response = await fetch(`http://localhost:8000/api/attachments/?filename=${encodeURIComponent(file.name)}`, {
+        method: 'POST',
+        headers: {
+          'Authorization': `Bearer ${token}`,
+          'Content-Type': file.type || 'application/octet-stream',
+        },
+        body: file,
+      });
+      const data = await response.json();
+      if (response.ok) {
+        setPendingAttachments(prev => (prev.some(a => a.id === data.id) ? prev : [...prev, data]));
+      } else {
+        alert(data.detail || 'Upload failed');
+      }
+    } catch (error) {
+      console.error('Error uploading attachment:', error);
+    } finally {
+      setUploading(false);
+    }
+  };
+
+  const handleFileChange = (e) => {
+    Array.from(e.target.files).forEach(uploadAttachment);
+    e.target.value = '';
+  };
+
   const handleSendMessage = async () => {
-    if (!inputValue.trim()) return;
+    if (!inputValue.trim() && pendingAttachments.length === 0) return;
 
+    // Same id on every attempt, so a retry can't store the message twice
+    const clientMessageId = newClientMessageId();
+    const attachmentIds = pendingAttachments.map(a => a.id);
     const messageData = {
       content: inputValue,
       [chat.type === 'group' ? 'group_id' : 'recipient_id']: chat.id,
+      client_message_id: clientMessageId,
+      attachment_ids: attachmentIds,
     };
 
     try {
-      const response = await fetch('http://localhost:8000/api/messages/', {
-        method: 'POST',
-        headers: {
-          'Authorization': `Bearer ${token}`,
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(messageData),
-      });
+      const response = await postMessage(messageData);
 
       if (response.ok) {
         const data = await response.json();
         
         // Add message to local state
-        setMessages(prev => [...prev, data]);
+        setMessages(prev => (prev.some(m => m.id === data.id) ? prev : [...prev, data]));
         
         // Send via WebSocket for real-time delivery
         sendMessage({
@@ -121,9 +220,12 @@ function ChatView({ chat, onStartCall }) {
           content: inputValue,
           timestamp: data.timestamp,
           message_id: data.id,
+          client_message_id: clientMessageId,
+          attachment_ids: attachmentIds,
         });
 
         setInputValue('');
+        setPendingAttachments([]);
         
         // Stop typing indicator
         if (chat.type === 'user') {
@@ -226,10 +328,16 @@ function ChatView({ chat, onStartCall }) {
               <div className="message-sender">{message.sender_username}</div>
             )}
             <div className="message-bubble">
-              <div className="message-content">{message.content}</div>
+              {message.content && <div className="message-content">{message.content}</div>}
+              {message.attachments?.map(attachment => (
+                <Attachment key={attachment.id} attachment={attachment} token={token} />
+              ))}
               <div className="message-meta">
                 <span className="message-time">{formatTime(message.timestamp)}</span>
-                {message.sender_id === user.id && (
+                {message.sender_id === user.id && chat.type === 'group' && message.seen_by > 0 && (
+                  <span className="message-status">Seen by {message.seen_by}</span>
+                )}
+                {message.sender_id === user.id && chat.type !== 'group' && (
                   <span className="message-status">{getMessageStatus(message.status)}</span>
                 )}
               </div>
@@ -239,7 +347,22 @@ function ChatView({ chat, onStartCall }) {
         <div ref={messagesEndRef} />
       </div>
 
+      {pendingAttachments.length > 0 && (
+        <div className="pending-attachments">
+          {pendingAttachments.map(attachment => (
+            <span key={attachment.id} className="pending-attachment">
+              📎 {attachment.filename}
+              <button onClick={() => setPendingAttachments(prev => prev.filter(a => a.id !== attachment.id))}>×</button>
+            </span>
+          ))}
+        </div>
+      )}
+
       <div className="message-input-container">
+        <label className="icon-button attach-button" title="Attach files">
+          {uploading ? '⏳' : '📎'}
+          <input type="file" multiple onChange={handleFileChange} disabled={uploading} hidden />
+        </label>
         <textarea
           value={inputValue}
           onChange={handleInputChange}
@@ -249,7 +372,7 @@ function ChatView({ chat, onStartCall }) {
         />
         <button
           onClick={handleSendMessage}
-          disabled={!inputValue.trim()}
+          disabled={!inputValue.trim() && pendingAttachments.length === 0}
           className="send-button"
         >
           ➤
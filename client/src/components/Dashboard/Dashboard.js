@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState } from 'react';
 import { Routes, Route } from 'react-router-dom';
 import { useAuth } from '../../contexts/AuthContext';
 import Sidebar from './Sidebar';
@@ -9,48 +9,14 @@ import VideoCall from '../Call/VideoCall';
 import './Dashboard.css';
 
 function Dashboard() {
-  const { token } = useAuth();
-  const [friends, setFriends] = useState([]);
-  const [groups, setGroups] = useState([]);
+  const { bootstrap, refreshBootstrap } = useAuth();
   const [selectedChat, setSelectedChat] = useState(null);
   const [activeCall, setActiveCall] = useState(null);
 
-  useEffect(() => {
-    loadFriends();
-    loadGroups();
-  }, []);
-
-  const loadFriends = async () => {
-    try {
-      const response = await fetch('http://localhost:8000/api/friends/', {
-        headers: {
-          'Authorization': `Bearer ${token}`,
-        },
-      });
-      if (response.ok) {
-        const data = await response.json();
-        setFriends(data);
-      }
-    } catch (error) {
-      console.error('Error loading friends:', error);
-    }
-  };
-
-  const loadGroups = async () => {
-    try {
-      const response = await fetch('http://localhost:8000/api/groups/', {
-        headers: {
-          'Authorization': `Bearer ${token}`,
-        },
-      });
-      if (response.ok) {
-        const data = await response.json();
-        setGroups(data);
-      }
-    } catch (error) {
-      console.error('Error loading groups:', error);
-    }
-  };
+  // Friends and groups come from the sign-in bootstrap; refreshing
+  // reloads the whole bootstrap in one request
+  const friends = bootstrap?.friends || [];
+  const groups = bootstrap?.groups || [];
 
   const handleSelectChat = (chat) => {
     setSelectedChat(chat);
@@ -72,10 +38,7 @@ function Dashboard() {
         groups={groups}
         selectedChat={selectedChat}
         onSelectChat={handleSelectChat}
-        onRefresh={() => {
-          loadFriends();
-          loadGroups();
-        }}
+        onRefresh={refreshBootstrap}
       />
       
       <div className="dashboard-content">
@@ -105,11 +68,11 @@ function Dashboard() {
             />
             <Route
               path="/friends"
-              element={<Friends onRefresh={loadFriends} />}
+              element={<Friends onRefresh={refreshBootstrap} />}
             />
             <Route
               path="/groups"
-              element={<Groups onRefresh={loadGroups} />}
+              element={<Groups onRefresh={refreshBootstrap} />}
             />
           </Routes>
         )}
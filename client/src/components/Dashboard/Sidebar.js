@@ -4,7 +4,7 @@ import { useAuth } from '../../contexts/AuthContext';
 import { useTheme } from '../../contexts/ThemeContext';
 import { useWebSocket } from '../../contexts/WebSocketContext';
 import './Sidebar.css';
-import ProfileEditor from '../Profile/Profile';
+import ProfileEditor, { avatarSrc } from '../Profile/Profile';
 import '../Profile/Profile.css';
 
 function Sidebar({ friends, groups, selectedChat, onSelectChat, onRefresh }) {
@@ -78,7 +78,7 @@ function Sidebar({ friends, groups, selectedChat, onSelectChat, onRefresh }) {
         <div className="user-info" onClick={() => setShowProfile(true)} style={{ cursor: 'pointer' }}>
           <div className="user-avatar">
             {user?.avatar ? (
-              <img src={user.avatar} alt="avatar" style={{ width: '100%', height: '100%', borderRadius: '50%', objectFit: 'cover' }} />
+              <img src={avatarSrc(user.avatar)} alt="avatar" style={{ width: '100%', height: '100%', borderRadius: '50%', objectFit: 'cover' }} />
             ) : (
               user?.username?.[0]?.toUpperCase()
             )}
@@ -182,7 +182,7 @@ function Sidebar({ friends, groups, selectedChat, onSelectChat, onRefresh }) {
                   <div className="chat-avatar group-avatar">👥</div>
                   <div className="chat-info">
                     <div className="chat-name">{group.name}</div>
-                    <div className="chat-status">{group.members?.length || 0} members</div>
+                    <div className="chat-status">{group.member_count ?? group.members?.length ?? 0} members</div>
                   </div>
                 </div>
               ))
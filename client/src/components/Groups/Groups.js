@@ -11,6 +11,7 @@ function Groups({ onRefresh }) {
   const [selectedMembers, setSelectedMembers] = useState([]);
   const [selectedGroup, setSelectedGroup] = useState(null);
   const [showAddMemberModal, setShowAddMemberModal] = useState(false);
+  const [membersToAdd, setMembersToAdd] = useState([]);
 
   useEffect(() => {
     loadGroups();
@@ -106,15 +107,20 @@ function Groups({ onRefresh }) {
     }
   };
 
-  const handleAddMember = async (groupId, userId) => {
+  const handleAddMembers = async (groupId, userIds) => {
+    if (userIds.length === 0) return;
+
     try {
+      // All selected friends in one request
       const response = await fetch(
-        `http://localhost:8000/api/groups/${groupId}/members/${userId}`,
+        `http://localhost:8000/api/groups/${groupId}/members`,
         {
           method: 'POST',
           headers: {
             'Authorization': `Bearer ${token}`,
+            'Content-Type': 'application/json',
           },
+          body: JSON.stringify({ user_ids: userIds }),
         }
       );
 
@@ -122,11 +128,12 @@ function Groups({ onRefresh }) {
         loadGroups();
         setShowAddMemberModal(false);
         setSelectedGroup(null);
+        setMembersToAdd([]);
         onRefresh?.();
       }
     } catch (error) {
-      console.error('Error adding member:', error);
-      alert('Failed to add member');
+      console.error('Error adding members:', error);
+      alert('Failed to add members');
     }
   };
 
@@ -162,6 +169,19 @@ function Groups({ onRefresh }) {
     );
   };
 
+  const toggleMemberToAdd = (memberId) => {
+    setMembersToAdd(prev =>
+      prev.includes(memberId)
+        ? prev.filter(id => id !== memberId)
+        : [...prev, memberId]
+    );
+  };
+
+  const closeAddMemberModal = () => {
+    setShowAddMemberModal(false);
+    setMembersToAdd([]);
+  };
+
   return (
     <div className="groups-container">
       <div className="groups-header">
@@ -182,7 +202,7 @@ function Groups({ onRefresh }) {
                   <div className="group-avatar">👥</div>
                   <div className="group-info">
                     <h3>{group.name}</h3>
-                    <p>{group.members.length} members</p>
+                    <p>{group.member_count ?? group.members.length} members</p>
                   </div>
                   <div className="group-actions">
                     <button
@@ -276,33 +296,37 @@ function Groups({ onRefresh }) {
       )}
 
       {showAddMemberModal && selectedGroup && (
-        <div className="modal-overlay" onClick={() => setShowAddMemberModal(false)}>
+        <div className="modal-overlay" onClick={closeAddMemberModal}>
           <div className="modal-content" onClick={(e) => e.stopPropagation()}>
-            <h3>Add Member to {selectedGroup.name}</h3>
+            <h3>Add Members to {selectedGroup.name}</h3>
             
             <div className="members-selection">
               {friends
                 .filter(friend => !selectedGroup.members.some(m => m.id === friend.id))
                 .map((friend) => (
-                  <div key={friend.id} className="friend-item">
-                    <div className="friend-avatar">{friend.username[0].toUpperCase()}</div>
-                    <div className="friend-info">
-                      <div className="friend-name">{friend.username}</div>
-                    </div>
-                    <button
-                      className="btn-primary"
-                      onClick={() => handleAddMember(selectedGroup.id, friend.id)}
-                    >
-                      Add
-                    </button>
+                  <div key={friend.id} className="member-checkbox">
+                    <input
+                      type="checkbox"
+                      id={`add-${friend.id}`}
+                      checked={membersToAdd.includes(friend.id)}
+                      onChange={() => toggleMemberToAdd(friend.id)}
+                    />
+                    <label htmlFor={`add-${friend.id}`}>{friend.username}</label>
                   </div>
                 ))}
             </div>
 
             <div className="modal-actions">
-              <button className="btn-secondary" onClick={() => setShowAddMemberModal(false)}>
+              <button className="btn-secondary" onClick={closeAddMemberModal}>
                 Close
               </button>
+              <button
+                className="btn-primary"
+                disabled={membersToAdd.length === 0}
+                onClick={() => handleAddMembers(selectedGroup.id, membersToAdd)}
+              >
+                Add {membersToAdd.length > 0 ? membersToAdd.length : ''}
+              </button>
             </div>
           </div>
         </div>
@@ -2,11 +2,15 @@ import React, { useState } from 'react';
 import { useAuth } from '../../contexts/AuthContext';
 import './Profile.css';
 
+export const avatarSrc = (avatar) => (
+  avatar && avatar.startsWith('/') ? `http://localhost:8000${avatar}` : avatar
+);
+
 function ProfileEditor({ user, onClose }) {
   const { updateUser } = useAuth();
   const [username, setUsername] = useState(user?.username || '');
-  const [avatar, setAvatar] = useState(user?.avatar || null);
-  const [preview, setPreview] = useState(user?.avatar || null);
+  const [avatarFile, setAvatarFile] = useState(null);
+  const [preview, setPreview] = useState(avatarSrc(user?.avatar) || null);
   const [loading, setLoading] = useState(false);
 
   const handleFileChange = (e) => {
@@ -19,12 +23,8 @@ function ProfileEditor({ user, onClose }) {
       return;
     }
     
-    const reader = new FileReader();
-    reader.onload = () => {
-      setPreview(reader.result);
-      setAvatar(reader.result);
-    };
-    reader.readAsDataURL(file);
+    setAvatarFile(file);
+    setPreview(URL.createObjectURL(file));
   };
 
   const handleSave = async () => {
@@ -36,8 +36,26 @@ function ProfileEditor({ user, onClose }) {
     setLoading(true);
     try {
       const token = localStorage.getItem('token');
+
+      // Upload the image as a file rather than inlining it in the JSON body
+      if (avatarFile) {
+        const form = new FormData();
+        form.append('file', avatarFile);
+        const upload = await fetch('http://localhost:8000/api/users/me/avatar', {
+          method: 'PUT',
+          headers: {
+            'Authorization': `Bearer ${token}`,
+          },
+          body: form,
+        });
+        if (!upload.ok) {
+          const err = await upload.json();
+          alert(err.detail || 'Failed to upload avatar');
+          return;
+        }
+      }
+
       const body = { username: username.trim() };
-      if (avatar && avatar !== user?.avatar) body.avatar = avatar;
 
       const res = await fetch('http://localhost:8000/api/users/me', {
         method: 'PATCH',
@@ -1,4 +1,4 @@
-import React, { createContext, useState, useContext, useEffect } from 'react';
+import React, { createContext, useState, useContext, useEffect, useCallback } from 'react';
 
 const AuthContext = createContext();
 
@@ -14,6 +14,24 @@ export const AuthProvider = ({ children }) => {
   const [user, setUser] = useState(null);
   const [token, setToken] = useState(null);
   const [loading, setLoading] = useState(true);
+  // Profile, friends, groups, pending requests and online friends, all
+  // from one /api/bootstrap request
+  const [bootstrap, setBootstrap] = useState(null);
+
+  const loadBootstrap = useCallback(async (accessToken) => {
+    const response = await fetch('http://localhost:8000/api/bootstrap', {
+      headers: {
+        'Authorization': `Bearer ${accessToken}`,
+      },
+    });
+
+    if (response.ok) {
+      const data = await response.json();
+      setBootstrap(data);
+      setUser(data.profile);
+      localStorage.setItem('user', JSON.stringify(data.profile));
+    }
+  }, []);
 
   useEffect(() => {
     // Check for stored token
@@ -23,10 +41,20 @@ export const AuthProvider = ({ children }) => {
     if (storedToken && storedUser) {
       setToken(storedToken);
       setUser(JSON.parse(storedUser));
+      loadBootstrap(storedToken).catch(error => console.error('Error loading dashboard:', error));
     }
     
     setLoading(false);
-  }, []);
+  }, [loadBootstrap]);
+
+  const refreshBootstrap = useCallback(async () => {
+    if (!token) return;
+    try {
+      await loadBootstrap(token);
+    } catch (error) {
+      console.error('Error loading dashboard:', error);
+    }
+  }, [token, loadBootstrap]);
 
   const signIn = async (username, password) => {
     const response = await fetch('http://localhost:8000/api/auth/signin', {
@@ -46,18 +74,8 @@ export const AuthProvider = ({ children }) => {
     setToken(data.access_token);
     localStorage.setItem('token', data.access_token);
 
-    // Fetch user info
-    const userResponse = await fetch('http://localhost:8000/api/users/me', {
-      headers: {
-        'Authorization': `Bearer ${data.access_token}`,
-      },
-    });
-
-    if (userResponse.ok) {
-      const userData = await userResponse.json();
-      setUser(userData);
-      localStorage.setItem('user', JSON.stringify(userData));
-    }
+    // Fetch user info along with everything the dashboard needs
+    await loadBootstrap(data.access_token);
 
     return data;
   };
@@ -80,18 +98,8 @@ export const AuthProvider = ({ children }) => {
     setToken(data.access_token);
     localStorage.setItem('token', data.access_token);
 
-    // Fetch user info
-    const userResponse = await fetch('http://localhost:8000/api/users/me', {
-      headers: {
-        'Authorization': `Bearer ${data.access_token}`,
-      },
-    });
-
-    if (userResponse.ok) {
-      const userData = await userResponse.json();
-      setUser(userData);
-      localStorage.setItem('user', JSON.stringify(userData));
-    }
+    // Fetch user info along with everything the dashboard needs
+    await loadBootstrap(data.access_token);
 
     return data;
   };
@@ -99,6 +107,7 @@ export const AuthProvider = ({ children }) => {
   const signOut = () => {
     setUser(null);
     setToken(null);
+    setBootstrap(null);
     localStorage.removeItem('token');
     localStorage.removeItem('user');
   };
@@ -116,6 +125,8 @@ export const AuthProvider = ({ children }) => {
     signUp,
     signOut,
     updateUser,
+    bootstrap,
+    refreshBootstrap,
     isAuthenticated: !!token,
   };
 
@@ -3,6 +3,31 @@ import { useAuth } from './AuthContext';
 
 const WebSocketContext = createContext();
 
+// Identifies this tab across reloads and reconnects so the server can
+// resume delivery from where this tab left off
+const getDeviceId = () => {
+  let deviceId = sessionStorage.getItem('deviceId');
+  if (!deviceId) {
+    deviceId = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+    sessionStorage.setItem('deviceId', deviceId);
+  }
+  return deviceId;
+};
+
+// Reconnect delays grow exponentially up to a cap, with full jitter so
+// clients that dropped together don't come back together
+const BASE_RECONNECT_DELAY = 1000;
+const MAX_RECONNECT_DELAY = 30000;
+
+const backoffDelay = (attempt) =>
+  Math.random() * Math.min(MAX_RECONNECT_DELAY, BASE_RECONNECT_DELAY * 2 ** attempt);
+
+// The server closes with 1012 on restart, with a retry hint in the reason
+const retryHint = (event) => {
+  const match = /^retry=(\d+)$/.exec(event.reason || '');
+  return match ? Number(match[1]) : null;
+};
+
 export const useWebSocket = () => {
   const context = useContext(WebSocketContext);
   if (!context) {
@@ -12,21 +37,35 @@ export const useWebSocket = () => {
 };
 
 export const WebSocketProvider = ({ children }) => {
-  const { token, isAuthenticated } = useAuth();
+  const { token, isAuthenticated, bootstrap } = useAuth();
   const [ws, setWs] = useState(null);
   const [connected, setConnected] = useState(false);
   const [messages, setMessages] = useState([]);
   const [onlineUsers, setOnlineUsers] = useState(new Set());
   const messageHandlers = useRef(new Map());
   const reconnectTimeout = useRef(null);
+  const reconnectAttempts = useRef(0);
+  const retryAfter = useRef(null);
+  const resumeToken = useRef(null);
+
+  useEffect(() => {
+    // Show who is online before the socket's own presence snapshot arrives
+    if (bootstrap) setOnlineUsers(new Set(bootstrap.online));
+  }, [bootstrap]);
 
   const connect = useCallback(() => {
     if (!token || !isAuthenticated) return;
 
-    const websocket = new WebSocket(`ws://localhost:8000/ws/${token}`);
+    let url = `ws://localhost:8000/ws/${token}?device=${getDeviceId()}`;
+    if (resumeToken.current) {
+      url += `&resume=${encodeURIComponent(resumeToken.current)}`;
+      resumeToken.current = null;
+    }
+    const websocket = new WebSocket(url);
 
     websocket.onopen = () => {
       console.log('WebSocket connected');
+      reconnectAttempts.current = 0;
       setConnected(true);
       setWs(websocket);
     };
@@ -35,7 +74,14 @@ export const WebSocketProvider = ({ children }) => {
       try {
         const data = JSON.parse(event.data);
         
-        if (data.type === 'user_status') {
+        if (data.type === 'presence') {
+          // Snapshot of online friends, sent on every (re)connect
+          setOnlineUsers(new Set(data.online));
+        } else if (data.type === 'reconnect') {
+          // Server is restarting; come back when told, resuming this session
+          retryAfter.current = data.retry_after_ms;
+          resumeToken.current = data.resume_token;
+        } else if (data.type === 'user_status') {
           setOnlineUsers(prev => {
             const newSet = new Set(prev);
             if (data.status === 'online') {
@@ -56,12 +102,20 @@ export const WebSocketProvider = ({ children }) => {
       }
     };
 
-    websocket.onclose = () => {
+    websocket.onclose = (event) => {
       console.log('WebSocket disconnected');
       setConnected(false);
       setWs(null);
       
-      // Attempt to reconnect after 3 seconds
+      // Reconnect when the server asked us to, otherwise back off
+      let delay = retryAfter.current ?? retryHint(event);
+      if (delay == null) {
+        delay = event.code === 1012
+          ? Math.random() * 10000
+          : backoffDelay(reconnectAttempts.current++);
+      }
+      retryAfter.current = null;
+
       if (reconnectTimeout.current) {
         clearTimeout(reconnectTimeout.current);
       }
@@ -69,7 +123,7 @@ export const WebSocketProvider = ({ children }) => {
         if (token && isAuthenticated) {
           connect();
         }
-      }, 3000);
+      }, delay);
     };
 
     websocket.onerror = (error) => {
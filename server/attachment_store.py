@@ -0,0 +1,326 @@
+from blob_store import BlobStore, TEMP_PREFIX
+from bson import ObjectId
+from datetime import datetime
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from typing import AsyncIterator, List, Optional, Tuple
+import asyncio
+import base64
+import binascii
+import os
+import re
+import time
+
+import group_members
+
+# Message attachments. Uploads are streamed to disk in WRITE_CHUNK_SIZE
+# writes and stored by the SHA-256 of their content, so the same file
+# sent by many users is kept once. Each upload gets a record in
+# `attachments` owned by the uploader; messages only carry small
+# references ({id, filename, content_type, size}) to those records.
+#
+# Every record counts against its owner's ATTACHMENT_QUOTA_BYTES, kept as
+# a running total in `attachment_usage`. Uploading the same content twice
+# returns the first record and isn't charged again.
+#
+# Sending a message with an attachment shares it with the recipient or
+# group ("u:<id>" / "g:<id>" in `shared`), which is what downloads check,
+# so access doesn't depend on where the message itself is stored.
+
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", os.path.join("media", "attachments"))
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", str(25 * 1024 * 1024)))
+ATTACHMENT_QUOTA_BYTES = int(os.getenv("ATTACHMENT_QUOTA_BYTES", str(500 * 1024 * 1024)))
+MAX_ATTACHMENTS_PER_MESSAGE = 10
+WRITE_CHUNK_SIZE = 1024 * 1024
+# Unreferenced blobs and abandoned uploads younger than this are kept, so
+# a sweep never races an upload in progress
+ORPHAN_GRACE_SECONDS = 3600
+
+# Shown inline by browsers; everything else downloads as a file
+INLINE_TYPES = ("image/", "audio/", "video/")
+
+CONTENT_TYPE_RE = re.compile(r"^[a-z0-9][a-z0-9!#$&^_.+-]*/[a-z0-9][a-z0-9!#$&^_.+-]*$")
+DATA_URL_RE = re.compile(r"^data:([^,;]*)(;[^,]*)?;base64,")
+
+store = BlobStore(ATTACHMENT_DIR)
+
+
+class InvalidAttachment(ValueError):
+    pass
+
+
+class AttachmentTooLarge(InvalidAttachment):
+    pass
+
+
+class QuotaExceeded(InvalidAttachment):
+    pass
+
+
+async def ensure_indexes(db):
+    await db.attachments.create_index([("owner_id", ASCENDING), ("digest", ASCENDING)], unique=True)
+    await db.attachments.create_index([("digest", ASCENDING)])
+
+
+def clean_filename(filename: Optional[str]) -> str:
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    name = "".join(c for c in name if c.isprintable() and c not in '"')[:255].strip()
+    return name or "attachment"
+
+
+def clean_content_type(content_type: Optional[str]) -> str:
+    value = (content_type or "").split(";")[0].strip().lower()
+    return value if CONTENT_TYPE_RE.match(value) and len(value) <= 100 else "application/octet-stream"
+
+
+def attachment_ref(doc: dict) -> dict:
+    return {
+        "id": str(doc["_id"]),
+        "filename": doc["filename"],
+        "content_type": doc["content_type"],
+        "size": doc["size"]
+    }
+
+
+def inline(doc: dict) -> bool:
+    return doc["content_type"].startswith(INLINE_TYPES)
+
+
+def path_for(doc: dict) -> str:
+    return store.path_for(doc["digest"])
+
+
+async def usage(db, user_id: str) -> int:
+    doc = await db.attachment_usage.find_one({"_id": user_id})
+    return doc["bytes"] if doc else 0
+
+
+async def _reserve(db, user_id: str, size: int) -> bool:
+    # Adds to the user's total unless that would go over the quota
+    try:
+        await db.attachment_usage.update_one({"_id": user_id}, {"$setOnInsert": {"bytes": 0}}, upsert=True)
+    except DuplicateKeyError:
+        pass
+    result = await db.attachment_usage.update_one(
+        {"_id": user_id, "bytes": {"$lte": ATTACHMENT_QUOTA_BYTES - size}},
+        {"$inc": {"bytes": size}}
+    )
+    return result.modified_count > 0
+
+
+async def _release(db, user_id: str, size: int):
+    await db.attachment_usage.update_one({"_id": user_id}, {"$inc": {"bytes": -size}})
+
+
+async def _write(chunks: AsyncIterator[bytes], limit: int) -> Tuple[str, int]:
+    # Streams chunks into a new blob, off the event loop one large write at
+    # a time; gives up as soon as more than `limit` bytes arrive
+    writer = await asyncio.to_thread(store.open_writer)
+    buffer = []
+    buffered = 0
+    try:
+        async for chunk in chunks:
+            buffered += len(chunk)
+            if writer.size + buffered > limit:
+                raise AttachmentTooLarge(f"Attachments must be at most {limit} bytes")
+            buffer.append(chunk)
+            if buffered >= WRITE_CHUNK_SIZE:
+                await asyncio.to_thread(writer.write, b"".join(buffer))
+                buffer = []
+                buffered = 0
+        if buffer:
+            await asyncio.to_thread(writer.write, b"".join(buffer))
+        if writer.size == 0:
+            raise InvalidAttachment("Attachment is empty")
+        return await asyncio.to_thread(writer.commit), writer.size
+    except BaseException:
+        await asyncio.to_thread(writer.abort)
+        raise
+
+
+async def _record(db, owner_id: str, digest: str, size: int, filename: str, content_type: str) -> dict:
+    existing = await db.attachments.find_one({"owner_id": owner_id, "digest": digest})
+    if existing:
+        return existing
+
+    if not await _reserve(db, owner_id, size):
+        raise QuotaExceeded("Attachment storage quota exceeded")
+    doc = {
+        "owner_id": owner_id,
+        "digest": digest,
+        "size": size,
+        "filename": filename,
+        "content_type": content_type,
+        "shared": [],
+        "created_at": datetime.utcnow()
+    }
+    try:
+        await db.attachments.insert_one(doc)
+    except DuplicateKeyError:
+        # The same upload finished concurrently
+        await _release(db, owner_id, size)
+        return await db.attachments.find_one({"owner_id": owner_id, "digest": digest})
+    return doc
+
+
+async def save_upload(
+    db,
+    owner_id: str,
+    chunks: AsyncIterator[bytes],
+    filename: Optional[str],
+    content_type: Optional[str],
+    declared_size: Optional[int] = None
+) -> dict:
+    remaining = ATTACHMENT_QUOTA_BYTES - await usage(db, owner_id)
+    if declared_size is not None and declared_size > MAX_ATTACHMENT_BYTES:
+        raise AttachmentTooLarge(f"Attachments must be at most {MAX_ATTACHMENT_BYTES} bytes")
+    if declared_size is not None and declared_size > remaining:
+        raise QuotaExceeded("Attachment storage quota exceeded")
+
+    # A file the user already stored doesn't need quota room, so only the
+    # size limit stops the stream; the quota is checked once it's hashed
+    digest, size = await _write(chunks, MAX_ATTACHMENT_BYTES)
+    return await _record(db, owner_id, digest, size, clean_filename(filename), clean_content_type(content_type))
+
+
+async def get(db, attachment_id: str) -> Optional[dict]:
+    if not ObjectId.is_valid(attachment_id):
+        return None
+    return await db.attachments.find_one({"_id": ObjectId(attachment_id)})
+
+
+async def can_read(db, doc: dict, user_id: str) -> bool:
+    if doc["owner_id"] == user_id or f"u:{user_id}" in doc["shared"]:
+        return True
+    for target in doc["shared"]:
+        if target.startswith("g:") and await group_members.is_member(db, target[2:], user_id):
+            return True
+    return False
+
+
+async def attach(
+    db,
+    owner_id: str,
+    attachment_ids: List[str],
+    recipient_id: Optional[str],
+    group_id: Optional[str]
+) -> List[dict]:
+    # Resolves a message's attachments, all of which must belong to the
+    # sender, and shares them with the conversation; returns their refs
+    if not attachment_ids:
+        return []
+    ids = list(dict.fromkeys(attachment_ids))
+    if len(ids) > MAX_ATTACHMENTS_PER_MESSAGE:
+        raise InvalidAttachment(f"At most {MAX_ATTACHMENTS_PER_MESSAGE} attachments per message")
+    if not all(ObjectId.is_valid(attachment_id) for attachment_id in ids):
+        raise InvalidAttachment("Attachment not found")
+
+    query = {"_id": {"$in": [ObjectId(attachment_id) for attachment_id in ids]}, "owner_id": owner_id}
+    found = {str(doc["_id"]): doc async for doc in db.attachments.find(query)}
+    if len(found) != len(ids):
+        raise InvalidAttachment("Attachment not found")
+
+    target = f"g:{group_id}" if group_id else f"u:{recipient_id}"
+    await db.attachments.update_many(query, {"$addToSet": {"shared": target}})
+    return [attachment_ref(found[attachment_id]) for attachment_id in ids]
+
+
+async def delete(db, owner_id: str, attachment_id: str) -> bool:
+    # The blob stays until collect_garbage finds nothing else using it;
+    # messages that referenced this attachment show it as missing
+    if not ObjectId.is_valid(attachment_id):
+        return False
+    doc = await db.attachments.find_one_and_delete({"_id": ObjectId(attachment_id), "owner_id": owner_id})
+    if doc is None:
+        return False
+    await _release(db, owner_id, doc["size"])
+    return True
+
+
+def _stale_files(min_age: float):
+    cutoff = time.time() - min_age
+    for directory, _, names in os.walk(store.root):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    yield name, path
+            except FileNotFoundError:
+                continue
+
+
+async def collect_garbage(db, min_age: float = ORPHAN_GRACE_SECONDS, batch_size: int = 500, after_batch=None) -> int:
+    # Removes blobs no record refers to, and uploads abandoned midway;
+    # after_batch is awaited after every batch_size files checked
+    removed = 0
+    stale = await asyncio.to_thread(lambda: list(_stale_files(min_age)))
+    for start in range(0, len(stale), batch_size):
+        batch = stale[start:start + batch_size]
+        digests = [name for name, _ in batch if not name.startswith(TEMP_PREFIX)]
+        referenced = set(await db.attachments.distinct("digest", {"digest": {"$in": digests}})) if digests else set()
+        for name, path in batch:
+            if name in referenced:
+                continue
+            try:
+                await asyncio.to_thread(os.unlink, path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        if after_batch:
+            await after_batch(len(batch))
+    return removed
+
+
+async def migrate_inline_attachments(db) -> int:
+    # Moves base64 data URLs pasted as message content into attachments.
+    # Counted in the sender's usage, but never refused for quota.
+    migrated = 0
+    async for msg in db.messages.find({"content": {"$regex": "^data:"}}):
+        match = DATA_URL_RE.match(msg["content"])
+        if not match:
+            continue
+        try:
+            data = base64.b64decode(msg["content"][match.end():], validate=True)
+        except (binascii.Error, ValueError):
+            continue
+        if not data:
+            continue
+
+        async def chunks():
+            yield data
+
+        digest, size = await _write(chunks(), len(data))
+        doc = await db.attachments.find_one({"owner_id": msg["sender_id"], "digest": digest})
+        if doc is None:
+            doc = {
+                "owner_id": msg["sender_id"],
+                "digest": digest,
+                "size": size,
+                "filename": "pasted",
+                "content_type": clean_content_type(match.group(1)),
+                "shared": [],
+                "created_at": msg["timestamp"]
+            }
+            await db.attachments.insert_one(doc)
+            await db.attachment_usage.update_one({"_id": msg["sender_id"]}, {"$inc": {"bytes": size}}, upsert=True)
+        target = f"g:{msg['group_id']}" if msg.get("group_id") else f"u:{msg.get('recipient_id')}"
+        await db.attachments.update_one({"_id": doc["_id"]}, {"$addToSet": {"shared": target}})
+        await db.messages.update_one(
+            {"_id": msg["_id"]},
+            {"$set": {"content": "", "attachments": [attachment_ref(doc)]}}
+        )
+        migrated += 1
+    return migrated
+
+
+if __name__ == "__main__":
+    from database import connect_to_mongo, close_mongo_connection, get_database
+
+    async def main():
+        await connect_to_mongo()
+        db = get_database()
+        await ensure_indexes(db)
+        print(f"✅ Migration complete: {await migrate_inline_attachments(db)} messages moved to attachments")
+        await close_mongo_connection()
+
+    asyncio.run(main())
@@ -10,6 +10,9 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-this-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
+# Resume tokens are signed with a derived key so they can't be used as access tokens
+RESUME_SECRET_KEY = SECRET_KEY + ":resume"
+RESUME_TOKEN_EXPIRE_SECONDS = 120
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
@@ -35,3 +38,13 @@ def decode_token(token: str):
         return payload
     except JWTError:
         raise Exception("Invalid token")
+
+def create_resume_token(user_id: str, device_id: Optional[str]):
+    expire = datetime.utcnow() + timedelta(seconds=RESUME_TOKEN_EXPIRE_SECONDS)
+    return jwt.encode({"sub": user_id, "device": device_id, "exp": expire}, RESUME_SECRET_KEY, algorithm=ALGORITHM)
+
+def decode_resume_token(token: str):
+    try:
+        return jwt.decode(token, RESUME_SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise Exception("Invalid resume token")
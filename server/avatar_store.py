@@ -0,0 +1,117 @@
+from PIL import Image, UnidentifiedImageError
+from blob_store import BlobStore
+from typing import Optional
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import os
+
+# Avatars are stored on disk by the hash of the uploaded image, next to
+# square WebP thumbnails in each of SIZES. User documents only keep the
+# hash as avatar_id, and the files are served from immutable URLs.
+
+AVATAR_DIR = os.getenv("AVATAR_DIR", os.path.join("media", "avatars"))
+MAX_AVATAR_BYTES = 5 * 1024 * 1024
+# Checked from the header before decoding; a small file can declare huge
+# dimensions and take gigabytes to decode
+MAX_AVATAR_PIXELS = 40_000_000
+SIZES = (64, 256)
+DEFAULT_SIZE = 256
+
+store = BlobStore(AVATAR_DIR)
+
+
+class InvalidAvatar(ValueError):
+    pass
+
+
+def _thumbnail(image: Image.Image, size: int) -> bytes:
+    # Center-crop to a square, then scale down
+    width, height = image.size
+    side = min(width, height)
+    left = (width - side) // 2
+    top = (height - side) // 2
+    thumb = image.crop((left, top, left + side, top + side)).resize((size, size), Image.LANCZOS)
+
+    out = io.BytesIO()
+    thumb.save(out, "WEBP", quality=85)
+    return out.getvalue()
+
+
+def _save(data: bytes) -> str:
+    if len(data) > MAX_AVATAR_BYTES:
+        raise InvalidAvatar("Image size must be less than 5MB")
+
+    digest = hashlib.sha256(data).hexdigest()
+    if all(store.exists(digest, f"-{size}.webp") for size in SIZES):
+        return digest
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        if width * height > MAX_AVATAR_PIXELS:
+            raise InvalidAvatar("Image dimensions are too large")
+        image.load()
+    except Image.DecompressionBombError:
+        raise InvalidAvatar("Image dimensions are too large")
+    except (UnidentifiedImageError, OSError):
+        raise InvalidAvatar("Avatar must be an image")
+
+    image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+    for size in SIZES:
+        store.put_bytes(_thumbnail(image, size), digest=digest, suffix=f"-{size}.webp")
+    return digest
+
+
+async def save_avatar(data: bytes) -> str:
+    # Decoding and resizing are CPU bound, keep them off the event loop
+    return await asyncio.to_thread(_save, data)
+
+
+def decode_data_url(value: str) -> bytes:
+    if not value.startswith("data:") or "," not in value:
+        raise InvalidAvatar("Avatar must be an image data URL")
+    header, payload = value.split(",", 1)
+    if not header.endswith(";base64"):
+        raise InvalidAvatar("Avatar must be base64 encoded")
+    try:
+        return base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        raise InvalidAvatar("Avatar must be base64 encoded")
+
+
+def avatar_path(avatar_id: str, size: int) -> Optional[str]:
+    if size not in SIZES or len(avatar_id) != 64 or not all(c in "0123456789abcdef" for c in avatar_id):
+        return None
+    path = store.path_for(avatar_id, f"-{size}.webp")
+    return path if os.path.exists(path) else None
+
+
+def avatar_url(user: dict, size: int = DEFAULT_SIZE) -> Optional[str]:
+    if user.get("avatar_id"):
+        return f"/api/users/avatars/{user['avatar_id']}/{size}"
+    # Users not migrated yet may still hold an external URL
+    return user.get("avatar")
+
+
+async def migrate_legacy_avatars(db):
+    # Move avatars stored inline on user documents into the store
+    migrated = 0
+    async for user in db.users.find({"avatar": {"$exists": True}}, {"avatar": 1}):
+        value = user.get("avatar")
+        update = {"$unset": {"avatar": ""}}
+        if value and value.startswith("data:"):
+            try:
+                update["$set"] = {"avatar_id": await save_avatar(decode_data_url(value))}
+            except InvalidAvatar:
+                pass
+        elif value:
+            # Keep external URLs as they are
+            continue
+        await db.users.update_one({"_id": user["_id"]}, update)
+        migrated += 1
+
+    if migrated:
+        print(f"Migrated {migrated} inline avatars")
@@ -0,0 +1,117 @@
+"""
+Call setup latency benchmark
+
+Runs many concurrent simulated calls through the signaling registry:
+each caller sends an offer and trickles ICE candidates, the callee answers
+and trickles its own. Every delivery goes through a fake socket with a
+small send delay, so flushing more frames costs more. Reports call setup
+latency (offer sent until the caller has the answer and all of the
+callee's candidates) and frames delivered, with ICE batching on and off.
+Run from the server directory: python benchmarks/bench_call_setup.py [calls]
+"""
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from call_sessions import CallRegistry, ICE_BATCH_WINDOW
+
+CANDIDATES_PER_SIDE = 20
+SEND_DELAY = 0.0002
+
+
+class FakeSockets:
+    def __init__(self):
+        self.frames = 0
+        self.inboxes = {}
+
+    def inbox(self, user_id: str) -> asyncio.Queue:
+        return self.inboxes.setdefault(user_id, asyncio.Queue())
+
+    async def send(self, message: str, user_id: str):
+        self.frames += 1
+        await asyncio.sleep(SEND_DELAY)
+        self.inbox(user_id).put_nowait(json.loads(message))
+
+
+def candidate(i: int) -> dict:
+    return {"candidate": f"candidate:{i} 1 udp 2122260223 192.168.1.{i % 250} {50000 + i} typ host",
+            "sdpMid": "0", "sdpMLineIndex": 0}
+
+
+async def trickle(registry: CallRegistry, sender: str, recipient: str):
+    for i in range(CANDIDATES_PER_SIDE):
+        await registry.ice_candidate(sender, recipient, candidate(i))
+        # Candidates arrive in bursts as each interface is gathered
+        if i % 5 == 4:
+            await asyncio.sleep(random.uniform(0.001, 0.005))
+
+
+async def wait_for(inbox: asyncio.Queue, got_answer: bool = False):
+    answered = got_answer
+    candidates = 0
+    while not answered or candidates < CANDIDATES_PER_SIDE:
+        frame = await inbox.get()
+        if frame["type"] == "answer":
+            answered = True
+        elif frame["type"] == "ice-candidates":
+            candidates += len(frame["candidates"])
+
+
+async def callee(registry: CallRegistry, sockets: FakeSockets, caller_id: str, callee_id: str):
+    inbox = sockets.inbox(callee_id)
+    while (await inbox.get())["type"] != "offer":
+        pass
+    await registry.answer(callee_id, caller_id, {"type": "answer", "sdp": "v=0"})
+    await trickle(registry, callee_id, caller_id)
+
+
+async def call(registry: CallRegistry, sockets: FakeSockets, n: int) -> float:
+    caller_id, callee_id = f"caller{n}", f"callee{n}"
+    answering = asyncio.create_task(callee(registry, sockets, caller_id, callee_id))
+
+    started = time.perf_counter()
+    await registry.offer(caller_id, callee_id, {"type": "offer", "sdp": "v=0"})
+    await asyncio.gather(trickle(registry, caller_id, callee_id), wait_for(sockets.inbox(caller_id)))
+    elapsed = time.perf_counter() - started
+
+    await answering
+    await registry.end(caller_id)
+    return elapsed
+
+
+async def run(label: str, calls: int, batch_window: float):
+    sockets = FakeSockets()
+    registry = CallRegistry(sockets.send, batch_window=batch_window)
+    random.seed(1)
+
+    started = time.perf_counter()
+    latencies = sorted(await asyncio.gather(*(call(registry, sockets, n) for n in range(calls))))
+    total = time.perf_counter() - started
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+    print(f"{label:<18} p50 {pct(0.5):>7.1f} ms  p95 {pct(0.95):>7.1f} ms  p99 {pct(0.99):>7.1f} ms  "
+          f"{sockets.frames / calls:>5.1f} frames/call  {calls / total:>7.0f} calls/s")
+
+
+async def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    print("=" * 60)
+    print(f"Call setup benchmark: {calls:,} concurrent calls, "
+          f"{CANDIDATES_PER_SIDE} candidates per side")
+    print("=" * 60)
+
+    await run("unbatched", calls, 0)
+    await run(f"batched {ICE_BATCH_WINDOW * 1000:.0f} ms", calls, ICE_BATCH_WINDOW)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
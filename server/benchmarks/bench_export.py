@@ -0,0 +1,155 @@
+"""
+Conversation export benchmark
+
+Seeds scratch databases with a direct conversation kept three ways: all
+in the hot tier, the older half compacted into cold-tier buckets by
+message_store.compact_once, and all of it compacted. Each is then read
+back with message_store.iter_conversation and encoded as an export, the
+way GET /api/messages/export/conversation does it, and the throughput,
+output size and peak memory are reported. Run from the server directory:
+
+    python benchmarks/bench_export.py [message_count]         # MongoDB from MONGODB_URL
+    python benchmarks/bench_export.py [message_count] mock    # mongomock-motor, no server
+
+The mock engine scans a collection on every query and is much slower than
+MongoDB, so give it a smaller count (20000 takes a few minutes); its numbers
+are only good for comparing the cases with each other.
+"""
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import message_export
+import message_store
+
+ALICE = str(ObjectId())
+BOB = str(ObjectId())
+INSERT_BATCH = 10_000
+MEMORY_SAMPLE = 20_000
+# Share of the conversation old enough to be compacted, per case
+CASES = [("hot", 0.0), ("mixed", 0.5), ("cold", 1.0)]
+
+
+def make_message(i: int, timestamp: datetime) -> dict:
+    sender, recipient = (ALICE, BOB) if i % 2 else (BOB, ALICE)
+    return {
+        "_id": ObjectId(),
+        "sender_id": sender,
+        "recipient_id": recipient,
+        "group_id": None,
+        "content": f"message number {i} with a little bit of typical chat text",
+        "timestamp": timestamp,
+        "status": "read"
+    }
+
+
+async def seed(db, count: int, cold_share: float):
+    # Messages a second apart, ids in the same order; the first cold_share
+    # of them are older than the compaction cutoff
+    cold = int(count * cold_share)
+    old_start = datetime.utcnow() - message_store.COMPACT_AFTER - timedelta(days=1, seconds=cold)
+    new_start = datetime.utcnow() - timedelta(seconds=count - cold)
+
+    await message_store.ensure_indexes(db)
+    for offset in range(0, count, INSERT_BATCH):
+        await db.messages.insert_many([
+            make_message(i, old_start + timedelta(seconds=i) if i < cold else new_start + timedelta(seconds=i - cold))
+            for i in range(offset, min(offset + INSERT_BATCH, count))
+        ])
+    await message_store.compact_once(db)
+
+
+def export_source(db):
+    query = {
+        "$or": [
+            {"sender_id": ALICE, "recipient_id": BOB},
+            {"sender_id": BOB, "recipient_id": ALICE}
+        ]
+    }
+    return message_store.iter_conversation(db, message_store.direct_conversation_key(ALICE, BOB), query)
+
+
+async def take(source, limit: int):
+    n = 0
+    async for msg in source:
+        yield msg
+        n += 1
+        if n == limit:
+            break
+
+
+async def drain(source, fmt: str) -> int:
+    size = 0
+    async for chunk in message_export.encode(source, fmt):
+        size += len(chunk)
+    return size
+
+
+async def run(label: str, db, fmt: str, count: int):
+    started = time.perf_counter()
+    size = await drain(export_source(db), fmt)
+    elapsed = time.perf_counter() - started
+
+    # tracemalloc slows allocation down a lot, so memory is measured on a
+    # separate, shorter pass; the peak should not grow with the count
+    traced = min(count, MEMORY_SAMPLE)
+    tracemalloc.start()
+    await drain(take(export_source(db), traced), fmt)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{label:<6} {fmt:<7} {count / elapsed:>10,.0f} msg/s "
+          f"{size / elapsed / 1e6:>7.1f} MB/s out {size / 1e6:>8.1f} MB "
+          f"{peak / 1e6:>6.2f} MB peak ({traced:,} msgs)")
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 100_000
+
+    if "mock" in sys.argv[1:]:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            print("The mock engine needs mongomock-motor: pip install mongomock-motor")
+            return
+        client = AsyncMongoMockClient()
+        prefix = "bench_export"
+        close = None
+    else:
+        from database import connect_to_mongo, close_mongo_connection, get_client, DATABASE_NAME
+        await connect_to_mongo()
+        client = get_client()
+        prefix = f"{DATABASE_NAME}_bench_export"
+        close = close_mongo_connection
+
+    print("=" * 60)
+    print(f"Export benchmark: {count:,} messages")
+    print("=" * 60)
+
+    try:
+        for label, cold_share in CASES:
+            db = client[f"{prefix}_{label}"]
+            started = time.perf_counter()
+            await seed(db, count, cold_share)
+            hot = await db.messages.count_documents({})
+            buckets = await db.message_buckets.count_documents({})
+            print(f"\n{label}: {hot:,} hot messages, {buckets:,} buckets "
+                  f"(seeded in {time.perf_counter() - started:.1f} s)")
+            for fmt in ("ndjson", "gzip"):
+                await run(label, db, fmt, count)
+    finally:
+        for label, _ in CASES:
+            await client.drop_database(f"{prefix}_{label}")
+        if close:
+            await close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+"""
+WebSocket frame decode and dispatch microbenchmark
+
+Compares the cost per frame of the old approach (json.loads into a dict,
+then an if/elif chain over the type with .get() lookups) against typed
+decoding with frames.decode and a dispatch table. Handlers are no-ops so
+only decoding, validation and dispatch are measured. Run from the server
+directory: python benchmarks/bench_frames.py [iterations]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import frames
+
+SAMPLES = {
+    "typing": {"type": "typing", "recipient_id": "65a1f0c2e4b0a1b2c3d4e5f6", "is_typing": True},
+    "message": {"type": "message", "recipient_id": "65a1f0c2e4b0a1b2c3d4e5f6",
+                "content": "hey, are we still on for tonight?", "timestamp": "2024-01-01T12:00:00",
+                "message_id": "65a1f0c2e4b0a1b2c3d4e5f7"},
+    "ice-candidate": {"type": "ice-candidate", "recipient_id": "65a1f0c2e4b0a1b2c3d4e5f6",
+                      "data": {"candidate": "candidate:1 1 udp 2122260223 192.168.1.2 50000 typ host",
+                               "sdpMid": "0", "sdpMLineIndex": 0}},
+    "status": {"type": "status", "recipient_id": "65a1f0c2e4b0a1b2c3d4e5f6",
+               "message_id": "65a1f0c2e4b0a1b2c3d4e5f7", "status": "delivered"},
+}
+
+
+async def noop(*args):
+    pass
+
+
+async def legacy_dispatch(data: str):
+    message_data = json.loads(data)
+    message_type = message_data.get("type")
+    if message_type == "typing":
+        recipient_id = message_data.get("recipient_id")
+        if recipient_id:
+            await noop(recipient_id, message_data.get("is_typing", False))
+    elif message_type == "message":
+        recipient_id = message_data.get("recipient_id")
+        group_id = message_data.get("group_id")
+        content = message_data.get("content")
+        if group_id or recipient_id:
+            await noop(recipient_id, group_id, content, message_data.get("timestamp"), message_data.get("message_id"))
+    elif message_type in ["offer", "answer", "ice-candidate"]:
+        recipient_id = message_data.get("recipient_id")
+        if recipient_id:
+            await noop(recipient_id, message_data.get("data"))
+    elif message_type == "call-end":
+        await noop(message_data.get("recipient_id"))
+    elif message_type == "status":
+        recipient_id = message_data.get("recipient_id")
+        message_id = message_data.get("message_id")
+        if recipient_id and message_id:
+            await noop(recipient_id, message_id, message_data.get("status"))
+
+
+HANDLERS = {name: noop for name in ("typing", "message", "offer", "answer", "ice-candidate", "call-end", "status")}
+
+
+async def typed_dispatch(data: str):
+    frame = frames.decode(data)
+    await HANDLERS[frame.type]("user", frame)
+
+
+async def time_per_frame(dispatch, data: str, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await dispatch(data)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+async def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+    print("=" * 60)
+    print(f"Frame decode + dispatch: {iterations:,} frames per type")
+    print("=" * 60)
+    print(f"{'frame':<15} {'legacy':>10} {'typed':>10}")
+
+    for name, sample in SAMPLES.items():
+        data = json.dumps(sample)
+        legacy = await time_per_frame(legacy_dispatch, data, iterations)
+        typed = await time_per_frame(typed_dispatch, data, iterations)
+        print(f"{name:<15} {legacy:>8.2f}us {typed:>8.2f}us")
+
+    # Rejected frames, including building the error reply
+    bad = json.dumps({"type": "typing"})
+    started = time.perf_counter()
+    for _ in range(iterations // 10):
+        try:
+            frames.decode(bad)
+        except frames.FrameError as e:
+            e.reply()
+    print(f"{'invalid frame':<15} {'-':>10} {(time.perf_counter() - started) / (iterations // 10) * 1e6:>8.2f}us")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
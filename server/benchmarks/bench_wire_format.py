@@ -0,0 +1,131 @@
+"""
+History page wire format benchmark
+
+Encodes 500-message history pages, shaped like the responses of
+/api/messages/conversation and /api/messages/group, in every format
+wire_format offers, with and without compression. Reports the body size,
+server-side encode time, client-side decode time, and an estimated page
+latency on a slow link (encode + transfer + decode). Run from the server
+directory: python benchmarks/bench_wire_format.py [page_size] [link_mbps]
+"""
+import gzip
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import wire_format
+
+ROUNDS = 50
+WORDS = "hey sure sounds good see you at the station later tonight did you get my message lol ok".split()
+
+
+def direct_page(count: int):
+    alice, bob = str(ObjectId()), str(ObjectId())
+    start = datetime(2024, 1, 1)
+    rows = []
+    for i in range(count):
+        sender, recipient = random.choice([(alice, bob), (bob, alice)])
+        rows.append({
+            "id": str(ObjectId()),
+            "sender_id": sender,
+            "recipient_id": recipient,
+            "content": " ".join(random.choices(WORDS, k=random.randint(2, 12))),
+            "timestamp": (start + timedelta(seconds=i * 17)).isoformat(),
+            "status": "read" if i < count - 3 else "delivered"
+        })
+    return rows
+
+
+def group_page(count: int):
+    group_id = str(ObjectId())
+    members = [(str(ObjectId()), f"member_{n}") for n in range(8)]
+    start = datetime(2024, 1, 1)
+    rows = []
+    for i in range(count):
+        sender_id, username = random.choice(members)
+        rows.append({
+            "id": str(ObjectId()),
+            "sender_id": sender_id,
+            "sender_username": username,
+            "group_id": group_id,
+            "content": " ".join(random.choices(WORDS, k=random.randint(2, 12))),
+            "timestamp": (start + timedelta(seconds=i * 17)).isoformat(),
+            "status": "sent",
+            "seen_by": min(7, count - i)
+        })
+    return rows
+
+
+def compressors():
+    yield "identity", lambda body: body, lambda body: body
+    yield "gzip", lambda body: gzip.compress(body, 6), gzip.decompress
+    if wire_format.brotli is not None:
+        brotli = wire_format.brotli
+        yield "br", lambda body: brotli.compress(body, quality=wire_format.BROTLI_QUALITY), brotli.decompress
+
+
+def decoder(media_type: str):
+    columnar, _ = wire_format.FORMATS[media_type]
+    if media_type in (wire_format.MSGPACK, wire_format.COLUMNS_MSGPACK):
+        loads = wire_format.msgpack.unpackb
+    else:
+        loads = json.loads
+    if columnar:
+        return lambda body: wire_format.rows_from_columns(loads(body))
+    return loads
+
+
+def timed(fn, arg) -> float:
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(arg)
+    return (time.perf_counter() - started) / ROUNDS * 1000
+
+
+def run(label: str, rows, link_mbps: float):
+    print(f"\n{label}: {len(rows)} messages")
+    print(f"{'format':<44} {'coding':<9} {'bytes':>8} {'enc ms':>7} {'dec ms':>7} {'page ms':>8} {'size':>6}")
+    baseline = None
+    for media_type in wire_format.FORMATS:
+        body = wire_format.encode(rows, media_type)
+        decode = decoder(media_type)
+        assert decode(body) == rows
+        encode_ms = timed(lambda r: wire_format.encode(r, media_type), rows)
+        decode_ms = timed(decode, body)
+        for coding, compress, decompress in compressors():
+            wire = compress(body)
+            compress_ms = timed(compress, body)
+            decompress_ms = timed(decompress, wire)
+            transfer_ms = len(wire) * 8 / (link_mbps * 1e6) * 1000
+            total = encode_ms + compress_ms + transfer_ms + decompress_ms + decode_ms
+            baseline = baseline or len(wire)
+            print(f"{media_type:<44} {coding:<9} {len(wire):>8,} {encode_ms + compress_ms:>7.2f} "
+                  f"{decompress_ms + decode_ms:>7.2f} {total:>8.1f} {len(wire) / baseline:>6.0%}")
+
+
+def main():
+    page_size = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    link_mbps = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    random.seed(1)
+
+    print("=" * 60)
+    print(f"Wire format benchmark: {page_size}-message pages, {link_mbps:g} Mbit/s link")
+    print("=" * 60)
+    if wire_format.msgpack is None:
+        print("msgpack not installed, MessagePack formats skipped")
+    if wire_format.brotli is None:
+        print("brotli not installed, br coding skipped")
+
+    run("Direct conversation", direct_page(page_size), link_mbps)
+    run("Group conversation", group_page(page_size), link_mbps)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+from typing import Optional
+import hashlib
+import os
+import tempfile
+
+# Content-addressed files on local disk. Blobs are named by the SHA-256
+# of their content and sharded two levels deep (ab/cd/abcd...) so no
+# directory grows too large. Writes go to a temporary file first and are
+# renamed into place, so readers never see a partial blob.
+
+TEMP_PREFIX = ".upload-"
+
+
+class BlobWriter:
+    # Streams a blob of unknown content into a temporary file, hashing as
+    # it goes; commit() moves it into place under its digest
+    def __init__(self, store: "BlobStore"):
+        self.store = store
+        os.makedirs(store.root, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=store.root, prefix=TEMP_PREFIX)
+        self.file = os.fdopen(fd, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def commit(self, suffix: str = "") -> str:
+        self.file.close()
+        digest = self.hash.hexdigest()
+        path = self.store.path_for(digest, suffix)
+        if os.path.exists(path):
+            # Already stored; refresh the mtime so a sweep for unreferenced
+            # blobs doesn't remove it before the new reference is saved
+            os.unlink(self.tmp_path)
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.tmp_path, path)
+        return digest
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+
+class BlobStore:
+    def __init__(self, root: str):
+        self.root = root
+
+    def path_for(self, digest: str, suffix: str = "") -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + suffix)
+
+    def exists(self, digest: str, suffix: str = "") -> bool:
+        return os.path.exists(self.path_for(digest, suffix))
+
+    def open_writer(self) -> BlobWriter:
+        return BlobWriter(self)
+
+    def delete(self, digest: str, suffix: str = "") -> bool:
+        try:
+            os.unlink(self.path_for(digest, suffix))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put_bytes(self, data: bytes, digest: Optional[str] = None, suffix: str = "") -> str:
+        digest = digest or hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest, suffix)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return digest
@@ -0,0 +1,157 @@
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import json
+import time
+import uuid
+
+# Registry of active calls for WebRTC signaling. An offer opens a session
+# between two users, if `can_call` allows the caller to ring the recipient;
+# answers and ICE candidates are only relayed between the participants of
+# that session, and a user is in at most one call.
+#
+# Trickle ICE sends many small frames, so candidates are held for up to
+# ICE_BATCH_WINDOW seconds (or until ICE_BATCH_MAX are waiting) and then
+# delivered together as one `ice-candidates` frame.
+
+ICE_BATCH_WINDOW = 0.02
+ICE_BATCH_MAX = 16
+RING_TIMEOUT = 60
+
+Send = Callable[[str, str], Awaitable[None]]
+CanCall = Callable[[str, str], Awaitable[bool]]
+
+
+class CallSession:
+    __slots__ = ("call_id", "caller", "callee", "state", "started")
+
+    def __init__(self, caller: str, callee: str):
+        self.call_id = uuid.uuid4().hex
+        self.caller = caller
+        self.callee = callee
+        self.state = "ringing"
+        self.started = time.monotonic()
+
+    def peer_of(self, user_id: str) -> Optional[str]:
+        if user_id == self.caller:
+            return self.callee
+        if user_id == self.callee:
+            return self.caller
+        return None
+
+
+class CallRegistry:
+    def __init__(self, send: Send, can_call: Optional[CanCall] = None,
+                 batch_window: float = ICE_BATCH_WINDOW, batch_max: int = ICE_BATCH_MAX):
+        self.send = send
+        self.can_call = can_call
+        self.batch_window = batch_window
+        self.batch_max = batch_max
+        self._sessions: Dict[str, CallSession] = {}
+        # (call_id, recipient) -> candidates waiting to be sent, and the
+        # task that will flush them
+        self._pending: Dict[Tuple[str, str], List] = {}
+        self._flushers: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    def session_of(self, user_id: str) -> Optional[CallSession]:
+        session = self._sessions.get(user_id)
+        if session and session.state == "ringing" and time.monotonic() - session.started > RING_TIMEOUT:
+            # Never answered; forget it so both users can place new calls
+            self._drop(session)
+            return None
+        return session
+
+    def active_calls(self) -> int:
+        return len({session.call_id for session in self._sessions.values()})
+
+    def _drop(self, session: CallSession):
+        for user_id in (session.caller, session.callee):
+            if self._sessions.get(user_id) is session:
+                del self._sessions[user_id]
+            key = (session.call_id, user_id)
+            self._pending.pop(key, None)
+            flusher = self._flushers.pop(key, None)
+            if flusher:
+                flusher.cancel()
+
+    async def offer(self, sender: str, recipient: str, data) -> bool:
+        session = self.session_of(sender)
+        if session is None or session.peer_of(sender) != recipient:
+            if session is not None or self.session_of(recipient) is not None:
+                await self.send(json.dumps({"type": "call-busy", "user_id": recipient}), sender)
+                return False
+            # Checked before anyone is marked busy, so an offer can't tie up
+            # a user the caller isn't allowed to ring
+            if self.can_call and not await self.can_call(sender, recipient):
+                await self.send(json.dumps({"type": "call-unavailable", "user_id": recipient}), sender)
+                return False
+            session = CallSession(sender, recipient)
+            self._sessions[sender] = session
+            self._sessions[recipient] = session
+
+        await self.send(json.dumps({
+            "type": "offer",
+            "sender_id": sender,
+            "call_id": session.call_id,
+            "data": data
+        }), recipient)
+        return True
+
+    async def answer(self, sender: str, recipient: str, data) -> bool:
+        session = self.session_of(sender)
+        if session is None or session.peer_of(sender) != recipient:
+            return False
+        session.state = "active"
+        await self.send(json.dumps({
+            "type": "answer",
+            "sender_id": sender,
+            "call_id": session.call_id,
+            "data": data
+        }), recipient)
+        return True
+
+    async def ice_candidate(self, sender: str, recipient: str, candidate) -> bool:
+        session = self.session_of(sender)
+        if session is None or session.peer_of(sender) != recipient:
+            return False
+
+        key = (session.call_id, recipient)
+        pending = self._pending.setdefault(key, [])
+        pending.append(candidate)
+        if len(pending) >= self.batch_max or self.batch_window <= 0:
+            flusher = self._flushers.pop(key, None)
+            if flusher:
+                flusher.cancel()
+            await self._flush(key, sender)
+        elif key not in self._flushers:
+            self._flushers[key] = asyncio.create_task(self._flush_later(key, sender))
+        return True
+
+    async def _flush_later(self, key: Tuple[str, str], sender: str):
+        await asyncio.sleep(self.batch_window)
+        self._flushers.pop(key, None)
+        await self._flush(key, sender)
+
+    async def _flush(self, key: Tuple[str, str], sender: str):
+        candidates = self._pending.pop(key, None)
+        if not candidates:
+            return
+        call_id, recipient = key
+        await self.send(json.dumps({
+            "type": "ice-candidates",
+            "sender_id": sender,
+            "call_id": call_id,
+            "candidates": candidates
+        }), recipient)
+
+    async def end(self, user_id: str) -> bool:
+        # Ends the user's call, if any, and tells the other participant
+        session = self._sessions.get(user_id)
+        if session is None:
+            return False
+        self._drop(session)
+        await self.send(json.dumps({
+            "type": "call-end",
+            "sender_id": user_id,
+            "call_id": session.call_id
+        }), session.peer_of(user_id))
+        return True
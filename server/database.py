@@ -44,5 +44,20 @@ async def close_mongo_connection():
         client.close()
         print("Closed MongoDB connection")
 
+async def ensure_ttl_index(collection, field: str, seconds: int):
+    # Documents expire `seconds` after the date in `field`. create_index
+    # refuses an existing index with a different expiry, so a changed
+    # setting is applied to that index in place instead.
+    existing = (await collection.index_information()).get(f"{field}_1")
+    if existing and "expireAfterSeconds" in existing and existing["expireAfterSeconds"] != seconds:
+        await collection.database.command(
+            "collMod", collection.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds}
+        )
+    else:
+        await collection.create_index(field, expireAfterSeconds=seconds)
+
 def get_database():
     return database
+
+def get_client():
+    return client
@@ -0,0 +1,58 @@
+from pymongo import ASCENDING
+from bson import ObjectId
+from datetime import datetime
+from typing import List, Optional, Tuple
+from database import ensure_ttl_index
+import os
+import group_members
+
+# Per-device delivery cursors. When a WebSocket session closes, the id of
+# the newest message it was sent is stored for its device; the device's
+# next connection is then sent everything newer than that, so a dropped
+# phone or a reloaded tab catches up without refetching every chat.
+
+RESUME_LIMIT = 500
+# Cursors of devices that never come back are removed after this long
+CURSOR_TTL_SECONDS = int(float(os.getenv("DEVICE_CURSOR_TTL_DAYS", "30")) * 24 * 3600)
+
+
+async def ensure_indexes(db):
+    await ensure_ttl_index(db.device_cursors, "updated", CURSOR_TTL_SECONDS)
+    # Resume reads a user's direct messages, both ways, in _id order
+    await db.messages.create_index([("recipient_id", ASCENDING), ("_id", ASCENDING)])
+    await db.messages.create_index([("sender_id", ASCENDING), ("_id", ASCENDING)])
+
+
+def _key(user_id: str, device_id: str) -> str:
+    return f"{user_id}:{device_id}"
+
+
+async def load(db, user_id: str, device_id: str) -> Optional[ObjectId]:
+    doc = await db.device_cursors.find_one({"_id": _key(user_id, device_id)}, {"last_id": 1})
+    return doc["last_id"] if doc else None
+
+
+async def save(db, user_id: str, device_id: str, cursor: ObjectId):
+    # $max so a slower session of the same device can't move it backwards
+    await db.device_cursors.update_one(
+        {"_id": _key(user_id, device_id)},
+        {"$max": {"last_id": cursor}, "$set": {"updated": datetime.utcnow()}},
+        upsert=True
+    )
+
+
+async def missed_messages(db, user_id: str, cursor: ObjectId, limit: int = RESUME_LIMIT) -> Tuple[List[dict], bool]:
+    # Messages to or from the user, or in their groups, newer than the
+    # cursor, oldest first. The flag is False when there were more than
+    # `limit` and the client should reload instead.
+    group_ids = await group_members.group_ids_for_user(db, user_id)
+    query = {
+        "_id": {"$gt": cursor},
+        "$or": [
+            {"recipient_id": user_id},
+            {"sender_id": user_id},
+            {"group_id": {"$in": group_ids}}
+        ]
+    }
+    messages = await db.messages.find(query).sort("_id", ASCENDING).limit(limit + 1).to_list(limit + 1)
+    return messages[:limit], len(messages) <= limit
@@ -0,0 +1,100 @@
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import Annotated, Any, Dict, List, Literal, Optional, Union
+import json
+
+# Schemas for frames received over the WebSocket. The union is keyed on
+# `type`, so pydantic-core picks the schema straight from the tag and
+# parses and validates the raw JSON text in one pass, without building an
+# intermediate dict first.
+
+MAX_CONTENT_LENGTH = 10000
+
+
+class TypingFrame(BaseModel):
+    type: Literal["typing"]
+    recipient_id: str
+    is_typing: bool = False
+
+
+class ChatFrame(BaseModel):
+    type: Literal["message"]
+    recipient_id: Optional[str] = None
+    group_id: Optional[str] = None
+    content: str = Field("", max_length=MAX_CONTENT_LENGTH)
+    timestamp: Optional[str] = None
+    message_id: Optional[str] = None
+    client_message_id: Optional[str] = Field(None, min_length=1, max_length=64)
+    attachment_ids: List[str] = Field(default_factory=list)
+
+
+class OfferFrame(BaseModel):
+    type: Literal["offer"]
+    recipient_id: str
+    data: Dict[str, Any]
+
+
+class AnswerFrame(BaseModel):
+    type: Literal["answer"]
+    recipient_id: str
+    data: Dict[str, Any]
+
+
+class IceCandidateFrame(BaseModel):
+    type: Literal["ice-candidate"]
+    recipient_id: str
+    data: Dict[str, Any]
+
+
+class CallEndFrame(BaseModel):
+    type: Literal["call-end"]
+    recipient_id: Optional[str] = None
+
+
+class StatusFrame(BaseModel):
+    type: Literal["status"]
+    recipient_id: str
+    message_id: str
+    status: Literal["sent", "delivered", "read"]
+
+
+Frame = Annotated[
+    Union[TypingFrame, ChatFrame, OfferFrame, AnswerFrame, IceCandidateFrame, CallEndFrame, StatusFrame],
+    Field(discriminator="type")
+]
+
+_frame_adapter = TypeAdapter(Frame)
+
+
+class FrameError(ValueError):
+    def __init__(self, error: str, detail: str, frame_type: Optional[str] = None):
+        super().__init__(detail)
+        self.error = error
+        self.detail = detail
+        self.frame_type = frame_type
+
+    def reply(self) -> str:
+        return json.dumps({
+            "type": "error",
+            "error": self.error,
+            "frame": self.frame_type,
+            "detail": self.detail
+        })
+
+
+def decode(data: str) -> Frame:
+    try:
+        return _frame_adapter.validate_json(data)
+    except ValidationError as e:
+        errors = e.errors(include_url=False, include_context=False, include_input=False)
+        first = errors[0]
+        if first["type"] == "json_invalid":
+            raise FrameError("invalid_json", "Frame is not valid JSON")
+        if first["type"] in ("dict_type", "union_tag_not_found"):
+            raise FrameError("invalid_frame", "Frame must be an object with a type")
+        if first["type"] == "union_tag_invalid":
+            raise FrameError("unknown_frame", "Unknown frame type")
+
+        # loc is (type, field, ...) for errors inside a known frame type
+        frame_type = first["loc"][0] if first["loc"] else None
+        field = ".".join(str(part) for part in first["loc"][1:])
+        raise FrameError("invalid_frame", f"{field}: {first['msg']}" if field else first["msg"], frame_type)
@@ -0,0 +1,108 @@
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Set, Tuple
+import os
+import time
+
+# In-memory adjacency index over db.friendships. A user's friend set is
+# loaded on first use (several users at a time with one query) and kept
+# up to date by the routes that create or delete friendships, so
+# friendship checks and graph queries don't touch the database once warm.
+# Least recently used entries are evicted past max_users.
+#
+# Those updates only reach the worker that handled the route, so every
+# entry is reloaded once it is FRIEND_GRAPH_TTL_SECONDS old; other workers
+# see a new or removed friendship within that long.
+
+FRIEND_GRAPH_TTL_SECONDS = float(os.getenv("FRIEND_GRAPH_TTL_SECONDS", "30"))
+
+
+class FriendGraph:
+    def __init__(self, max_users: int = 100000, ttl: float = FRIEND_GRAPH_TTL_SECONDS):
+        self.max_users = max_users
+        self.ttl = ttl
+        # user id -> (monotonic time loaded, friend ids)
+        self._adjacency: "OrderedDict[str, Tuple[float, Set[str]]]" = OrderedDict()
+        self._mutations = 0
+
+    async def _lookup(self, db, user_ids: Iterable[str]) -> Dict[str, Set[str]]:
+        result: Dict[str, Set[str]] = {}
+        missing = []
+        now = time.monotonic()
+        for user_id in dict.fromkeys(user_ids):
+            entry = self._adjacency.get(user_id)
+            if entry and now - entry[0] < self.ttl:
+                self._adjacency.move_to_end(user_id)
+                result[user_id] = entry[1]
+            else:
+                missing.append(user_id)
+        if not missing:
+            return result
+
+        mutations = self._mutations
+        loaded: Dict[str, Set[str]] = {user_id: set() for user_id in missing}
+        async for friendship in db.friendships.find(
+            {"$or": [{"user1_id": {"$in": missing}}, {"user2_id": {"$in": missing}}]},
+            {"user1_id": 1, "user2_id": 1, "_id": 0}
+        ):
+            a, b = friendship["user1_id"], friendship["user2_id"]
+            if a in loaded:
+                loaded[a].add(b)
+            if b in loaded:
+                loaded[b].add(a)
+
+        # A friendship added or removed while the query ran may be missing
+        # from the result, so only cache when nothing changed meanwhile
+        if mutations == self._mutations:
+            for user_id, friends in loaded.items():
+                self._adjacency[user_id] = (now, friends)
+                self._adjacency.move_to_end(user_id)
+            while len(self._adjacency) > self.max_users:
+                self._adjacency.popitem(last=False)
+
+        result.update(loaded)
+        return result
+
+    async def preload(self, db, user_ids: Iterable[str]):
+        await self._lookup(db, user_ids)
+
+    async def friends_of(self, db, user_id: str) -> Set[str]:
+        return set((await self._lookup(db, [user_id]))[user_id])
+
+    async def is_friend(self, db, user_id: str, other_id: str) -> bool:
+        return other_id in (await self._lookup(db, [user_id]))[user_id]
+
+    async def mutual_friends(self, db, user_id: str, other_id: str) -> Set[str]:
+        sets = await self._lookup(db, [user_id, other_id])
+        return sets[user_id] & sets[other_id]
+
+    async def mutual_counts(self, db, user_id: str, other_ids: Iterable[str]) -> Dict[str, int]:
+        other_ids = list(other_ids)
+        sets = await self._lookup(db, [user_id] + other_ids)
+        return {other: len(sets[user_id] & sets[other]) for other in other_ids}
+
+    async def suggestions(self, db, user_id: str, exclude: Iterable[str] = (), limit: int = 10) -> List[Tuple[str, int]]:
+        # Friends of friends, ranked by how many friends they share
+        friends = (await self._lookup(db, [user_id]))[user_id]
+        counts = Counter()
+        for friends_of_friend in (await self._lookup(db, friends)).values():
+            counts.update(friends_of_friend)
+
+        skip = friends | set(exclude) | {user_id}
+        return [(candidate, n) for candidate, n in counts.most_common() if candidate not in skip][:limit]
+
+    def add_friendship(self, user_id: str, other_id: str):
+        self._mutations += 1
+        if user_id in self._adjacency:
+            self._adjacency[user_id][1].add(other_id)
+        if other_id in self._adjacency:
+            self._adjacency[other_id][1].add(user_id)
+
+    def remove_friendship(self, user_id: str, other_id: str):
+        self._mutations += 1
+        if user_id in self._adjacency:
+            self._adjacency[user_id][1].discard(other_id)
+        if other_id in self._adjacency:
+            self._adjacency[other_id][1].discard(user_id)
+
+
+friend_graph = FriendGraph()
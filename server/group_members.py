@@ -0,0 +1,155 @@
+from pymongo import ASCENDING, UpdateOne
+from bson import ObjectId
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+import read_receipts
+
+# Group membership lives in its own collection, one document per
+# (group_id, user_id) pair, so that membership checks are a single indexed
+# lookup and large groups never have to be loaded or rewritten as a whole.
+# The group document only keeps a denormalized member_count, recounted
+# from the index whenever the membership changes.
+
+MEMBER_PAGE_SIZE = 100
+MAX_MEMBER_PAGE_SIZE = 1000
+FANOUT_CHUNK_SIZE = 1000
+
+
+async def ensure_indexes(db):
+    await db.group_members.create_index(
+        [("group_id", ASCENDING), ("user_id", ASCENDING)], unique=True
+    )
+    await db.group_members.create_index([("user_id", ASCENDING), ("_id", ASCENDING)])
+
+
+def _upserts(group_id: str, user_ids: Iterable[str]) -> List[UpdateOne]:
+    return [
+        UpdateOne(
+            {"group_id": group_id, "user_id": user_id},
+            {"$setOnInsert": {"group_id": group_id, "user_id": user_id}},
+            upsert=True
+        )
+        for user_id in user_ids
+    ]
+
+
+async def is_member(db, group_id: str, user_id: str) -> bool:
+    doc = await db.group_members.find_one(
+        {"group_id": group_id, "user_id": user_id}, {"_id": 1}
+    )
+    return doc is not None
+
+
+async def add_members(db, group_id: str, user_ids: Iterable[str]) -> int:
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return 0
+
+    result = await db.group_members.bulk_write(_upserts(group_id, user_ids), ordered=False)
+
+    added = result.upserted_count
+    if added:
+        await _sync_member_count(db, group_id)
+    return added
+
+
+async def remove_members(db, group_id: str, user_ids: Iterable[str]) -> int:
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return 0
+
+    result = await db.group_members.delete_many(
+        {"group_id": group_id, "user_id": {"$in": user_ids}}
+    )
+
+    removed = result.deleted_count
+    if removed:
+        await _sync_member_count(db, group_id)
+        # Former members no longer count towards "seen by"
+        await read_receipts.forget_members(db, group_id, user_ids)
+    return removed
+
+
+async def _sync_member_count(db, group_id: str):
+    # Recounted from the index rather than moved by $inc, so a failed write
+    # or overlapping batches can't leave the count off for good; the next
+    # change to the group always puts it right
+    member_count = await db.group_members.count_documents({"group_id": group_id})
+    await db.groups.update_one({"_id": ObjectId(group_id)}, {"$set": {"member_count": member_count}})
+
+
+async def list_member_ids(
+    db,
+    group_id: str,
+    after: Optional[str] = None,
+    limit: int = MEMBER_PAGE_SIZE
+) -> List[str]:
+    query = {"group_id": group_id}
+    if after:
+        query["user_id"] = {"$gt": after}
+
+    cursor = db.group_members.find(query, {"user_id": 1, "_id": 0}).sort("user_id", ASCENDING).limit(limit)
+    return [doc["user_id"] async for doc in cursor]
+
+
+async def preview_member_ids(
+    db,
+    group_ids: List[str],
+    limit: int = MEMBER_PAGE_SIZE
+) -> Dict[str, List[str]]:
+    # The first page of member ids of each group, as list_member_ids would
+    # return it, with one aggregate instead of a query per group. $topN
+    # (MongoDB 5.2+) keeps at most `limit` ids per group while grouping, so
+    # large groups never build their whole member list
+    if not group_ids:
+        return {}
+    pipeline = [
+        {"$match": {"group_id": {"$in": group_ids}}},
+        {"$group": {
+            "_id": "$group_id",
+            "user_ids": {"$topN": {"n": limit, "sortBy": {"user_id": ASCENDING}, "output": "$user_id"}}
+        }}
+    ]
+    previews = {group_id: [] for group_id in group_ids}
+    async for doc in db.group_members.aggregate(pipeline):
+        previews[doc["_id"]] = doc["user_ids"]
+    return previews
+
+
+async def iter_member_id_chunks(
+    db,
+    group_id: str,
+    chunk_size: int = FANOUT_CHUNK_SIZE
+) -> AsyncIterator[List[str]]:
+    # Walks the membership index in fixed-size pages so fan-out to very
+    # large groups never materializes the whole member list at once
+    after = None
+    while True:
+        chunk = await list_member_ids(db, group_id, after=after, limit=chunk_size)
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        after = chunk[-1]
+
+
+async def group_ids_for_user(db, user_id: str) -> List[str]:
+    cursor = db.group_members.find({"user_id": user_id}, {"group_id": 1, "_id": 0})
+    return [doc["group_id"] async for doc in cursor]
+
+
+async def migrate_embedded_members(db):
+    # Move members out of legacy group documents that still embed them
+    migrated = 0
+    async for group in db.groups.find({"members": {"$exists": True}}, {"members": 1}):
+        group_id = str(group["_id"])
+        if group.get("members"):
+            await db.group_members.bulk_write(_upserts(group_id, group["members"]), ordered=False)
+        member_count = await db.group_members.count_documents({"group_id": group_id})
+        await db.groups.update_one(
+            {"_id": group["_id"]},
+            {"$set": {"member_count": member_count}, "$unset": {"members": ""}}
+        )
+        migrated += 1
+
+    if migrated:
+        print(f"Migrated embedded members of {migrated} groups")
@@ -0,0 +1,145 @@
+from bisect import bisect_left
+from datetime import datetime
+from typing import Optional
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+# Event loop lag monitor. Every socket and request shares one asyncio loop,
+# so any synchronous stretch (password hashing, a huge json.dumps, a Python
+# loop over a big member list) delays all of them. A task sleeps for
+# LOOP_MONITOR_INTERVAL_MS at a time and records how late it wakes up in a
+# histogram. A watchdog thread watches the same task's heartbeat; when the
+# loop has been stuck for LOOP_BLOCK_THRESHOLD_MS it prints the loop
+# thread's stack, which is the code doing the blocking, once per stall.
+
+LOOP_MONITOR_INTERVAL_MS = float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100"))
+# 0 turns the watchdog off; lag is still measured
+LOOP_BLOCK_THRESHOLD_MS = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "250"))
+LAG_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+STALL_STACK_DEPTH = 40
+
+
+class LagHistogram:
+    def __init__(self, buckets=LAG_BUCKETS_MS):
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        # One count per bucket plus one for lag above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, lag_ms: float):
+        self.counts[bisect_left(self.buckets, lag_ms)] += 1
+        self.count += 1
+        self.total += lag_ms
+        self.max = max(self.max, lag_ms)
+
+    def quantile(self, q: float) -> Optional[float]:
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self) -> dict:
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets.append({"le": bound, "count": cumulative})
+        buckets.append({"le": "+Inf", "count": self.count})
+        return {
+            "count": self.count,
+            "sum_ms": round(self.total, 1),
+            "max_ms": round(self.max, 1),
+            "p50_ms": self.quantile(0.5),
+            "p99_ms": self.quantile(0.99),
+            "buckets": buckets
+        }
+
+
+class LoopMonitor:
+    def __init__(self, interval_ms: float = LOOP_MONITOR_INTERVAL_MS, threshold_ms: float = LOOP_BLOCK_THRESHOLD_MS):
+        self.interval_ms = interval_ms
+        self.threshold_ms = threshold_ms
+        self.histogram = LagHistogram()
+        self.stalls = 0
+        self.last_stall: Optional[dict] = None
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        # Call from the event loop being monitored
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._measure())
+        if self.threshold_ms > 0:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _measure(self):
+        interval = self.interval_ms / 1000
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            self._heartbeat = time.monotonic()
+            self.histogram.observe(max(0.0, (self._heartbeat - started - interval) * 1000))
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.threshold_ms / 4000):
+            heartbeat = self._heartbeat
+            # The next heartbeat is due one interval after the last
+            blocked_ms = (time.monotonic() - heartbeat) * 1000 - self.interval_ms
+            if blocked_ms < self.threshold_ms or heartbeat == reported:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame, limit=STALL_STACK_DEPTH)) if frame else ""
+            self.stalls += 1
+            # How long it had been blocked when caught; the histogram gets
+            # the full lag once the loop wakes up
+            self.last_stall = {
+                "at": datetime.utcnow().isoformat(),
+                "blocked_ms": round(blocked_ms, 1),
+                "stack": stack
+            }
+            print(f"Event loop blocked for over {blocked_ms:.0f} ms, stack:\n{stack}")
+
+    def stats(self) -> dict:
+        return {
+            "interval_ms": self.interval_ms,
+            "threshold_ms": self.threshold_ms,
+            "lag": self.histogram.snapshot(),
+            "stalls": self.stalls,
+            "last_stall": self.last_stall
+        }
+
+    def reset(self):
+        self.histogram.reset()
+        self.stalls = 0
+        self.last_stall = None
+
+
+loop_monitor = LoopMonitor()
@@ -1,24 +1,94 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from contextlib import asynccontextmanager
 import uvicorn
-from typing import Dict, Set
+from typing import Dict, Optional, Set, Tuple
 import json
+import asyncio
+import os
+import random
+from bson import ObjectId
 
-from routes import auth, users, friends, messages, groups
-from database import connect_to_mongo, close_mongo_connection
-from websocket_manager import ConnectionManager
+from routes import auth, users, friends, messages, groups, admin, attachments
+from database import connect_to_mongo, close_mongo_connection, get_database, get_client
+from storage import open_server_storage, set_storage
+from websocket_manager import ConnectionManager, Session
+from call_sessions import CallRegistry
+import group_members
+import message_store
+import search_index
+import avatar_store
+import rate_limit
+import frames
+import device_cursors
+import message_ingest
+import attachment_store
+import wire_format
+import maintenance
+from profiler import profiler, ProfilerMiddleware
+from loop_monitor import loop_monitor
+from friend_graph import friend_graph
+from auth_utils import decode_token, create_resume_token, decode_resume_token
+from startup import startup, fill_connection_pool, prime_caches, preload_modules
 
 # Connection manager for WebSocket connections
 manager = ConnectionManager()
 
+async def can_call(caller: str, callee: str) -> bool:
+    # Calls only ring friends who are connected right now
+    return manager.is_online(callee) and await friend_graph.is_friend(get_database(), caller, callee)
+
+calls = CallRegistry(manager.send_personal_message, can_call)
+
+# Clients closed on shutdown are told to reconnect at a random point
+# within this many seconds
+DRAIN_SPREAD_SECONDS = float(os.getenv("DRAIN_SPREAD_SECONDS", "10"))
+
+async def drain_connections():
+    await manager.drain(
+        int(DRAIN_SPREAD_SECONDS * 1000),
+        lambda user_id, session: create_resume_token(user_id, session.device_id)
+    )
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup
-    await connect_to_mongo()
+    # Startup, one timed phase at a time; /readyz fails until all are done
+    loop_monitor.start()
+    async with startup.phase("connect"):
+        await connect_to_mongo()
+        db = get_database()
+        storage = open_server_storage(db)
+        set_storage(storage)
+    async with startup.phase("indexes and migrations"):
+        await group_members.ensure_indexes(db)
+        await group_members.migrate_embedded_members(db)
+        await message_store.ensure_indexes(db)
+        await search_index.ensure_indexes(db)
+        await friends.migrate_pair_keys(db)
+        await friends.ensure_indexes(db)
+        await avatar_store.migrate_legacy_avatars(db)
+        await rate_limit.ensure_indexes(db)
+        await device_cursors.ensure_indexes(db)
+        await message_ingest.ensure_indexes(db)
+        await attachment_store.ensure_indexes(db)
+    async with startup.phase("connection pool"):
+        await fill_connection_pool(get_client())
+    async with startup.phase("caches"):
+        preload_modules()
+        await prime_caches(db)
+    if maintenance.MAINTENANCE_ENABLED:
+        await maintenance.scheduler.start(db)
+    startup.finish()
     yield
     # Shutdown
+    startup.ready = False
+    await drain_connections()
+    await maintenance.scheduler.stop()
+    loop_monitor.stop()
+    set_storage(None)
+    await storage.close()
     await close_mongo_connection()
 
 app = FastAPI(title="ChatterBox API", lifespan=lifespan)
@@ -32,21 +102,245 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compresses responses of at least COMPRESS_MIN_BYTES unless a route
+# already encoded them (brotli history pages, gzip exports); attachment
+# downloads are left alone so Range and pathsend keep working
+app.add_middleware(wire_format.CompressionMiddleware, minimum_size=wire_format.COMPRESS_MIN_BYTES, compresslevel=6)
+
+# Samples a fraction of requests when PROFILE_SAMPLE_RATE is set
+app.add_middleware(ProfilerMiddleware)
+
 # Include routers
 app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
 app.include_router(users.router, prefix="/api/users", tags=["users"])
 app.include_router(friends.router, prefix="/api/friends", tags=["friends"])
 app.include_router(messages.router, prefix="/api/messages", tags=["messages"])
 app.include_router(groups.router, prefix="/api/groups", tags=["groups"])
+app.include_router(attachments.router, prefix="/api/attachments", tags=["attachments"])
+app.include_router(admin.router, prefix="/api/admin", tags=["admin"])
 
 @app.get("/")
 async def root():
     return {"message": "ChatterBox API"}
 
-@app.websocket("/ws/{token}")
-async def websocket_endpoint(websocket: WebSocket, token: str):
-    from auth_utils import decode_token
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the process is up and serving requests
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    # Readiness: warmed up, not draining, and the database answers
+    ready = startup.ready and not manager.draining
+    if ready:
+        try:
+            await asyncio.wait_for(get_client().admin.command("ping"), timeout=2.0)
+        except Exception:
+            ready = False
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"status": "ready" if ready else "not ready", "startup_ms": startup.phases}
+    )
+
+@app.get("/api/bootstrap")
+async def bootstrap(current_user: str = Depends(users.get_current_user)):
+    # Everything the dashboard shows after sign-in, in one round trip. The
+    # friend, group and request queries run together, then every user they
+    # mention is resolved with a single users query.
+    db = get_database()
+    friend_ids, (group_docs, previews), requests = await asyncio.gather(
+        friend_graph.friends_of(db, current_user),
+        groups.load_user_groups(db, current_user),
+        friends.pending_requests(db, current_user)
+    )
     
+    mentioned = {current_user, *friend_ids}
+    mentioned.update(member_id for preview in previews.values() for member_id in preview)
+    mentioned.update(req["from_user_id"] for req in requests)
+    cards = {card["id"]: card for card in await users.user_cards(list(mentioned))}
+    
+    if current_user not in cards:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    
+    friend_cards = sorted(
+        (cards[friend_id] for friend_id in friend_ids if friend_id in cards),
+        key=lambda card: card["username"].lower()
+    )
+    return {
+        "profile": cards[current_user],
+        "friends": friend_cards,
+        "groups": [groups.group_listing(group, previews[str(group["_id"])], cards) for group in group_docs],
+        "friend_requests": friends.request_listing(requests, cards),
+        "online": manager.online_among(friend_ids)
+    }
+
+# WebSocket frame handlers, one per frame type
+async def handle_typing(user_id: str, session: Session, frame: frames.TypingFrame):
+    await manager.send_personal_message(
+        json.dumps({
+            "type": "typing",
+            "user_id": user_id,
+            "is_typing": frame.is_typing
+        }),
+        frame.recipient_id
+    )
+
+# (sender, message_id) of messages already fanned out, so a frame resent
+# after a flaky connection isn't delivered twice
+delivered_messages = message_ingest.SeenSet()
+
+async def ingest_message(user_id: str, session: Session, frame: frames.ChatFrame) -> Tuple[bool, Optional[dict]]:
+    # A frame with a client_message_id but no message_id hasn't been saved
+    # through the REST API; save it here. Either way the sender gets an ack
+    # with the server id, and the frame is only delivered the first time.
+    # Returns whether there is anything (more) to deliver, and the stored
+    # message the frame carries; ids and attachments the server can't
+    # vouch for are never relayed or used to move device cursors.
+    db = get_database()
+    stored = None
+    if frame.client_message_id and not frame.message_id:
+        # Only attachments the sender uploaded are passed on, and they are
+        # shared only once the message is sure to be stored
+        try:
+            attachments = await attachment_store.attach(
+                db, user_id, frame.attachment_ids, frame.recipient_id, frame.group_id
+            )
+        except attachment_store.InvalidAttachment as e:
+            await session.websocket.send_text(frames.FrameError("invalid_attachment", str(e), frame.type).reply())
+            return False, None
+        stored, _ = await message_ingest.store_message(
+            db, user_id, frame.recipient_id, frame.group_id, frame.content, frame.client_message_id, attachments
+        )
+        frame.message_id = str(stored["_id"])
+        frame.timestamp = stored["timestamp"].isoformat()
+    elif frame.message_id:
+        stored = await message_ingest.find_sent(
+            db, user_id, frame.message_id, frame.recipient_id, frame.group_id, frame.client_message_id
+        )
+    if frame.client_message_id:
+        await session.websocket.send_text(json.dumps({
+            "type": "ack",
+            "client_message_id": frame.client_message_id,
+            "message_id": frame.message_id
+        }))
+    if stored:
+        return delivered_messages.add((user_id, str(stored["_id"]))), stored
+    return True, None
+
+async def handle_message(user_id: str, session: Session, frame: frames.ChatFrame):
+    if not frame.group_id and not frame.recipient_id:
+        return
+    if not frame.content and not frame.attachment_ids:
+        return
+    db = get_database()
+    if not await message_ingest.can_send(user_id, frame.recipient_id, frame.group_id):
+        return
+    deliver, stored = await ingest_message(user_id, session, frame)
+    if not deliver:
+        return
+    message_id = str(stored["_id"]) if stored else None
+    attachments = stored.get("attachments", []) if stored else []
+    if frame.group_id:
+        # Group message - fan out to members chunk by chunk
+        try:
+            payload = json.dumps({
+                "type": "message",
+                "sender_id": user_id,
+                "group_id": frame.group_id,
+                "content": frame.content,
+                "attachments": attachments,
+                "timestamp": frame.timestamp,
+                "message_id": message_id
+            })
+            async for member_ids in group_members.iter_member_id_chunks(db, frame.group_id):
+                await manager.send_group_message(payload, frame.group_id, user_id, member_ids)
+                for member_id in member_ids:
+                    manager.mark_delivered(member_id, message_id)
+            # Keep the sender's other tabs and devices in sync
+            await manager.send_personal_message(payload, user_id, exclude=session.session_id)
+        except Exception as e:
+            print(f"Error sending group message: {e}")
+    elif frame.recipient_id:
+        # One-to-one message, also sent to the sender's other sessions
+        payload = json.dumps({
+            "type": "message",
+            "sender_id": user_id,
+            "recipient_id": frame.recipient_id,
+            "content": frame.content,
+            "attachments": attachments,
+            "timestamp": frame.timestamp,
+            "message_id": message_id
+        })
+        await manager.send_personal_message(payload, frame.recipient_id)
+        await manager.send_personal_message(payload, user_id, exclude=session.session_id)
+        manager.mark_delivered(frame.recipient_id, message_id)
+        manager.mark_delivered(user_id, message_id)
+
+async def handle_offer(user_id: str, session: Session, frame: frames.OfferFrame):
+    # WebRTC signaling - an offer opens a call between the pair
+    await calls.offer(user_id, frame.recipient_id, frame.data)
+
+async def handle_answer(user_id: str, session: Session, frame: frames.AnswerFrame):
+    await calls.answer(user_id, frame.recipient_id, frame.data)
+
+async def handle_ice_candidate(user_id: str, session: Session, frame: frames.IceCandidateFrame):
+    # Batched and delivered to the peer as ice-candidates
+    await calls.ice_candidate(user_id, frame.recipient_id, frame.data)
+
+async def handle_call_end(user_id: str, session: Session, frame: frames.CallEndFrame):
+    await calls.end(user_id)
+
+async def handle_status(user_id: str, session: Session, frame: frames.StatusFrame):
+    # Message status update
+    await manager.send_personal_message(
+        json.dumps({
+            "type": "status",
+            "message_id": frame.message_id,
+            "status": frame.status
+        }),
+        frame.recipient_id
+    )
+
+FRAME_HANDLERS = {
+    "typing": handle_typing,
+    "message": handle_message,
+    "offer": handle_offer,
+    "answer": handle_answer,
+    "ice-candidate": handle_ice_candidate,
+    "call-end": handle_call_end,
+    "status": handle_status,
+}
+
+async def resume_session(db, user_id: str, session: Session):
+    # Send a reconnecting device what it missed since its last session
+    cursor = await device_cursors.load(db, user_id, session.device_id)
+    if cursor is None:
+        # First time this device connects; catch up from now on
+        session.cursor = ObjectId()
+        return
+    session.cursor = cursor
+    messages, complete = await device_cursors.missed_messages(db, user_id, cursor)
+    for msg in messages:
+        await session.websocket.send_text(json.dumps({
+            "type": "message",
+            "sender_id": msg["sender_id"],
+            "recipient_id": msg.get("recipient_id"),
+            "group_id": msg.get("group_id"),
+            "content": msg["content"],
+            "attachments": msg.get("attachments", []),
+            "timestamp": msg["timestamp"].isoformat(),
+            "message_id": str(msg["_id"]),
+            "replayed": True
+        }))
+        session.cursor = msg["_id"]
+    await session.websocket.send_text(json.dumps({
+        "type": "resumed",
+        "count": len(messages),
+        "complete": complete
+    }))
+
+@app.websocket("/ws/{token}")
+async def websocket_endpoint(websocket: WebSocket, token: str, device: Optional[str] = None, resume: Optional[str] = None):
     try:
         payload = decode_token(token)
         user_id = payload.get("sub")
@@ -57,113 +351,95 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
         await websocket.close(code=1008)
         return
     
-    await manager.connect(user_id, websocket)
+    if manager.draining:
+        # Shutting down; send the client elsewhere after a random delay
+        await websocket.accept()
+        await websocket.close(code=1012, reason=f"retry={random.randint(500, int(DRAIN_SPREAD_SECONDS * 1000))}")
+        return
+    
+    # A client reconnecting after a drain never appeared offline to its
+    # friends, so it doesn't need to be announced again
+    resumed = False
+    if resume:
+        try:
+            resumed = decode_resume_token(resume).get("sub") == user_id
+        except Exception:
+            pass
+    
+    # Presence is only announced to the user's friends
+    db = get_database()
+    friends = await friend_graph.friends_of(db, user_id)
+    session = await manager.connect(
+        user_id, websocket, friends, device_id=device[:64] if device else None, announce=not resumed
+    )
     
     try:
+        # Tell the new session which friends are online right now
+        await websocket.send_text(json.dumps({
+            "type": "presence",
+            "online": manager.online_among(friends)
+        }))
+        
+        if session.device_id:
+            await resume_session(db, user_id, session)
+        
         while True:
             data = await websocket.receive_text()
-            message_data = json.loads(data)
             
-            message_type = message_data.get("type")
+            try:
+                frame = frames.decode(data)
+            except frames.FrameError as e:
+                # Reply to bad frames, but no faster than the invalid-frame allowance
+                if await rate_limit.limiter.check(user_id, "ws:invalid") is None:
+                    await websocket.send_text(e.reply())
+                continue
             
-            if message_type == "typing":
-                # Handle typing indicator
-                recipient_id = message_data.get("recipient_id")
-                if recipient_id:
-                    await manager.send_personal_message(
-                        json.dumps({
-                            "type": "typing",
-                            "user_id": user_id,
-                            "is_typing": message_data.get("is_typing", False)
-                        }),
-                        recipient_id
-                    )
+            # Drop frames over the sender's allowance and tell them when to retry
+            retry_after = await rate_limit.limiter.check(user_id, f"ws:{frame.type}")
+            if retry_after is not None:
+                await websocket.send_text(json.dumps({
+                    "type": "error",
+                    "error": "rate_limited",
+                    "frame": frame.type,
+                    "retry_after": round(min(retry_after, 3600), 2)
+                }))
+                continue
             
-            elif message_type == "message":
-                # Handle chat message
-                recipient_id = message_data.get("recipient_id")
-                group_id = message_data.get("group_id")
-                content = message_data.get("content")
-                
-                if group_id:
-                    # Group message - fetch group members
-                    from database import get_database
-                    from bson import ObjectId
-                    db = get_database()
-                    try:
-                        group = await db.groups.find_one({"_id": ObjectId(group_id)})
-                        if group and user_id in group.get("members", []):
-                            await manager.send_group_message(
-                                json.dumps({
-                                    "type": "message",
-                                    "sender_id": user_id,
-                                    "group_id": group_id,
-                                    "content": content,
-                                    "timestamp": message_data.get("timestamp")
-                                }),
-                                group_id,
-                                user_id,
-                                group.get("members", [])
-                            )
-                    except Exception as e:
-                        print(f"Error sending group message: {e}")
-                elif recipient_id:
-                    # One-to-one message
-                    await manager.send_personal_message(
-                        json.dumps({
-                            "type": "message",
-                            "sender_id": user_id,
-                            "content": content,
-                            "timestamp": message_data.get("timestamp"),
-                            "message_id": message_data.get("message_id")
-                        }),
-                        recipient_id
-                    )
-            
-            elif message_type in ["offer", "answer", "ice-candidate"]:
-                # WebRTC signaling
-                recipient_id = message_data.get("recipient_id")
-                if recipient_id:
-                    await manager.send_personal_message(
-                        json.dumps({
-                            "type": message_type,
-                            "sender_id": user_id,
-                            "data": message_data.get("data")
-                        }),
-                        recipient_id
-                    )
-            
-            elif message_type == "call-end":
-                # Call ended
-                recipient_id = message_data.get("recipient_id")
-                if recipient_id:
-                    await manager.send_personal_message(
-                        json.dumps({
-                            "type": "call-end",
-                            "sender_id": user_id
-                        }),
-                        recipient_id
-                    )
-            
-            elif message_type == "status":
-                # Message status update
-                recipient_id = message_data.get("recipient_id")
-                message_id = message_data.get("message_id")
-                status_type = message_data.get("status")
-                
-                if recipient_id and message_id:
-                    await manager.send_personal_message(
-                        json.dumps({
-                            "type": "status",
-                            "message_id": message_id,
-                            "status": status_type
-                        }),
-                        recipient_id
-                    )
+            try:
+                await profiler.maybe_run(f"ws:{frame.type}", FRAME_HANDLERS[frame.type](user_id, session, frame))
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                print(f"Error handling {frame.type} frame from {user_id}: {e}")
+                await websocket.send_text(frames.FrameError("internal_error", "Could not process frame", frame.type).reply())
     
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
-        await manager.broadcast_user_status(user_id, "offline")
+        pass
+    except RuntimeError:
+        # Receiving after drain_connections closed the socket
+        if not manager.draining:
+            raise
+    finally:
+        if session.device_id and session.cursor:
+            await device_cursors.save(db, user_id, session.device_id, session.cursor)
+        # Calls and presence belong to the user, so they only end with the last session
+        if manager.disconnect(user_id, session.session_id):
+            await calls.end(user_id)
+            if not manager.draining:
+                await manager.broadcast_user_status(
+                    user_id, "offline", await friend_graph.friends_of(db, user_id)
+                )
+
+class DrainingServer(uvicorn.Server):
+    # uvicorn closes open WebSockets itself before running the lifespan
+    # shutdown, without a retry hint, so drain them before that happens
+    async def shutdown(self, sockets=None):
+        import main
+        await main.drain_connections()
+        await super().shutdown(sockets)
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # "main:app" is imported as its own module, separate from this script,
+    # which is why DrainingServer reaches the manager through `import main`
+    config = uvicorn.Config("main:app", host="0.0.0.0", port=8000)
+    DrainingServer(config).run()
@@ -0,0 +1,332 @@
+from datetime import datetime, timedelta
+from pymongo import DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+import asyncio
+import os
+import socket
+import time
+import uuid
+
+from database import ensure_ttl_index
+import attachment_store
+import message_store
+import search_index
+from routes import friends
+
+# In-process maintenance scheduler. Every worker runs one, but only the
+# holder of the "maintenance" lease in db.maintenance_leases runs jobs; the
+# lease lasts MAINTENANCE_LEASE_SECONDS and the leader renews it every
+# third of that, so another worker takes over within one lease of the
+# leader going away.
+#
+# Jobs run one at a time and work in batches of MAINTENANCE_BATCH_SIZE.
+# After each batch a job sleeps long enough that it is busy for at most
+# MAINTENANCE_DUTY_CYCLE of the time, so slow batches (a loaded database)
+# automatically mean longer pauses, and it stops at the next batch if the
+# worker has lost the lease. Each run is recorded in db.maintenance_runs
+# (kept MAINTENANCE_HISTORY_DAYS), which is also how a new leader knows
+# when every job last ran.
+#
+# Jobs:
+#   friend_request_retention  answered requests after FRIEND_REQUEST_RETENTION_DAYS
+#   message_retention         messages, cold buckets and search postings after
+#                             MESSAGE_RETENTION_DAYS (0, the default, keeps them)
+#   message_compaction        the cold-tier compactor, when MESSAGE_BUCKETING is on
+#   attachment_gc             blobs no attachment refers to any more
+
+MAINTENANCE_ENABLED = os.getenv("MAINTENANCE_ENABLED", "true").lower() in ("1", "true", "yes")
+MAINTENANCE_LEASE_SECONDS = float(os.getenv("MAINTENANCE_LEASE_SECONDS", "60"))
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "500"))
+MAINTENANCE_DUTY_CYCLE = float(os.getenv("MAINTENANCE_DUTY_CYCLE", "0.2"))
+MAINTENANCE_HISTORY_DAYS = float(os.getenv("MAINTENANCE_HISTORY_DAYS", "30"))
+FRIEND_REQUEST_RETENTION_DAYS = float(os.getenv("FRIEND_REQUEST_RETENTION_DAYS", "30"))
+MESSAGE_RETENTION_DAYS = float(os.getenv("MESSAGE_RETENTION_DAYS", "0"))
+RETENTION_INTERVAL_SECONDS = 3600
+ATTACHMENT_GC_INTERVAL_SECONDS = 6 * 3600
+# How often the scheduler looks for due jobs
+TICK_SECONDS = 5.0
+
+LEASE_NAME = "maintenance"
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class JobRun:
+    # Handed to a running job; paces it and tracks its progress
+    def __init__(self, scheduler: "Scheduler", name: str):
+        self.scheduler = scheduler
+        self.name = name
+        self.started = time.monotonic()
+        self.processed = 0
+        self.batches = 0
+        self.paused = 0.0
+        self._busy_since = self.started
+
+    async def after_batch(self, count: int):
+        self.processed += count
+        self.batches += 1
+        busy = time.monotonic() - self._busy_since
+        pause = busy * (1 - MAINTENANCE_DUTY_CYCLE) / MAINTENANCE_DUTY_CYCLE
+        if pause > 0:
+            await asyncio.sleep(pause)
+            self.paused += pause
+        if not self.scheduler.is_leader:
+            raise LeaseLost
+        self._busy_since = time.monotonic()
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self.started) * 1000
+
+
+class Job(NamedTuple):
+    name: str
+    interval: float
+    run: Callable[[object, JobRun], Awaitable[int]]
+
+
+class JobStats:
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.last_started: Optional[datetime] = None
+        self.last_duration_ms: Optional[float] = None
+        self.last_result: Optional[int] = None
+        self.last_error: Optional[str] = None
+        self.total_processed = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_started": self.last_started.isoformat() if self.last_started else None,
+            "last_duration_ms": round(self.last_duration_ms, 1) if self.last_duration_ms is not None else None,
+            "last_result": self.last_result,
+            "last_error": self.last_error,
+            "total_processed": self.total_processed
+        }
+
+
+async def _friend_request_retention(db, run: JobRun) -> int:
+    cutoff = datetime.utcnow() - timedelta(days=FRIEND_REQUEST_RETENTION_DAYS)
+    return await friends.expire_answered_requests(db, cutoff, MAINTENANCE_BATCH_SIZE, run.after_batch)
+
+
+async def _message_retention(db, run: JobRun) -> int:
+    # Postings first, so search never returns a message that's gone
+    cutoff = datetime.utcnow() - timedelta(days=MESSAGE_RETENTION_DAYS)
+    await search_index.expire_before(db, cutoff, MAINTENANCE_BATCH_SIZE, run.after_batch)
+    return await message_store.expire_before(db, cutoff, MAINTENANCE_BATCH_SIZE, run.after_batch)
+
+
+async def _message_compaction(db, run: JobRun) -> int:
+    return await message_store.compact_once(db, after_batch=run.after_batch)
+
+
+async def _attachment_gc(db, run: JobRun) -> int:
+    return await attachment_store.collect_garbage(db, batch_size=MAINTENANCE_BATCH_SIZE, after_batch=run.after_batch)
+
+
+def default_jobs() -> List[Job]:
+    jobs = [
+        Job("friend_request_retention", RETENTION_INTERVAL_SECONDS, _friend_request_retention),
+        Job("attachment_gc", ATTACHMENT_GC_INTERVAL_SECONDS, _attachment_gc)
+    ]
+    if MESSAGE_RETENTION_DAYS > 0:
+        jobs.append(Job("message_retention", RETENTION_INTERVAL_SECONDS, _message_retention))
+    if message_store.BUCKETING_ENABLED:
+        jobs.append(Job("message_compaction", message_store.COMPACT_INTERVAL_SECONDS, _message_compaction))
+    return jobs
+
+
+class Scheduler:
+    def __init__(self, jobs: Optional[List[Job]] = None):
+        self.jobs: Dict[str, Job] = {job.name: job for job in (jobs if jobs is not None else default_jobs())}
+        self.stats: Dict[str, JobStats] = {name: JobStats() for name in self.jobs}
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.db = None
+        self.current: Optional[JobRun] = None
+        self._lease_until = 0.0
+        self._last_run: Dict[str, datetime] = {}
+        self._requested: List[str] = []
+        self._wake = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._lease_until
+
+    async def ensure_indexes(self, db):
+        await ensure_ttl_index(db.maintenance_runs, "finished_at", int(MAINTENANCE_HISTORY_DAYS * 24 * 3600))
+        await db.maintenance_runs.create_index([("job", 1), ("finished_at", DESCENDING)])
+
+    async def _acquire(self) -> bool:
+        # Take the lease if it's free or expired, or extend our own
+        now = datetime.utcnow()
+        asked_at = time.monotonic()
+        try:
+            await self.db.maintenance_leases.find_one_and_update(
+                {"_id": LEASE_NAME, "$or": [{"holder": self.worker_id}, {"expires": {"$lt": now}}]},
+                {"$set": {"holder": self.worker_id, "expires": now + timedelta(seconds=MAINTENANCE_LEASE_SECONDS)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return False
+        # Counted from before the request, so we let go no later than the
+        # database thinks the lease ends
+        self._lease_until = asked_at + MAINTENANCE_LEASE_SECONDS
+        return True
+
+    async def _lease_loop(self):
+        while True:
+            was_leader = self.is_leader
+            try:
+                leader = await self._acquire()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error renewing maintenance lease: {e}")
+                leader = self.is_leader
+            if leader and not was_leader:
+                print(f"Maintenance leader: {self.worker_id}")
+                await self._load_last_runs()
+                self._wake.set()
+            await asyncio.sleep(MAINTENANCE_LEASE_SECONDS / 3)
+
+    async def _load_last_runs(self):
+        for name in self.jobs:
+            last = await self.db.maintenance_runs.find_one(
+                {"job": name, "ok": True}, {"finished_at": 1}, sort=[("finished_at", DESCENDING)]
+            )
+            if last:
+                self._last_run[name] = last["finished_at"]
+
+    def _due(self) -> List[Job]:
+        now = datetime.utcnow()
+        due = [self.jobs[name] for name in dict.fromkeys(self._requested)]
+        for job in self.jobs.values():
+            last = self._last_run.get(job.name)
+            if job not in due and (last is None or now - last >= timedelta(seconds=job.interval)):
+                due.append(job)
+        return due
+
+    async def _run_job(self, job: Job):
+        stats = self.stats[job.name]
+        run = JobRun(self, job.name)
+        self.current = run
+        stats.runs += 1
+        stats.last_started = datetime.utcnow()
+        result = None
+        error = None
+        try:
+            result = await job.run(self.db, run)
+        except asyncio.CancelledError:
+            raise
+        except LeaseLost:
+            error = "lease lost"
+        except Exception as e:
+            error = str(e)[:500]
+        finally:
+            self.current = None
+
+        stats.last_duration_ms = run.elapsed_ms()
+        stats.last_result = result
+        stats.last_error = error
+        stats.total_processed += run.processed
+        if error:
+            stats.failures += 1
+            print(f"Maintenance job {job.name} failed after {run.elapsed_ms():.0f} ms: {error}")
+        elif result:
+            print(f"Maintenance job {job.name}: {result} done in {run.elapsed_ms():.0f} ms")
+
+        finished = datetime.utcnow()
+        if error is None:
+            self._last_run[job.name] = finished
+        await self.db.maintenance_runs.insert_one({
+            "job": job.name,
+            "worker": self.worker_id,
+            "started_at": stats.last_started,
+            "finished_at": finished,
+            "duration_ms": round(run.elapsed_ms(), 1),
+            "paused_ms": round(run.paused * 1000, 1),
+            "batches": run.batches,
+            "processed": run.processed,
+            "result": result,
+            "ok": error is None,
+            "error": error
+        })
+
+    async def _run_loop(self):
+        while True:
+            if self.is_leader:
+                for job in self._due():
+                    if not self.is_leader:
+                        break
+                    if job.name in self._requested:
+                        self._requested = [name for name in self._requested if name != job.name]
+                    try:
+                        await self._run_job(job)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        print(f"Error recording maintenance job {job.name}: {e}")
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=TICK_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def request_run(self, name: str) -> bool:
+        # Runs the job at the next chance, if this worker is the leader
+        if name not in self.jobs or not self.is_leader:
+            return False
+        self._requested.append(name)
+        self._wake.set()
+        return True
+
+    async def start(self, db):
+        self.db = db
+        await self.ensure_indexes(db)
+        self._tasks = [asyncio.create_task(self._lease_loop()), asyncio.create_task(self._run_loop())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.is_leader:
+            # Hand over now rather than when the lease runs out
+            self._lease_until = 0.0
+            try:
+                await self.db.maintenance_leases.delete_one({"_id": LEASE_NAME, "holder": self.worker_id})
+            except Exception as e:
+                print(f"Error releasing maintenance lease: {e}")
+
+    def snapshot(self) -> dict:
+        current = None
+        if self.current:
+            current = {
+                "job": self.current.name,
+                "elapsed_ms": round(self.current.elapsed_ms(), 1),
+                "batches": self.current.batches,
+                "processed": self.current.processed
+            }
+        return {
+            "worker": self.worker_id,
+            "leader": self.is_leader,
+            "running": current,
+            "jobs": {
+                name: {
+                    "interval_seconds": job.interval,
+                    "last_run": self._last_run[name].isoformat() if name in self._last_run else None,
+                    **self.stats[name].snapshot()
+                }
+                for name, job in self.jobs.items()
+            }
+        }
+
+
+scheduler = Scheduler()
@@ -0,0 +1,64 @@
+from typing import AsyncIterator
+import json
+import zlib
+
+# Incremental encoders for conversation exports. Messages are serialized
+# one line at a time and flushed in chunks of roughly CHUNK_SIZE bytes, so
+# memory use does not depend on the length of the conversation.
+
+CHUNK_SIZE = 64 * 1024
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "gzip": "application/gzip",
+}
+
+
+def export_record(msg: dict) -> dict:
+    record = {
+        "id": str(msg["_id"]),
+        "sender_id": msg["sender_id"],
+        "content": msg["content"],
+        "timestamp": msg["timestamp"].isoformat(),
+        "status": msg.get("status", "sent")
+    }
+    if msg.get("attachments"):
+        record["attachments"] = msg["attachments"]
+    if msg.get("group_id"):
+        record["group_id"] = msg["group_id"]
+    else:
+        record["recipient_id"] = msg.get("recipient_id")
+    return record
+
+
+async def ndjson_chunks(messages: AsyncIterator[dict], chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+    buffer = []
+    size = 0
+    async for msg in messages:
+        line = (dumps(export_record(msg)) + "\n").encode("utf-8")
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # Sync-flush after every chunk so a client can decompress what it has
+    # received so far and resume from the last complete line
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def encode(messages: AsyncIterator[dict], fmt: str) -> AsyncIterator[bytes]:
+    chunks = ndjson_chunks(messages)
+    if fmt == "gzip":
+        return gzip_chunks(chunks)
+    return chunks
@@ -0,0 +1,135 @@
+from bson import ObjectId
+from collections import OrderedDict
+from datetime import datetime
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from typing import Hashable, List, Optional, Tuple
+import time
+
+import search_index
+from storage import get_storage
+
+# Idempotent message writes. Clients tag each message with their own
+# client_message_id; a unique (sender_id, client_message_id) index makes a
+# retried send return the message stored the first time instead of a copy.
+# Recent keys are also kept in memory, so most retries are answered
+# without touching the database at all.
+
+SEEN_TTL_SECONDS = 600
+SEEN_MAX_ENTRIES = 100000
+
+
+class SeenSet:
+    # Keys seen in the last `ttl` seconds, with a value each, oldest first
+    def __init__(self, ttl: float = SEEN_TTL_SECONDS, max_entries: int = SEEN_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._entries:
+            key, (seen_at, _) = next(iter(self._entries.items()))
+            if seen_at > cutoff and len(self._entries) <= self.max_entries:
+                break
+            self._entries.popitem(last=False)
+
+    def get(self, key: Hashable):
+        self._expire()
+        entry = self._entries.get(key)
+        return entry[1] if entry else None
+
+    def add(self, key: Hashable, value=True) -> bool:
+        # Returns False if the key was already there
+        self._expire()
+        if key in self._entries:
+            return False
+        self._entries[key] = (time.monotonic(), value)
+        return True
+
+
+sent_messages = SeenSet()
+
+
+async def ensure_indexes(db):
+    await db.messages.create_index(
+        [("sender_id", ASCENDING), ("client_message_id", ASCENDING)],
+        unique=True,
+        partialFilterExpression={"client_message_id": {"$type": "string"}}
+    )
+
+
+async def store_message(
+    db,
+    sender_id: str,
+    recipient_id: Optional[str],
+    group_id: Optional[str],
+    content: str,
+    client_message_id: Optional[str] = None,
+    attachments: Optional[List[dict]] = None
+) -> Tuple[dict, bool]:
+    # Returns the stored message and whether this call created it
+    key = (sender_id, client_message_id)
+    if client_message_id:
+        original = sent_messages.get(key)
+        if original:
+            return original, False
+
+    message_data = {
+        "sender_id": sender_id,
+        "recipient_id": recipient_id,
+        "group_id": group_id,
+        "content": content,
+        "timestamp": datetime.utcnow(),
+        "status": "sent"
+    }
+    if client_message_id:
+        message_data["client_message_id"] = client_message_id
+    if attachments:
+        message_data["attachments"] = attachments
+
+    try:
+        await db.messages.insert_one(message_data)
+    except DuplicateKeyError:
+        # Sent before, longer ago than the in-memory window or to another worker
+        original = await db.messages.find_one({"sender_id": sender_id, "client_message_id": client_message_id})
+        if original is None:
+            raise
+        sent_messages.add(key, original)
+        return original, False
+
+    if client_message_id:
+        sent_messages.add(key, message_data)
+    await search_index.index_message(db, message_data)
+    return message_data, True
+
+
+async def can_send(sender_id: str, recipient_id: Optional[str], group_id: Optional[str]) -> bool:
+    # Group messages need the sender to be a member; direct ones a recipient
+    # that exists
+    storage = get_storage()
+    if group_id:
+        return await storage.groups.is_member(group_id, sender_id)
+    return await storage.users.get(recipient_id) is not None
+
+
+async def find_sent(
+    db,
+    sender_id: str,
+    message_id: Optional[str],
+    recipient_id: Optional[str],
+    group_id: Optional[str],
+    client_message_id: Optional[str] = None
+) -> Optional[dict]:
+    # The stored message with this id, if the sender sent it to this
+    # conversation; None for ids that don't name such a message
+    if not message_id or not ObjectId.is_valid(message_id):
+        return None
+    message = sent_messages.get((sender_id, client_message_id)) if client_message_id else None
+    if message is None or str(message["_id"]) != message_id:
+        message = await db.messages.find_one({"_id": ObjectId(message_id), "sender_id": sender_id})
+    if message is None or message.get("group_id") != group_id:
+        return None
+    if not group_id and message.get("recipient_id") != recipient_id:
+        return None
+    return message
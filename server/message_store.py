@@ -0,0 +1,306 @@
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from bson import Binary, ObjectId
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+import json
+import os
+import zlib
+
+# Messages are written to db.messages (the hot tier). When bucketing is
+# enabled, a compaction job of the maintenance scheduler packs messages
+# older than a threshold into per-conversation time buckets in
+# db.message_buckets (the cold tier).
+# Each bucket stores its messages column by column and zlib-compressed, so
+# per-message field names and the repeated conversation ids disappear.
+# Reads always consult both tiers, whether or not compaction is running.
+
+BUCKETING_ENABLED = os.getenv("MESSAGE_BUCKETING", "false").lower() in ("1", "true", "yes")
+COMPACT_AFTER = timedelta(days=float(os.getenv("MESSAGE_COMPACT_AFTER_DAYS", "30")))
+BUCKET_SPAN = timedelta(hours=float(os.getenv("MESSAGE_BUCKET_SPAN_HOURS", "24")))
+COMPACT_INTERVAL_SECONDS = float(os.getenv("MESSAGE_COMPACT_INTERVAL_SECONDS", "3600"))
+# Hot messages read per query when exporting a conversation
+EXPORT_PAGE_SIZE = 1000
+COMPACT_BATCH_SIZE = 5000
+
+STATUSES = ["sent", "delivered", "read"]
+
+
+async def ensure_indexes(db):
+    await db.messages.create_index([("sender_id", ASCENDING), ("recipient_id", ASCENDING), ("timestamp", DESCENDING)])
+    await db.messages.create_index([("group_id", ASCENDING), ("timestamp", DESCENDING)])
+    await db.messages.create_index([("timestamp", ASCENDING)])
+    await db.messages.create_index([("sender_id", ASCENDING), ("recipient_id", ASCENDING), ("_id", ASCENDING)])
+    await db.messages.create_index([("group_id", ASCENDING), ("_id", ASCENDING)])
+    await db.message_buckets.create_index([("conversation", ASCENDING), ("last_id", DESCENDING)])
+    # Retention drops whole buckets once their newest message is old enough
+    await db.message_buckets.create_index([("end", ASCENDING)])
+
+
+def conversation_key(message: dict) -> str:
+    if message.get("group_id"):
+        return f"g:{message['group_id']}"
+    return "dm:" + ":".join(sorted([message["sender_id"], message["recipient_id"]]))
+
+
+def direct_conversation_key(user_a: str, user_b: str) -> str:
+    return "dm:" + ":".join(sorted([user_a, user_b]))
+
+
+def group_conversation_key(group_id: str) -> str:
+    return f"g:{group_id}"
+
+
+def _bucket_start(timestamp: datetime) -> datetime:
+    span = int(BUCKET_SPAN.total_seconds())
+    epoch = int((timestamp - datetime(1970, 1, 1)).total_seconds())
+    return datetime(1970, 1, 1) + timedelta(seconds=epoch - epoch % span)
+
+
+def pack_bucket(key: str, messages: List[dict]) -> dict:
+    messages = sorted(messages, key=lambda m: m["_id"])
+    start = messages[0]["timestamp"]
+
+    senders: List[str] = []
+    sender_index: Dict[str, int] = {}
+    columns = {"id": [], "sender": [], "ts": [], "content": [], "status": []}
+    for msg in messages:
+        if msg["sender_id"] not in sender_index:
+            sender_index[msg["sender_id"]] = len(senders)
+            senders.append(msg["sender_id"])
+        columns["id"].append(str(msg["_id"]))
+        columns["sender"].append(sender_index[msg["sender_id"]])
+        columns["ts"].append(int((msg["timestamp"] - start).total_seconds() * 1000))
+        columns["content"].append(msg["content"])
+        status = msg.get("status", "sent")
+        columns["status"].append(STATUSES.index(status) if status in STATUSES else 0)
+    columns["senders"] = senders
+    if any(msg.get("attachments") for msg in messages):
+        columns["attachments"] = [msg.get("attachments") for msg in messages]
+
+    return {
+        "_id": messages[0]["_id"],
+        "conversation": key,
+        "first_id": messages[0]["_id"],
+        "last_id": messages[-1]["_id"],
+        "start": start,
+        "end": messages[-1]["timestamp"],
+        "count": len(messages),
+        "data": Binary(zlib.compress(json.dumps(columns, separators=(",", ":")).encode("utf-8")))
+    }
+
+
+def unpack_bucket(bucket: dict) -> List[dict]:
+    columns = json.loads(zlib.decompress(bucket["data"]))
+    key = bucket["conversation"]
+    group_id = key[2:] if key.startswith("g:") else None
+    participants = key[3:].split(":") if group_id is None else []
+
+    attachments = columns.get("attachments")
+    messages = []
+    for i, message_id in enumerate(columns["id"]):
+        sender_id = columns["senders"][columns["sender"][i]]
+        if group_id is None:
+            recipient_id = participants[1] if participants[0] == sender_id else participants[0]
+        else:
+            recipient_id = None
+        messages.append({
+            "_id": ObjectId(message_id),
+            "sender_id": sender_id,
+            "recipient_id": recipient_id,
+            "group_id": group_id,
+            "content": columns["content"][i],
+            "timestamp": bucket["start"] + timedelta(milliseconds=columns["ts"][i]),
+            "status": STATUSES[columns["status"][i]]
+        })
+        if attachments and attachments[i]:
+            messages[-1]["attachments"] = attachments[i]
+    return messages
+
+
+async def _read_cold(db, key: str, before: Optional[ObjectId], limit: int) -> List[dict]:
+    query = {"conversation": key}
+    if before is not None:
+        query["first_id"] = {"$lt": before}
+
+    result = []
+    async for bucket in db.message_buckets.find(query).sort("last_id", DESCENDING):
+        for msg in reversed(unpack_bucket(bucket)):
+            if before is None or msg["_id"] < before:
+                result.append(msg)
+                if len(result) == limit:
+                    return result
+    return result
+
+
+async def fetch_history(db, key: str, query: dict, limit: int, before: Optional[str] = None) -> List[dict]:
+    # Returns up to `limit` messages, newest first, spanning both tiers.
+    # Everything in the cold tier is older than the hot tier, so buckets are
+    # only read once the hot tier runs out.
+    before_id = None
+    if before:
+        try:
+            before_id = ObjectId(before)
+            query = {**query, "_id": {"$lt": before_id}}
+        except:
+            pass
+
+    # _id breaks ties between messages sent in the same millisecond
+    messages = await db.messages.find(query).sort([("timestamp", -1), ("_id", -1)]).limit(limit).to_list(limit)
+    if len(messages) < limit:
+        messages += await _read_cold(db, key, before_id, limit - len(messages))
+    return messages
+
+
+async def _buckets_after(db, key: str, after: Optional[ObjectId]) -> AsyncIterator[dict]:
+    # Buckets holding messages newer than `after`, oldest first
+    query = {"conversation": key}
+    if after is not None:
+        query["last_id"] = {"$gt": after}
+    async for bucket in db.message_buckets.find(query).sort("first_id", ASCENDING):
+        yield bucket
+
+
+async def iter_conversation(db, key: str, query: dict, after: Optional[ObjectId] = None) -> AsyncIterator[dict]:
+    # Yields every message of a conversation oldest first, one bucket or one
+    # page of EXPORT_PAGE_SIZE at a time. Both tiers are filtered on _id so
+    # a walk resumed after `after` stays correct if compaction ran in between.
+    last = after
+    async for bucket in _buckets_after(db, key, after):
+        for msg in unpack_bucket(bucket):
+            if last is None or msg["_id"] > last:
+                yield msg
+                last = msg["_id"]
+
+    # The compactor can move hot messages into buckets while this walks, so
+    # each hot page is followed by a look for buckets ending past the last
+    # message yielded. Buckets are written before their messages are
+    # deleted, so a message moved around the page read is found in one
+    # tier or the other.
+    while True:
+        hot_query = query if last is None else {**query, "_id": {"$gt": last}}
+        page = await db.messages.find(hot_query).sort("_id", ASCENDING).limit(EXPORT_PAGE_SIZE).to_list(EXPORT_PAGE_SIZE)
+        found = {msg["_id"]: msg for msg in page}
+        async for bucket in _buckets_after(db, key, last):
+            for msg in unpack_bucket(bucket):
+                if last is None or msg["_id"] > last:
+                    found.setdefault(msg["_id"], msg)
+
+        full = len(page) == EXPORT_PAGE_SIZE
+        for message_id in sorted(found):
+            # Past a full page, more hot messages may come first
+            if full and message_id > page[-1]["_id"]:
+                break
+            yield found[message_id]
+            last = message_id
+        if not full:
+            break
+
+
+async def fetch_by_ids(db, refs: List[Tuple[str, ObjectId]]) -> Dict[ObjectId, dict]:
+    # Looks up (conversation key, message id) pairs in the hot tier first and
+    # falls back to the bucket covering each remaining id
+    found = {}
+    async for msg in db.messages.find({"_id": {"$in": [message_id for _, message_id in refs]}}):
+        found[msg["_id"]] = msg
+
+    unpacked = {}
+    for key, message_id in refs:
+        if message_id in found:
+            continue
+        bucket = await db.message_buckets.find_one({
+            "conversation": key,
+            "first_id": {"$lte": message_id},
+            "last_id": {"$gte": message_id}
+        }, {"_id": 1})
+        if not bucket:
+            continue
+        if bucket["_id"] not in unpacked:
+            full = await db.message_buckets.find_one({"_id": bucket["_id"]})
+            unpacked[bucket["_id"]] = {m["_id"]: m for m in unpack_bucket(full)}
+        if message_id in unpacked[bucket["_id"]]:
+            found[message_id] = unpacked[bucket["_id"]][message_id]
+    return found
+
+
+async def compact_once(
+    db,
+    older_than: timedelta = COMPACT_AFTER,
+    batch_size: int = COMPACT_BATCH_SIZE,
+    after_batch: Optional[Callable[[int], Awaitable[None]]] = None
+) -> int:
+    # after_batch is awaited with the size of every batch moved, which is
+    # where the maintenance scheduler paces the run
+    cutoff = datetime.utcnow() - older_than
+    moved = 0
+
+    while True:
+        batch = await db.messages.find({"timestamp": {"$lt": cutoff}}).sort("_id", ASCENDING).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        buckets = defaultdict(list)
+        for msg in batch:
+            buckets[(conversation_key(msg), _bucket_start(msg["timestamp"]))].append(msg)
+
+        for (key, _), msgs in buckets.items():
+            bucket = pack_bucket(key, msgs)
+            try:
+                await db.message_buckets.insert_one(bucket)
+            except DuplicateKeyError:
+                # A run died between writing this bucket and deleting its
+                # messages; merge so nothing it missed gets dropped
+                existing = await db.message_buckets.find_one({"_id": bucket["_id"]})
+                merged = {m["_id"]: m for m in unpack_bucket(existing)}
+                merged.update((m["_id"], m) for m in msgs)
+                await db.message_buckets.replace_one(
+                    {"_id": bucket["_id"]}, pack_bucket(key, list(merged.values()))
+                )
+            await db.messages.delete_many({"_id": {"$in": [m["_id"] for m in msgs]}})
+
+        moved += len(batch)
+        if after_batch:
+            await after_batch(len(batch))
+        if len(batch) < batch_size:
+            break
+
+    return moved
+
+
+async def expire_before(
+    db,
+    cutoff: datetime,
+    batch_size: int,
+    after_batch: Optional[Callable[[int], Awaitable[None]]] = None
+) -> int:
+    # Deletes messages sent before cutoff from both tiers, batch by batch.
+    # A cold bucket goes once all of its messages are past the cutoff.
+    deleted = 0
+    while True:
+        batch = await db.messages.find(
+            {"timestamp": {"$lt": cutoff}}, {"_id": 1}
+        ).sort("timestamp", ASCENDING).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        await db.messages.delete_many({"_id": {"$in": [msg["_id"] for msg in batch]}})
+        deleted += len(batch)
+        if after_batch:
+            await after_batch(len(batch))
+        if len(batch) < batch_size:
+            break
+
+    while True:
+        buckets = await db.message_buckets.find(
+            {"end": {"$lt": cutoff}}, {"count": 1}
+        ).sort("end", ASCENDING).limit(batch_size).to_list(batch_size)
+        if not buckets:
+            break
+        await db.message_buckets.delete_many({"_id": {"$in": [bucket["_id"] for bucket in buckets]}})
+        deleted += sum(bucket["count"] for bucket in buckets)
+        if after_batch:
+            await after_batch(len(buckets))
+        if len(buckets) < batch_size:
+            break
+
+    return deleted
@@ -2,6 +2,7 @@ from pydantic import BaseModel, EmailStr, Field
 from typing import Optional, List
 from datetime import datetime
 from bson import ObjectId
+from frames import MAX_CONTENT_LENGTH
 
 class PyObjectId(ObjectId):
     @classmethod
@@ -63,13 +64,17 @@ class Message(BaseModel):
 class MessageCreate(BaseModel):
     recipient_id: Optional[str] = None
     group_id: Optional[str] = None
-    content: str
+    content: str = Field("", max_length=MAX_CONTENT_LENGTH)
+    # Chosen by the client; resending with the same id returns the original
+    client_message_id: Optional[str] = Field(None, min_length=1, max_length=64)
+    # Uploaded through /api/attachments first
+    attachment_ids: List[str] = Field(default_factory=list)
 
 class Group(BaseModel):
     id: Optional[str] = Field(alias="_id")
     name: str
     created_by: str
-    members: List[str] = []
+    member_count: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
     
     class Config:
@@ -79,3 +84,14 @@ class Group(BaseModel):
 class GroupCreate(BaseModel):
     name: str = Field(..., min_length=1, max_length=50)
     members: List[str] = []
+
+# Bodies of the batch endpoints; each is handled with a fixed number of
+# database operations however many ids it carries
+class UserBatch(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=100)
+
+class MemberBatch(BaseModel):
+    user_ids: List[str] = Field(..., min_length=1, max_length=500)
+
+class FriendRequestBatch(BaseModel):
+    request_ids: List[str] = Field(..., min_length=1, max_length=100)
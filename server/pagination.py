@@ -0,0 +1,67 @@
+from fastapi import HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from bson import ObjectId
+from bson.errors import InvalidId
+from typing import AsyncIterator, List, Optional
+import base64
+import binascii
+import json
+
+# Opaque cursors for keyset pagination over ObjectId-ordered collections,
+# plus helpers for streaming results as newline-delimited JSON
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def encode_cursor(last_id: ObjectId) -> str:
+    return base64.urlsafe_b64encode(last_id.binary).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[ObjectId]:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return ObjectId(raw)
+    except (binascii.Error, InvalidId, TypeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
+def page_size(limit: Optional[int]) -> int:
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="limit must be at least 1"
+        )
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def wants_ndjson(request: Request, stream: bool) -> bool:
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+async def batched(cursor, size: int) -> AsyncIterator[List[dict]]:
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _ndjson_lines(items: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    async for item in items:
+        yield (json.dumps(item, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def ndjson_response(items: AsyncIterator[dict]) -> StreamingResponse:
+    return StreamingResponse(_ndjson_lines(items), media_type=NDJSON_MEDIA_TYPE)
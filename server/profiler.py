@@ -0,0 +1,152 @@
+from collections import Counter
+from typing import Awaitable, Callable, Dict, Tuple, Union
+import os
+import random
+import sys
+import threading
+import time
+
+# Opt-in sampling profiler. A fraction of HTTP requests and WebSocket frame
+# handlers (PROFILE_SAMPLE_RATE, 0 = off) run under `profiler.run`, which
+# marks its own stack frame. While any are in flight, a background thread
+# reads the event loop thread's stack every PROFILE_INTERVAL_MS and, when
+# the running code is inside a marked frame, counts the stack below it.
+# Time spent awaiting I/O isn't counted, so the result shows where CPU goes.
+#
+# GET /api/admin/profile returns the counts as folded stacks, one
+# "root;caller;callee count" line each, which flamegraph.pl and speedscope
+# read directly.
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# Distinct stacks kept before new ones are counted as truncated
+MAX_STACKS = 20000
+
+Label = Union[str, Callable[[], str]]
+
+
+def _frame_name(code) -> str:
+    # co_qualname (Class.method) is new in Python 3.11
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profiler:
+    def __init__(self, sample_rate: float = PROFILE_SAMPLE_RATE, interval_ms: float = PROFILE_INTERVAL_MS):
+        self.sample_rate = sample_rate
+        self.interval_ms = interval_ms
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.profiled = 0
+        # Marked frame -> (thread it runs on, root label)
+        self._active: Dict[object, Tuple[int, Label]] = {}
+        self._names: Dict[object, str] = {}
+        self._thread = None
+
+    def should_sample(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def configure(self, sample_rate: float, interval_ms: float):
+        self.sample_rate = sample_rate
+        self.interval_ms = interval_ms
+
+    async def run(self, label: Label, awaitable: Awaitable):
+        # Everything `awaitable` runs is sampled under `label`; a callable
+        # label is only evaluated when a sample is taken
+        frame = sys._getframe()
+        self._active[frame] = (threading.get_ident(), label)
+        self.profiled += 1
+        self._start()
+        try:
+            return await awaitable
+        finally:
+            del self._active[frame]
+
+    async def maybe_run(self, label: Label, awaitable: Awaitable):
+        if self.should_sample():
+            return await self.run(label, awaitable)
+        return await awaitable
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._sampler, name="profiler", daemon=True)
+            self._thread.start()
+
+    def _sampler(self):
+        # Exits once profiling is switched off; the next sampled run restarts it
+        while self.sample_rate > 0 or self._active:
+            time.sleep(self.interval_ms / 1000)
+            if not self._active:
+                continue
+            current = sys._current_frames()
+            for thread_id in {thread_id for thread_id, _ in list(self._active.values())}:
+                frame = current.get(thread_id)
+                if frame is not None:
+                    self._record(frame)
+
+    def _record(self, frame):
+        stack = []
+        while frame is not None:
+            marked = self._active.get(frame)
+            if marked is not None:
+                break
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        else:
+            # The loop is between tasks or running something unsampled
+            return
+
+        label = marked[1]
+        names = [label() if callable(label) else label]
+        for code in reversed(stack):
+            name = self._names.get(code)
+            if name is None:
+                name = self._names[code] = _frame_name(code)
+            names.append(name)
+
+        key = ";".join(names)
+        if key not in self.stacks and len(self.stacks) >= MAX_STACKS:
+            key = f"{names[0]};[truncated]"
+        self.stacks[key] += 1
+        self.samples += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def reset(self):
+        self.stacks.clear()
+        self.samples = 0
+        self.profiled = 0
+
+    def stats(self) -> dict:
+        return {
+            "sample_rate": self.sample_rate,
+            "interval_ms": self.interval_ms,
+            "profiled": self.profiled,
+            "samples": self.samples,
+            "stacks": len(self.stacks)
+        }
+
+
+profiler = Profiler()
+
+
+def _http_label(scope) -> str:
+    # Path parameters are put back as placeholders once routing has matched,
+    # so /api/users/{user_id} is one root rather than one per user
+    path = scope["path"]
+    for name, value in scope.get("path_params", {}).items():
+        path = path.replace(f"/{value}", f"/{{{name}}}", 1)
+    return f"{scope['method']} {path}"
+
+
+class ProfilerMiddleware:
+    # Plain ASGI middleware, so the endpoint runs in the same task and its
+    # frames sit under the marked one
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiler.should_sample():
+            return await self.app(scope, receive, send)
+        await profiler.run(lambda: _http_label(scope), self.app(scope, receive, send))
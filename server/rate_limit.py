@@ -0,0 +1,209 @@
+from fastapi import HTTPException, Request, status
+from collections import Counter, OrderedDict
+from datetime import datetime
+from pymongo import ReturnDocument
+from typing import Dict, NamedTuple, Optional, Tuple
+import math
+import os
+import time
+
+from auth_utils import decode_token
+from database import ensure_ttl_index, get_database
+
+# Token-bucket rate limiting keyed by (user, route or WebSocket frame type).
+# Each bucket holds up to `burst` tokens and refills at `rate` tokens per
+# second; a request spends one token and is throttled when none are left.
+#
+# RATE_LIMIT_BACKEND=memory keeps buckets in this process. With several
+# workers, RATE_LIMIT_BACKEND=mongo shares them through the rate_limits
+# collection so a client can't multiply its allowance across workers.
+# Policies can be overridden with RATE_LIMITS, e.g. "signin=5/0.1,ws:message=30/10".
+#
+# Anonymous requests are limited per client address. Behind reverse proxies,
+# set TRUSTED_PROXY_COUNT to how many of them append to X-Forwarded-For so
+# the address comes from that header rather than the nearest proxy; entries
+# further left than that can be forged by the client and are ignored.
+
+
+class Policy(NamedTuple):
+    burst: float
+    rate: float
+
+
+DEFAULT_POLICY = Policy(60, 20)
+
+POLICIES: Dict[str, Policy] = {
+    # REST routes
+    "signin": Policy(5, 0.1),
+    "signup": Policy(3, 0.05),
+    "search_users": Policy(10, 2),
+    "search_messages": Policy(10, 2),
+    "send_message": Policy(20, 5),
+    "friend_request": Policy(10, 0.5),
+    "upload_attachment": Policy(10, 0.5),
+    # WebSocket frames
+    "ws:message": Policy(20, 5),
+    "ws:typing": Policy(10, 3),
+    "ws:status": Policy(60, 20),
+    "ws:offer": Policy(5, 1),
+    "ws:answer": Policy(5, 1),
+    "ws:ice-candidate": Policy(100, 50),
+    "ws:call-end": Policy(5, 1),
+    "ws:invalid": Policy(10, 1),
+}
+
+
+def _parse_policies(value: str) -> Dict[str, Policy]:
+    policies = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        try:
+            name, spec = item.split("=", 1)
+            burst, rate = spec.split("/", 1)
+            policies[name.strip()] = Policy(float(burst), float(rate))
+        except ValueError:
+            print(f"Ignoring invalid rate limit policy: {item}")
+    return policies
+
+
+POLICIES.update(_parse_policies(os.getenv("RATE_LIMITS", "")))
+
+
+class MemoryBackend:
+    def __init__(self, max_buckets: int = 100000):
+        self.max_buckets = max_buckets
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take(self, key: str, policy: Policy, cost: float = 1) -> Tuple[bool, float]:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (policy.burst, now))
+        tokens = min(policy.burst, tokens + (now - updated) * policy.rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return allowed, tokens
+
+
+class MongoBackend:
+    # One document per bucket, refilled and spent in a single pipeline
+    # update so concurrent workers never race on the token count
+    EXPIRE_SECONDS = 3600
+
+    async def take(self, key: str, policy: Policy, cost: float = 1) -> Tuple[bool, float]:
+        now = datetime.utcnow()
+        elapsed_ms = {"$subtract": [now, {"$ifNull": ["$updated", now]}]}
+        doc = await get_database().rate_limits.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [
+                        policy.burst,
+                        {"$add": [
+                            {"$ifNull": ["$tokens", policy.burst]},
+                            {"$multiply": [elapsed_ms, policy.rate / 1000]}
+                        ]}
+                    ]},
+                    "updated": now
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]}}}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return doc["allowed"], doc["tokens"]
+
+
+class RateLimiter:
+    def __init__(self, backend):
+        self.backend = backend
+        self.allowed: Counter = Counter()
+        self.throttled: Counter = Counter()
+
+    def policy(self, name: str) -> Policy:
+        return POLICIES.get(name, DEFAULT_POLICY)
+
+    def set_policy(self, name: str, policy: Policy):
+        # Takes effect on the next request; existing buckets keep their tokens
+        POLICIES[name] = policy
+
+    async def check(self, subject: str, name: str) -> Optional[float]:
+        # Returns None when allowed, otherwise seconds until a token is back
+        policy = self.policy(name)
+        allowed, tokens = await self.backend.take(f"{name}:{subject}", policy)
+        if allowed:
+            self.allowed[name] += 1
+            return None
+        self.throttled[name] += 1
+        if policy.rate <= 0:
+            return float("inf")
+        return (1 - tokens) / policy.rate
+
+    def stats(self) -> dict:
+        names = sorted(set(POLICIES) | set(self.allowed) | set(self.throttled))
+        return {
+            "backend": type(self.backend).__name__,
+            "limits": {
+                name: {
+                    "burst": self.policy(name).burst,
+                    "rate": self.policy(name).rate,
+                    "allowed": self.allowed[name],
+                    "throttled": self.throttled[name]
+                }
+                for name in names
+            }
+        }
+
+
+BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+limiter = RateLimiter(MongoBackend() if BACKEND == "mongo" else MemoryBackend())
+
+
+async def ensure_indexes(db):
+    if isinstance(limiter.backend, MongoBackend):
+        # Idle buckets are full again long before they expire
+        await ensure_ttl_index(db.rate_limits, "updated", MongoBackend.EXPIRE_SECONDS)
+
+
+def _subject(request: Request) -> str:
+    # Signed-in callers are limited per user, everyone else per address
+    header = request.headers.get("authorization", "")
+    if header.lower().startswith("bearer "):
+        try:
+            user_id = decode_token(header[7:]).get("sub")
+            if user_id:
+                return user_id
+        except Exception:
+            pass
+    return "ip:" + client_address(request)
+
+
+def client_address(request: Request) -> str:
+    # The address the outermost trusted proxy saw, when there are any
+    if TRUSTED_PROXY_COUNT > 0:
+        hops = [
+            hop.strip()
+            for header in request.headers.getlist("x-forwarded-for")
+            for hop in header.split(",")
+            if hop.strip()
+        ]
+        if hops:
+            return hops[max(0, len(hops) - TRUSTED_PROXY_COUNT)]
+    return request.client.host if request.client else "unknown"
+
+
+def rate_limit(name: str):
+    async def dependency(request: Request):
+        retry_after = await limiter.check(_subject(request), name)
+        if retry_after is not None:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests",
+                headers={"Retry-After": str(max(1, math.ceil(min(retry_after, 3600))))}
+            )
+    return dependency
@@ -0,0 +1,54 @@
+from bisect import bisect_left
+from bson import ObjectId
+from typing import Dict, List
+
+# Group read receipts as per-member watermarks. Each group has a single
+# document mapping member ids to the id of the newest message they have
+# read:
+#
+#   {_id: group_id, reads: {user_id: ObjectId, ...}}
+#
+# Marking a message read is one $max update, which never moves a watermark
+# backwards. Since message ids grow over time, a member has read message X
+# exactly when their watermark is >= X, so "seen by" counts and reader lists
+# come from the one document without any per-message writes.
+
+
+async def mark_read(db, group_id: str, user_id: str, message_id: ObjectId):
+    await db.group_reads.update_one(
+        {"_id": group_id},
+        {"$max": {f"reads.{user_id}": message_id}},
+        upsert=True
+    )
+
+
+async def watermarks(db, group_id: str) -> Dict[str, ObjectId]:
+    doc = await db.group_reads.find_one({"_id": group_id})
+    return doc.get("reads", {}) if doc else {}
+
+
+async def forget_members(db, group_id: str, user_ids: List[str]):
+    await db.group_reads.update_one(
+        {"_id": group_id},
+        {"$unset": {f"reads.{user_id}": "" for user_id in user_ids}}
+    )
+
+
+def readers(reads: Dict[str, ObjectId], message_id: ObjectId, sender_id: str = None) -> List[str]:
+    return [user_id for user_id, last_read in reads.items() if last_read >= message_id and user_id != sender_id]
+
+
+class SeenCounter:
+    # Answers "seen by N" for many messages of one group with one sort of
+    # the watermarks and a binary search per message
+    def __init__(self, reads: Dict[str, ObjectId]):
+        self.reads = reads
+        self.sorted = sorted(reads.values())
+
+    def seen_by(self, message_id: ObjectId, sender_id: str) -> int:
+        count = len(self.sorted) - bisect_left(self.sorted, message_id)
+        # The sender's own watermark doesn't count as seeing their message
+        sender_read = self.reads.get(sender_id)
+        if sender_read is not None and sender_read >= message_id:
+            count -= 1
+        return count
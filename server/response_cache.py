@@ -0,0 +1,125 @@
+from fastapi import Request, Response
+from collections import OrderedDict
+from pymongo import UpdateOne
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+import hashlib
+import json
+
+from database import get_database
+
+# Per-user cache of rendered list responses (friends, groups).
+# Each (scope, user_id) pair has a version counter in the cache_versions
+# collection, which mutating routes bump. The ETag is derived from the
+# version rather than the body, so every worker agrees on it: a client
+# holding the current ETag gets 304 without anything being rebuilt, and a
+# worker only serves its local copy of a body while the shared version is
+# still the one it was built at.
+#
+# A groups listing has no counter of its own. Its version is made of the
+# user's group ids and each group's GROUP counter, so a change to a group
+# bumps one counter however many members it has, and joining or leaving
+# changes the version without bumping anything.
+
+FRIENDS = "friends"
+GROUPS = "groups"
+GROUP = "group"
+
+
+class CachedResponse:
+    __slots__ = ("etag", "body")
+
+    def __init__(self, etag: str, body: bytes):
+        self.etag = etag
+        self.body = body
+
+
+def etag_for(scope: str, user_id: str, version: str) -> str:
+    digest = hashlib.sha256(f"{scope}:{user_id}:{version}".encode("utf-8")).hexdigest()
+    return '"' + digest[:32] + '"'
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], CachedResponse]" = OrderedDict()
+
+    async def versions(self, scope: str, ids: List[str]) -> Dict[str, int]:
+        # Shared version of each id in the scope; never bumped counts as 0
+        found = {}
+        if ids:
+            async for doc in get_database().cache_versions.find(
+                {"_id": {"$in": [f"{scope}:{id_}" for id_ in ids]}}
+            ):
+                found[doc["_id"].split(":", 1)[1]] = doc["v"]
+        return {id_: found.get(id_, 0) for id_ in ids}
+
+    def get(self, scope: str, user_id: str, etag: str) -> Optional[CachedResponse]:
+        key = (scope, user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.etag != etag:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, scope: str, user_id: str, etag: str, payload) -> CachedResponse:
+        # A body built while a write bumped the version is stored under the
+        # old ETag, so the next request simply rebuilds it
+        body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        entry = CachedResponse(etag, body)
+        key = (scope, user_id)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    async def invalidate(self, scope: str, ids: Iterable[str]):
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return
+        await get_database().cache_versions.bulk_write(
+            [UpdateOne({"_id": f"{scope}:{id_}"}, {"$inc": {"v": 1}}, upsert=True) for id_ in ids],
+            ordered=False
+        )
+        for id_ in ids:
+            self._entries.pop((scope, id_), None)
+
+
+response_cache = ResponseCache()
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in [tag.strip() for tag in header.split(",")]
+
+
+def _headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+async def cached_json_response(
+    request: Request,
+    scope: str,
+    user_id: str,
+    build: Callable[[], Awaitable[object]],
+    version: Optional[str] = None,
+) -> Response:
+    # version stands for everything the body is built from; by default the
+    # user's own counter in the scope
+    if version is None:
+        version = str((await response_cache.versions(scope, [user_id]))[user_id])
+    etag = etag_for(scope, user_id, version)
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=_headers(etag))
+
+    entry = response_cache.get(scope, user_id, etag)
+    if entry is None:
+        entry = response_cache.put(scope, user_id, etag, await build())
+    return Response(content=entry.body, media_type="application/json", headers=_headers(etag))
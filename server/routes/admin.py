@@ -0,0 +1,97 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
+from routes.users import get_current_user
+from rate_limit import Policy, limiter
+from profiler import profiler
+from loop_monitor import loop_monitor
+from maintenance import scheduler
+from database import get_database
+import os
+
+router = APIRouter()
+
+# Comma separated user ids allowed to use the admin endpoints
+ADMIN_USER_IDS = {user_id.strip() for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
+
+class PolicyUpdate(BaseModel):
+    burst: float = Field(gt=0)
+    rate: float = Field(ge=0)
+
+
+class ProfilerSettings(BaseModel):
+    sample_rate: float = Field(ge=0, le=1)
+    interval_ms: float = Field(default=5, ge=1, le=1000)
+
+
+async def get_admin_user(current_user: str = Depends(get_current_user)):
+    if current_user not in ADMIN_USER_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+    return current_user
+
+@router.get("/rate-limits")
+async def get_rate_limits(admin: str = Depends(get_admin_user)):
+    return limiter.stats()
+
+@router.put("/rate-limits/{name}")
+async def update_rate_limit(name: str, update: PolicyUpdate, admin: str = Depends(get_admin_user)):
+    limiter.set_policy(name, Policy(update.burst, update.rate))
+    return {"name": name, "burst": update.burst, "rate": update.rate}
+
+@router.get("/profile", response_class=PlainTextResponse)
+async def get_profile(reset: bool = False, admin: str = Depends(get_admin_user)):
+    # Folded stacks for flamegraph.pl or speedscope
+    folded, samples = profiler.folded(), profiler.samples
+    if reset:
+        profiler.reset()
+    return PlainTextResponse(folded, headers={"X-Profile-Samples": str(samples)})
+
+@router.get("/profile/stats")
+async def get_profile_stats(admin: str = Depends(get_admin_user)):
+    return profiler.stats()
+
+@router.put("/profile")
+async def update_profile(settings: ProfilerSettings, admin: str = Depends(get_admin_user)):
+    # Switches sampling on or off on this worker
+    profiler.configure(settings.sample_rate, settings.interval_ms)
+    return profiler.stats()
+
+@router.delete("/profile")
+async def reset_profile(admin: str = Depends(get_admin_user)):
+    profiler.reset()
+    return profiler.stats()
+
+@router.get("/loop-lag")
+async def get_loop_lag(reset: bool = False, admin: str = Depends(get_admin_user)):
+    # Event loop lag histogram and the last blocking stack caught
+    stats = loop_monitor.stats()
+    if reset:
+        loop_monitor.reset()
+    return stats
+
+@router.get("/maintenance")
+async def get_maintenance(admin: str = Depends(get_admin_user)):
+    # This worker's view of the scheduler plus the latest runs by any worker
+    db = get_database()
+    lease = await db.maintenance_leases.find_one({"_id": "maintenance"})
+    runs = await db.maintenance_runs.find({}, {"_id": 0}).sort("finished_at", -1).limit(20).to_list(20)
+    return {
+        **scheduler.snapshot(),
+        "lease": {"holder": lease["holder"], "expires": lease["expires"].isoformat()} if lease else None,
+        "recent_runs": runs
+    }
+
+@router.post("/maintenance/{job}/run", status_code=status.HTTP_202_ACCEPTED)
+async def run_maintenance_job(job: str, admin: str = Depends(get_admin_user)):
+    if job not in scheduler.jobs:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown maintenance job")
+    if not scheduler.request_run(job):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="This worker is not the maintenance leader"
+        )
+    return {"message": f"{job} queued"}
@@ -0,0 +1,87 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import FileResponse
+from typing import Optional
+from database import get_database
+from routes.users import get_current_user
+from rate_limit import rate_limit
+import os
+import attachment_store
+
+router = APIRouter()
+
+
+@router.post("/", dependencies=[Depends(rate_limit("upload_attachment"))])
+async def upload_attachment(
+    request: Request,
+    filename: Optional[str] = None,
+    current_user: str = Depends(get_current_user)
+):
+    # The request body is the file itself, streamed to disk as it arrives;
+    # its Content-Type header becomes the attachment's type
+    db = get_database()
+
+    declared_size = request.headers.get("content-length")
+    try:
+        doc = await attachment_store.save_upload(
+            db,
+            current_user,
+            request.stream(),
+            filename,
+            request.headers.get("content-type"),
+            int(declared_size) if declared_size and declared_size.isdigit() else None
+        )
+    except (attachment_store.AttachmentTooLarge, attachment_store.QuotaExceeded) as e:
+        raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=str(e))
+    except attachment_store.InvalidAttachment as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    return attachment_store.attachment_ref(doc)
+
+
+@router.get("/usage")
+async def get_usage(current_user: str = Depends(get_current_user)):
+    db = get_database()
+
+    return {
+        "used": await attachment_store.usage(db, current_user),
+        "quota": attachment_store.ATTACHMENT_QUOTA_BYTES,
+        "max_attachment_bytes": attachment_store.MAX_ATTACHMENT_BYTES
+    }
+
+
+@router.get("/{attachment_id}")
+async def download_attachment(attachment_id: str, current_user: str = Depends(get_current_user)):
+    # FileResponse answers Range requests (206, multipart for several
+    # ranges) and hands whole files to the server with pathsend when it
+    # supports that, so the bytes never pass through Python
+    db = get_database()
+
+    doc = await attachment_store.get(db, attachment_id)
+    if not doc or not await attachment_store.can_read(db, doc, current_user):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attachment not found")
+
+    path = attachment_store.path_for(doc)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attachment not found")
+
+    return FileResponse(
+        path,
+        media_type=doc["content_type"],
+        filename=doc["filename"],
+        content_disposition_type="inline" if attachment_store.inline(doc) else "attachment",
+        headers={
+            # The content behind an id never changes
+            "Cache-Control": "private, max-age=31536000, immutable",
+            "X-Content-Type-Options": "nosniff"
+        }
+    )
+
+
+@router.delete("/{attachment_id}")
+async def delete_attachment(attachment_id: str, current_user: str = Depends(get_current_user)):
+    db = get_database()
+
+    if not await attachment_store.delete(db, current_user, attachment_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attachment not found")
+
+    return {"message": "Attachment deleted"}
@@ -1,14 +1,15 @@
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status
 from models import UserCreate, UserLogin, Token, User
-from database import get_database
+from storage import DuplicateError, get_storage
 from auth_utils import verify_password, get_password_hash, create_access_token
+from rate_limit import rate_limit
 from datetime import timedelta
 
 router = APIRouter()
 
-@router.post("/signup", response_model=Token)
+@router.post("/signup", response_model=Token, dependencies=[Depends(rate_limit("signup"))])
 async def signup(user: UserCreate):
-    db = get_database()
+    storage = get_storage()
     
     # Validate input
     if len(user.username) < 3:
@@ -23,31 +24,15 @@ async def signup(user: UserCreate):
             detail="Password must be at least 6 characters"
         )
     
-    # Check if user already exists
-    existing_user = await db.users.find_one({
-        "$or": [
-            {"username": user.username},
-            {"email": user.email}
-        ]
-    })
-    
-    if existing_user:
+    # Create new user unless the username or email is taken
+    try:
+        new_user = await storage.users.create(user.username, user.email, get_password_hash(user.password))
+    except DuplicateError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username or email already registered"
         )
-    
-    # Create new user
-    hashed_password = get_password_hash(user.password)
-    user_dict = {
-        "username": user.username,
-        "email": user.email,
-        "password": hashed_password,
-        "created_at": user_dict.get("created_at") if "created_at" in locals() else None
-    }
-    
-    result = await db.users.insert_one(user_dict)
-    user_id = str(result.inserted_id)
+    user_id = new_user["id"]
     
     # Create access token
     access_token = create_access_token(
@@ -56,12 +41,12 @@ async def signup(user: UserCreate):
     
     return {"access_token": access_token, "token_type": "bearer"}
 
-@router.post("/signin", response_model=Token)
+@router.post("/signin", response_model=Token, dependencies=[Depends(rate_limit("signin"))])
 async def signin(user: UserLogin):
-    db = get_database()
+    storage = get_storage()
     
     # Find user
-    db_user = await db.users.find_one({"username": user.username})
+    db_user = await storage.users.get_login(user.username)
     
     if not db_user or not verify_password(user.password, db_user["password"]):
         raise HTTPException(
@@ -70,7 +55,7 @@ async def signin(user: UserLogin):
         )
     
     # Create access token
-    user_id = str(db_user["_id"])
+    user_id = db_user["id"]
     access_token = create_access_token(
         data={"sub": user_id, "username": db_user["username"]}
     )
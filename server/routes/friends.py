@@ -1,13 +1,73 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from typing import List, Optional
 from database import get_database
-from routes.users import get_current_user
+from routes.users import get_current_user, object_ids, user_cards
+from friend_graph import friend_graph
+from response_cache import FRIENDS, cached_json_response, response_cache
+import pagination
+from rate_limit import rate_limit
+from models import FriendRequestBatch
+from storage import pair_key
 from datetime import datetime
 from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 router = APIRouter()
 
-@router.post("/request/{user_id}")
+async def ensure_indexes(db):
+    # At most one friendship and one friend request per pair of users
+    await db.friendships.create_index("pair_key", unique=True)
+    await db.friend_requests.create_index("pair_key", unique=True)
+    # Friend listings walk each side of the friendship in _id order
+    await db.friendships.create_index([("user1_id", 1), ("_id", 1)])
+    await db.friendships.create_index([("user2_id", 1), ("_id", 1)])
+    # Answered requests are deleted by the retention job
+    await db.friend_requests.create_index([("status", 1), ("responded_at", 1)])
+
+async def expire_answered_requests(db, cutoff: datetime, batch_size: int, after_batch=None) -> int:
+    # Deletes accepted and rejected requests answered before cutoff, which
+    # also lets the pair send each other a new request. Requests answered
+    # before responded_at was recorded go by when they were sent.
+    query = {"status": {"$in": ["accepted", "rejected"]}, "$or": [
+        {"responded_at": {"$lt": cutoff}},
+        {"responded_at": {"$exists": False}, "created_at": {"$lt": cutoff}}
+    ]}
+    deleted = 0
+    while True:
+        batch = await db.friend_requests.find(query, {"_id": 1}).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        await db.friend_requests.delete_many({"_id": {"$in": [req["_id"] for req in batch]}})
+        deleted += len(batch)
+        if after_batch:
+            await after_batch(len(batch))
+        if len(batch) < batch_size:
+            break
+    return deleted
+
+async def migrate_pair_keys(db):
+    # Key documents written before pair keys existed and drop duplicate
+    # pairs so the unique indexes can be built. For requests, an accepted
+    # one wins over a pending one, which wins over a rejected one.
+    rank = {"accepted": 0, "pending": 1, "rejected": 2}
+    for collection, a, b in (
+        (db.friendships, "user1_id", "user2_id"),
+        (db.friend_requests, "from_user_id", "to_user_id")
+    ):
+        seen = {}
+        async for doc in collection.find({"pair_key": {"$exists": False}}):
+            key = pair_key(doc[a], doc[b])
+            existing = seen.get(key) or await collection.find_one({"pair_key": key})
+            if existing and rank.get(existing.get("status"), 0) <= rank.get(doc.get("status"), 0):
+                await collection.delete_one({"_id": doc["_id"]})
+                continue
+            if existing:
+                await collection.delete_one({"_id": existing["_id"]})
+            await collection.update_one({"_id": doc["_id"]}, {"$set": {"pair_key": key}})
+            seen[key] = doc
+
+@router.post("/request/{user_id}", dependencies=[Depends(rate_limit("friend_request"))])
 async def send_friend_request(user_id: str, current_user: str = Depends(get_current_user)):
     db = get_database()
     
@@ -19,7 +79,7 @@ async def send_friend_request(user_id: str, current_user: str = Depends(get_curr
     
     # Check if user exists
     try:
-        target_user = await db.users.find_one({"_id": ObjectId(user_id)})
+        target_user = await db.users.find_one({"_id": ObjectId(user_id)}, {"_id": 1})
     except:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -32,46 +92,40 @@ async def send_friend_request(user_id: str, current_user: str = Depends(get_curr
             detail="User not found"
         )
     
-    # Check if request already exists
-    existing_request = await db.friend_requests.find_one({
-        "$or": [
-            {"from_user_id": current_user, "to_user_id": user_id},
-            {"from_user_id": user_id, "to_user_id": current_user}
-        ]
-    })
-    
-    if existing_request:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Friend request already exists"
-        )
-    
     # Check if already friends
-    existing_friendship = await db.friendships.find_one({
-        "$or": [
-            {"user1_id": current_user, "user2_id": user_id},
-            {"user1_id": user_id, "user2_id": current_user}
-        ]
-    })
-    
-    if existing_friendship:
+    if await friend_graph.is_friend(db, current_user, user_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Already friends"
         )
     
-    # Create friend request
+    # Create the request unless one already exists for this pair, in
+    # either direction; the unique pair_key index settles concurrent clicks
     request_data = {
+        "pair_key": pair_key(current_user, user_id),
         "from_user_id": current_user,
         "to_user_id": user_id,
         "status": "pending",
         "created_at": datetime.utcnow()
     }
     
-    result = await db.friend_requests.insert_one(request_data)
+    try:
+        result = await db.friend_requests.update_one(
+            {"pair_key": request_data["pair_key"]},
+            {"$setOnInsert": request_data},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        result = None
+    
+    if result is None or result.upserted_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Friend request already exists"
+        )
     
     return {
-        "id": str(result.inserted_id),
+        "id": str(result.upserted_id),
         "message": "Friend request sent"
     }
 
@@ -79,40 +133,46 @@ async def send_friend_request(user_id: str, current_user: str = Depends(get_curr
 async def get_friend_requests(current_user: str = Depends(get_current_user)):
     db = get_database()
     
-    # Get pending requests sent to current user
-    requests = await db.friend_requests.find({
+    requests = await pending_requests(db, current_user)
+    
+    # Get sender info in one query
+    senders = {card["id"]: card for card in await user_cards([req["from_user_id"] for req in requests])}
+    return request_listing(requests, senders)
+
+async def pending_requests(db, current_user: str) -> List[dict]:
+    # Pending requests sent to the user, oldest first
+    return await db.friend_requests.find({
         "to_user_id": current_user,
         "status": "pending"
-    }).to_list(100)
-    
-    result = []
-    for req in requests:
-        # Get sender info
-        sender = await db.users.find_one({"_id": ObjectId(req["from_user_id"])})
-        if sender:
-            result.append({
-                "id": str(req["_id"]),
-                "from_user": {
-                    "id": str(sender["_id"]),
-                    "username": sender["username"],
-                    "email": sender["email"]
-                },
-                "created_at": req["created_at"].isoformat()
-            })
-    
-    return result
+    }).sort("_id", 1).to_list(100)
+
+def request_listing(requests: List[dict], senders: dict) -> List[dict]:
+    # senders maps user id to card; requests from deleted users are left out
+    return [
+        {
+            "id": str(req["_id"]),
+            "from_user": senders[req["from_user_id"]],
+            "created_at": req["created_at"].isoformat()
+        }
+        for req in requests
+        if req["from_user_id"] in senders
+    ]
 
 @router.post("/requests/{request_id}/accept")
 async def accept_friend_request(request_id: str, current_user: str = Depends(get_current_user)):
     db = get_database()
     
-    # Find request
+    # Find the request. Already accepted requests match too, so a retried
+    # accept finishes whatever the first attempt didn't.
     try:
-        request = await db.friend_requests.find_one({
-            "_id": ObjectId(request_id),
-            "to_user_id": current_user,
-            "status": "pending"
-        })
+        request = await db.friend_requests.find_one(
+            {
+                "_id": ObjectId(request_id),
+                "to_user_id": current_user,
+                "status": {"$in": ["pending", "accepted"]}
+            },
+            {"from_user_id": 1, "pair_key": 1}
+        )
     except:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -125,23 +185,60 @@ async def accept_friend_request(request_id: str, current_user: str = Depends(get
             detail="Friend request not found"
         )
     
-    # Update request status
-    await db.friend_requests.update_one(
-        {"_id": ObjectId(request_id)},
-        {"$set": {"status": "accepted"}}
+    # Create the friendship before marking the request accepted, so a
+    # failure in between leaves a request that can still be accepted
+    created = await _create_friendships(db, current_user, [request])
+    result = await db.friend_requests.update_one(
+        {"_id": request["_id"], "status": {"$in": ["pending", "accepted"]}},
+        {"$set": {"status": "accepted", "responded_at": datetime.utcnow()}}
     )
     
-    # Create friendship
-    friendship_data = {
-        "user1_id": request["from_user_id"],
-        "user2_id": current_user,
-        "created_at": datetime.utcnow()
-    }
+    if result.matched_count == 0:
+        # Rejected in the meantime; take back the friendship made above
+        await db.friendships.delete_many({"_id": {"$in": list(created.values())}})
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Friend request not found"
+        )
     
-    await db.friendships.insert_one(friendship_data)
+    friend_graph.add_friendship(request["from_user_id"], current_user)
+    await response_cache.invalidate(FRIENDS, [request["from_user_id"], current_user])
     
     return {"message": "Friend request accepted"}
 
+def _request_pair_key(request: dict, current_user: str) -> str:
+    return request.get("pair_key") or pair_key(request["from_user_id"], current_user)
+
+async def _create_friendships(db, current_user: str, requests: List[dict]) -> dict:
+    # Friendships for requests sent to the user, in one bulk write; existing
+    # ones are left alone. Returns the ids of the new ones by pair key.
+    now = datetime.utcnow()
+    keys = [_request_pair_key(request, current_user) for request in requests]
+    upserts = [
+        UpdateOne(
+            {"pair_key": key},
+            {"$setOnInsert": {
+                "pair_key": key,
+                "user1_id": request["from_user_id"],
+                "user2_id": current_user,
+                "created_at": now
+            }},
+            upsert=True
+        )
+        for key, request in zip(keys, requests)
+    ]
+    if not upserts:
+        return {}
+    try:
+        result = await db.friendships.bulk_write(upserts, ordered=False)
+        upserted = result.upserted_ids
+    except BulkWriteError as e:
+        # Lost a race with another accept of the same pair
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+        upserted = {item["index"]: item["_id"] for item in e.details["upserted"]}
+    return {keys[index]: friendship_id for index, friendship_id in upserted.items()}
+
 @router.post("/requests/{request_id}/reject")
 async def reject_friend_request(request_id: str, current_user: str = Depends(get_current_user)):
     db = get_database()
@@ -168,50 +265,193 @@ async def reject_friend_request(request_id: str, current_user: str = Depends(get
     # Update request status
     await db.friend_requests.update_one(
         {"_id": ObjectId(request_id)},
-        {"$set": {"status": "rejected"}}
+        {"$set": {"status": "rejected", "responded_at": datetime.utcnow()}}
     )
     
     return {"message": "Friend request rejected"}
 
+@router.post("/requests/accept")
+async def accept_friend_requests(batch: FriendRequestBatch, current_user: str = Depends(get_current_user)):
+    db = get_database()
+    request_ids = object_ids(batch.request_ids)
+    
+    # Already accepted requests are included so a retry completes
+    query = {
+        "_id": {"$in": request_ids},
+        "to_user_id": current_user,
+        "status": {"$in": ["pending", "accepted"]}
+    }
+    requests = await db.friend_requests.find(query, {"from_user_id": 1, "pair_key": 1}).to_list(len(request_ids))
+    
+    # As for a single accept, the friendships come first, then the requests
+    # are accepted in one update and read back
+    created = await _create_friendships(db, current_user, requests)
+    await db.friend_requests.update_many(
+        query,
+        {"$set": {"status": "accepted", "responded_at": datetime.utcnow()}}
+    )
+    accepted = {
+        request["_id"]
+        for request in await db.friend_requests.find(
+            {"_id": {"$in": [request["_id"] for request in requests]}, "status": "accepted"},
+            {"_id": 1}
+        ).to_list(len(requests))
+    }
+    
+    # Take back friendships made for requests rejected in the meantime
+    withdrawn = [
+        created[key]
+        for key in (_request_pair_key(request, current_user) for request in requests if request["_id"] not in accepted)
+        if key in created
+    ]
+    if withdrawn:
+        await db.friendships.delete_many({"_id": {"$in": withdrawn}})
+    
+    senders = [request["from_user_id"] for request in requests if request["_id"] in accepted]
+    for sender in senders:
+        friend_graph.add_friendship(sender, current_user)
+    await response_cache.invalidate(FRIENDS, senders + [current_user])
+    
+    accepted = {str(request_id) for request_id in accepted}
+    return {
+        "accepted": [request_id for request_id in batch.request_ids if request_id in accepted],
+        "not_found": [request_id for request_id in batch.request_ids if request_id not in accepted]
+    }
+
+@router.post("/requests/reject")
+async def reject_friend_requests(batch: FriendRequestBatch, current_user: str = Depends(get_current_user)):
+    db = get_database()
+    request_ids = object_ids(batch.request_ids)
+    
+    query = {"_id": {"$in": request_ids}, "to_user_id": current_user}
+    await db.friend_requests.update_many(
+        {**query, "status": "pending"},
+        {"$set": {"status": "rejected", "responded_at": datetime.utcnow()}}
+    )
+    rejected = {
+        str(request["_id"])
+        for request in await db.friend_requests.find(
+            {**query, "status": "rejected"}, {"_id": 1}
+        ).to_list(len(request_ids))
+    }
+    
+    return {
+        "rejected": [request_id for request_id in batch.request_ids if request_id in rejected],
+        "not_found": [request_id for request_id in batch.request_ids if request_id not in rejected]
+    }
+
 @router.get("/")
-async def get_friends(current_user: str = Depends(get_current_user)):
+async def get_friends(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    stream: bool = False,
+    current_user: str = Depends(get_current_user)
+):
     db = get_database()
     
-    # Get all friendships
-    friendships = await db.friendships.find({
+    # Stream every friend as NDJSON while the cursor produces them
+    if pagination.wants_ndjson(request, stream):
+        return pagination.ndjson_response(_iter_friends(db, current_user))
+    
+    # One page, resumable with next_cursor
+    if cursor is not None or limit is not None:
+        limit = pagination.page_size(limit)
+        page = [
+            pair
+            async for batch in _friend_batches(db, current_user, pagination.decode_cursor(cursor), limit)
+            for pair in batch
+        ]
+        return {
+            "items": [friend for _, friend in page if friend],
+            "next_cursor": pagination.encode_cursor(page[-1][0]) if len(page) == limit else None
+        }
+    
+    return await cached_json_response(
+        request, FRIENDS, current_user, lambda: _build_friends(current_user)
+    )
+
+async def _friend_batches(db, current_user: str, after=None, limit: int = 0, batch_size: int = 100):
+    # Walk friendships in _id order and resolve each batch of friends with
+    # one users query. Yields lists of (friendship_id, friend) pairs, with
+    # friend set to None when the user no longer exists.
+    query = {
         "$or": [
             {"user1_id": current_user},
             {"user2_id": current_user}
         ]
-    }).to_list(1000)
+    }
+    if after:
+        query["_id"] = {"$gt": after}
     
-    result = []
-    for friendship in friendships:
+    friendships = db.friendships.find(query, {"user1_id": 1, "user2_id": 1}).sort("_id", 1).limit(limit)
+    async for batch in pagination.batched(friendships, batch_size):
         # Get the other user's ID
-        friend_id = friendship["user2_id"] if friendship["user1_id"] == current_user else friendship["user1_id"]
+        friend_ids = [
+            f["user2_id"] if f["user1_id"] == current_user else f["user1_id"]
+            for f in batch
+        ]
         
         # Get friend info
-        friend = await db.users.find_one({"_id": ObjectId(friend_id)})
-        if friend:
-            result.append({
+        friends = {}
+        async for friend in db.users.find(
+            {"_id": {"$in": [ObjectId(friend_id) for friend_id in friend_ids]}},
+            {"username": 1, "email": 1}
+        ):
+            friends[str(friend["_id"])] = {
                 "id": str(friend["_id"]),
                 "username": friend["username"],
                 "email": friend["email"]
-            })
+            }
+        
+        yield [(f["_id"], friends.get(friend_id)) for f, friend_id in zip(batch, friend_ids)]
+
+async def _iter_friends(db, current_user: str):
+    async for batch in _friend_batches(db, current_user):
+        for _, friend in batch:
+            if friend:
+                yield friend
+
+async def _build_friends(current_user: str):
+    db = get_database()
+    return [friend async for friend in _iter_friends(db, current_user)]
+
+@router.get("/mutual/{user_id}")
+async def get_mutual_friends(user_id: str, current_user: str = Depends(get_current_user)):
+    db = get_database()
+    
+    mutual = await friend_graph.mutual_friends(db, current_user, user_id)
+    return await user_cards(sorted(mutual))
+
+@router.get("/suggestions")
+async def get_friend_suggestions(limit: int = 10, current_user: str = Depends(get_current_user)):
+    db = get_database()
+    
+    # Leave out anyone with a request already pending in either direction
+    pending = set()
+    async for req in db.friend_requests.find(
+        {
+            "$or": [{"from_user_id": current_user}, {"to_user_id": current_user}],
+            "status": "pending"
+        },
+        {"from_user_id": 1, "to_user_id": 1}
+    ):
+        pending.add(req["to_user_id"] if req["from_user_id"] == current_user else req["from_user_id"])
     
-    return result
+    suggestions = await friend_graph.suggestions(db, current_user, exclude=pending, limit=max(1, min(limit, 50)))
+    mutual_counts = dict(suggestions)
+    cards = await user_cards([user_id for user_id, _ in suggestions])
+    for card in cards:
+        card["mutual_friends"] = mutual_counts[card["id"]]
+    return cards
 
 @router.delete("/{friend_id}")
 async def remove_friend(friend_id: str, current_user: str = Depends(get_current_user)):
     db = get_database()
     
     # Delete friendship
-    result = await db.friendships.delete_one({
-        "$or": [
-            {"user1_id": current_user, "user2_id": friend_id},
-            {"user1_id": friend_id, "user2_id": current_user}
-        ]
-    })
+    key = pair_key(current_user, friend_id)
+    result = await db.friendships.delete_one({"pair_key": key})
     
     if result.deleted_count == 0:
         raise HTTPException(
@@ -219,4 +459,10 @@ async def remove_friend(friend_id: str, current_user: str = Depends(get_current_
             detail="Friendship not found"
         )
     
+    # Drop the accepted request too so either side can send a new one later
+    await db.friend_requests.delete_one({"pair_key": key, "status": "accepted"})
+    
+    friend_graph.remove_friendship(current_user, friend_id)
+    await response_cache.invalidate(FRIENDS, [current_user, friend_id])
+    
     return {"message": "Friend removed"}
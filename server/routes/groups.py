@@ -1,13 +1,79 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from typing import List, Optional
 from database import get_database
-from routes.users import get_current_user
-from models import GroupCreate
+from routes.users import get_current_user, object_ids
+from models import GroupCreate, MemberBatch
+from response_cache import GROUP, GROUPS, cached_json_response, response_cache
+import group_members
+import pagination
 from datetime import datetime
 from bson import ObjectId
 
 router = APIRouter()
 
+async def _find_group(db, group_id: str):
+    try:
+        group = await db.groups.find_one({"_id": ObjectId(group_id)})
+    except:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Group not found"
+        )
+    
+    if not group:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Group not found"
+        )
+    
+    return group
+
+async def _find_group_as_member(db, group_id: str, current_user: str):
+    try:
+        group = await db.groups.find_one({"_id": ObjectId(group_id)})
+    except:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Group not found"
+        )
+    
+    if not group or not await group_members.is_member(db, group_id, current_user):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Group not found or you're not a member"
+        )
+    
+    return group
+
+async def _member_cards(db, member_ids: List[str], with_email: bool = False):
+    # Resolve member ids to user cards with a single query, keeping the order
+    projection = {"username": 1, "email": 1} if with_email else {"username": 1}
+    users = {}
+    async for user in db.users.find(
+        {"_id": {"$in": [ObjectId(member_id) for member_id in member_ids]}},
+        projection
+    ):
+        users[str(user["_id"])] = user
+    
+    cards = []
+    for member_id in member_ids:
+        user = users.get(member_id)
+        if user:
+            card = {"id": member_id, "username": user["username"]}
+            if with_email:
+                card["email"] = user["email"]
+            cards.append(card)
+    return cards
+
+async def _groups_version(db, current_user: str) -> str:
+    # The user's groups in listing order, each with its cache version
+    group_ids = [
+        membership["group_id"]
+        async for membership in db.group_members.find({"user_id": current_user}, {"group_id": 1}).sort("_id", 1)
+    ]
+    versions = await response_cache.versions(GROUP, group_ids)
+    return ",".join(f"{group_id}.{versions[group_id]}" for group_id in group_ids)
+
 @router.post("/")
 async def create_group(group: GroupCreate, current_user: str = Depends(get_current_user)):
     db = get_database()
@@ -26,95 +92,175 @@ async def create_group(group: GroupCreate, current_user: str = Depends(get_curre
     group_data = {
         "name": group.name.strip(),
         "created_by": current_user,
-        "members": members,
+        "member_count": 0,
         "created_at": datetime.utcnow()
     }
     
     result = await db.groups.insert_one(group_data)
+    group_id = str(result.inserted_id)
+    await group_members.add_members(db, group_id, members)
     
     return {
-        "id": str(result.inserted_id),
+        "id": group_id,
         "name": group_data["name"],
         "created_by": current_user,
         "members": members,
+        "member_count": len(members),
         "created_at": group_data["created_at"].isoformat()
     }
 
 @router.get("/")
-async def get_user_groups(current_user: str = Depends(get_current_user)):
+async def get_user_groups(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    stream: bool = False,
+    current_user: str = Depends(get_current_user)
+):
     db = get_database()
     
-    # Get all groups where user is a member
-    groups = await db.groups.find({
-        "members": current_user
-    }).to_list(1000)
+    # Stream every group as NDJSON while the cursor produces them
+    if pagination.wants_ndjson(request, stream):
+        return pagination.ndjson_response(_iter_user_groups(db, current_user))
     
-    result = []
-    for group in groups:
-        # Get member details
-        members = []
-        for member_id in group.get("members", []):
-            member = await db.users.find_one({"_id": ObjectId(member_id)})
-            if member:
-                members.append({
-                    "id": str(member["_id"]),
-                    "username": member["username"]
-                })
+    # One page, resumable with next_cursor
+    if cursor is not None or limit is not None:
+        limit = pagination.page_size(limit)
+        page = [
+            pair
+            async for batch in _group_batches(db, current_user, pagination.decode_cursor(cursor), limit)
+            for pair in batch
+        ]
+        return {
+            "items": [group for _, group in page if group],
+            "next_cursor": pagination.encode_cursor(page[-1][0]) if len(page) == limit else None
+        }
+    
+    return await cached_json_response(
+        request, GROUPS, current_user, lambda: _build_user_groups(current_user),
+        version=await _groups_version(db, current_user)
+    )
+
+async def _group_batches(db, current_user: str, after=None, limit: int = 0, batch_size: int = 50):
+    # Walk the user's memberships in _id order and load each batch of groups
+    # with one query. Yields lists of (membership_id, group) pairs, with group
+    # set to None when the group no longer exists.
+    query = {"user_id": current_user}
+    if after:
+        query["_id"] = {"$gt": after}
+    
+    memberships = db.group_members.find(query, {"group_id": 1}).sort("_id", 1).limit(limit)
+    async for batch in pagination.batched(memberships, batch_size):
+        groups, previews = await _load_groups(db, [m["group_id"] for m in batch])
+        cards = {
+            card["id"]: card
+            for card in await _member_cards(db, list({m for ids in previews.values() for m in ids}))
+        }
         
-        result.append({
-            "id": str(group["_id"]),
-            "name": group["name"],
-            "created_by": group["created_by"],
-            "members": members,
-            "created_at": group["created_at"].isoformat()
-        })
-    
-    return result
+        result = []
+        for membership in batch:
+            group = groups.get(membership["group_id"])
+            if group:
+                group = group_listing(group, previews[membership["group_id"]], cards)
+            result.append((membership["_id"], group))
+        yield result
+
+async def _load_groups(db, group_ids: List[str]):
+    # Groups by id, plus the first page of member ids of each, in two queries
+    groups = {}
+    async for group in db.groups.find({"_id": {"$in": object_ids(group_ids)}}):
+        groups[str(group["_id"])] = group
+    
+    # Only the first page of members is embedded in the listing
+    previews = await group_members.preview_member_ids(db, list(groups))
+    return groups, previews
+
+async def load_user_groups(db, current_user: str, batch_size: int = 50):
+    # Every group of the user in membership order, with member previews,
+    # for callers that resolve the member cards themselves; loaded a batch
+    # of groups at a time
+    memberships = db.group_members.find({"user_id": current_user}, {"group_id": 1}).sort("_id", 1)
+    result = []
+    previews = {}
+    async for batch in pagination.batched(memberships, batch_size):
+        group_ids = [m["group_id"] for m in batch]
+        groups, batch_previews = await _load_groups(db, group_ids)
+        result.extend(groups[group_id] for group_id in group_ids if group_id in groups)
+        previews.update(batch_previews)
+    return result, previews
+
+def group_listing(group: dict, preview: List[str], cards: dict) -> dict:
+    # cards maps user id to a card with at least id and username
+    return {
+        "id": str(group["_id"]),
+        "name": group["name"],
+        "created_by": group["created_by"],
+        "members": [{"id": cards[m]["id"], "username": cards[m]["username"]} for m in preview if m in cards],
+        "member_count": group.get("member_count", 0),
+        "created_at": group["created_at"].isoformat()
+    }
+
+async def _iter_user_groups(db, current_user: str):
+    async for batch in _group_batches(db, current_user):
+        for _, group in batch:
+            if group:
+                yield group
+
+async def _build_user_groups(current_user: str):
+    db = get_database()
+    return [group async for group in _iter_user_groups(db, current_user)]
 
 @router.get("/{group_id}")
 async def get_group(group_id: str, current_user: str = Depends(get_current_user)):
     db = get_database()
     
-    try:
-        group = await db.groups.find_one({"_id": ObjectId(group_id)})
-    except:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Group not found"
-        )
-    
-    if not group:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Group not found"
-        )
+    group = await _find_group(db, group_id)
     
     # Verify user is a member
-    if current_user not in group.get("members", []):
+    if not await group_members.is_member(db, group_id, current_user):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not a member of this group"
         )
     
-    # Get member details
-    members = []
-    for member_id in group.get("members", []):
-        member = await db.users.find_one({"_id": ObjectId(member_id)})
-        if member:
-            members.append({
-                "id": str(member["_id"]),
-                "username": member["username"],
-                "email": member["email"]
-            })
+    # Get details of the first page of members
+    member_ids = await group_members.list_member_ids(db, group_id)
+    members = await _member_cards(db, member_ids, with_email=True)
     
     return {
         "id": str(group["_id"]),
         "name": group["name"],
         "created_by": group["created_by"],
         "members": members,
+        "member_count": group.get("member_count", 0),
         "created_at": group["created_at"].isoformat()
     }
 
+@router.get("/{group_id}/members")
+async def get_group_members(
+    group_id: str,
+    after: Optional[str] = None,
+    limit: int = group_members.MEMBER_PAGE_SIZE,
+    current_user: str = Depends(get_current_user)
+):
+    db = get_database()
+    
+    await _find_group(db, group_id)
+    
+    if not await group_members.is_member(db, group_id, current_user):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not a member of this group"
+        )
+    
+    limit = max(1, min(limit, group_members.MAX_MEMBER_PAGE_SIZE))
+    member_ids = await group_members.list_member_ids(db, group_id, after=after, limit=limit)
+    
+    return {
+        "members": await _member_cards(db, member_ids, with_email=True),
+        "next": member_ids[-1] if len(member_ids) == limit else None
+    }
+
 @router.put("/{group_id}/name")
 async def rename_group(
     group_id: str,
@@ -130,28 +276,14 @@ async def rename_group(
         )
     
     # Find group and verify user is member
-    try:
-        group = await db.groups.find_one({
-            "_id": ObjectId(group_id),
-            "members": current_user
-        })
-    except:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Group not found"
-        )
-    
-    if not group:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Group not found or you're not a member"
-        )
+    await _find_group_as_member(db, group_id, current_user)
     
     # Update group name
     await db.groups.update_one(
         {"_id": ObjectId(group_id)},
         {"$set": {"name": new_name.strip()}}
     )
+    await response_cache.invalidate(GROUP, [group_id])
     
     return {"message": "Group renamed successfully"}
 
@@ -164,26 +296,11 @@ async def add_member(
     db = get_database()
     
     # Verify group exists and user is a member
-    try:
-        group = await db.groups.find_one({
-            "_id": ObjectId(group_id),
-            "members": current_user
-        })
-    except:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Group not found"
-        )
-    
-    if not group:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Group not found or you're not a member"
-        )
+    await _find_group_as_member(db, group_id, current_user)
     
     # Verify user to add exists
     try:
-        user_to_add = await db.users.find_one({"_id": ObjectId(user_id)})
+        user_to_add = await db.users.find_one({"_id": ObjectId(user_id)}, {"_id": 1})
     except:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -196,54 +313,81 @@ async def add_member(
             detail="User not found"
         )
     
-    # Check if user is already a member
-    if user_id in group.get("members", []):
+    # Add member; nothing is inserted if they already are one
+    if not await group_members.add_members(db, group_id, [user_id]):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="User is already a member"
         )
     
-    # Add member
-    await db.groups.update_one(
-        {"_id": ObjectId(group_id)},
-        {"$push": {"members": user_id}}
-    )
+    await response_cache.invalidate(GROUP, [group_id])
     
     return {"message": "Member added successfully"}
 
-@router.delete("/{group_id}/members/{user_id}")
-async def remove_member(
+@router.post("/{group_id}/members")
+async def add_members(
     group_id: str,
-    user_id: str,
+    batch: MemberBatch,
     current_user: str = Depends(get_current_user)
 ):
     db = get_database()
     
     # Verify group exists and user is a member
-    try:
-        group = await db.groups.find_one({
-            "_id": ObjectId(group_id),
-            "members": current_user
-        })
-    except:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Group not found"
-        )
+    await _find_group_as_member(db, group_id, current_user)
     
-    if not group:
+    # One query for which of the users exist, one bulk write to add them
+    existing = {
+        str(user["_id"])
+        async for user in db.users.find({"_id": {"$in": object_ids(batch.user_ids)}}, {"_id": 1})
+    }
+    added = await group_members.add_members(db, group_id, [user_id for user_id in batch.user_ids if user_id in existing])
+    if added:
+        await response_cache.invalidate(GROUP, [group_id])
+    
+    return {
+        "added": added,
+        "not_found": [user_id for user_id in batch.user_ids if user_id not in existing]
+    }
+
+@router.delete("/{group_id}/members")
+async def remove_members(
+    group_id: str,
+    batch: MemberBatch,
+    current_user: str = Depends(get_current_user)
+):
+    db = get_database()
+    
+    # Verify group exists and user is a member
+    group = await _find_group_as_member(db, group_id, current_user)
+    
+    # Anyone may leave, only the group creator can remove others
+    if group["created_by"] != current_user and any(user_id != current_user for user_id in batch.user_ids):
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Group not found or you're not a member"
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only the group creator can remove members"
         )
     
+    removed = await group_members.remove_members(db, group_id, batch.user_ids)
+    await response_cache.invalidate(GROUP, [group_id])
+    
+    return {"removed": removed}
+
+@router.delete("/{group_id}/members/{user_id}")
+async def remove_member(
+    group_id: str,
+    user_id: str,
+    current_user: str = Depends(get_current_user)
+):
+    db = get_database()
+    
+    # Verify group exists and user is a member
+    group = await _find_group_as_member(db, group_id, current_user)
+    
     # Check if trying to remove self
     if user_id == current_user:
         # Allow leaving group
-        await db.groups.update_one(
-            {"_id": ObjectId(group_id)},
-            {"$pull": {"members": user_id}}
-        )
+        await group_members.remove_members(db, group_id, [user_id])
+        await response_cache.invalidate(GROUP, [group_id])
         return {"message": "Left group successfully"}
     
     # Only group creator can remove others
@@ -254,9 +398,7 @@ async def remove_member(
         )
     
     # Remove member
-    await db.groups.update_one(
-        {"_id": ObjectId(group_id)},
-        {"$pull": {"members": user_id}}
-    )
+    await group_members.remove_members(db, group_id, [user_id])
+    await response_cache.invalidate(GROUP, [group_id])
     
     return {"message": "Member removed successfully"}
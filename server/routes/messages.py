@@ -1,14 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
 from typing import List, Optional
 from database import get_database
 from routes.users import get_current_user
 from models import MessageCreate
+import group_members
+import message_store
+import search_index
+import message_ingest
+import message_export
+import attachment_store
+import read_receipts
+import wire_format
+from routes.users import USER_CARD_PROJECTION, user_card
+from rate_limit import rate_limit
 from datetime import datetime
 from bson import ObjectId
 
 router = APIRouter()
 
-@router.post("/")
+@router.post("/", dependencies=[Depends(rate_limit("send_message"))])
 async def send_message(message: MessageCreate, current_user: str = Depends(get_current_user)):
     db = get_database()
     
@@ -18,32 +29,54 @@ async def send_message(message: MessageCreate, current_user: str = Depends(get_c
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Either recipient_id or group_id must be provided"
         )
+    if not message.content and not message.attachment_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Message must have content or attachments"
+        )
     
-    # Create message
-    message_data = {
-        "sender_id": current_user,
-        "recipient_id": message.recipient_id,
-        "group_id": message.group_id,
-        "content": message.content,
-        "timestamp": datetime.utcnow(),
-        "status": "sent"
-    }
+    if not await message_ingest.can_send(current_user, message.recipient_id, message.group_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Group not found or you're not a member" if message.group_id else "Recipient not found"
+        )
+    
+    # Attachments are only shared once the message is sure to be stored
+    try:
+        attachments = await attachment_store.attach(
+            db, current_user, message.attachment_ids, message.recipient_id, message.group_id
+        )
+    except attachment_store.InvalidAttachment as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     
-    result = await db.messages.insert_one(message_data)
+    # Create message, or return the original if this is a retry
+    message_data, created = await message_ingest.store_message(
+        db,
+        current_user,
+        message.recipient_id,
+        message.group_id,
+        message.content,
+        message.client_message_id,
+        attachments
+    )
     
     return {
-        "id": str(result.inserted_id),
+        "id": str(message_data["_id"]),
+        "client_message_id": message.client_message_id,
         "sender_id": current_user,
-        "recipient_id": message.recipient_id,
-        "group_id": message.group_id,
-        "content": message.content,
+        "recipient_id": message_data["recipient_id"],
+        "group_id": message_data["group_id"],
+        "content": message_data["content"],
         "timestamp": message_data["timestamp"].isoformat(),
-        "status": "sent"
+        "status": message_data.get("status", "sent"),
+        "attachments": message_data.get("attachments", []),
+        "duplicate": not created
     }
 
 @router.get("/conversation/{other_user_id}")
 async def get_conversation(
     other_user_id: str,
+    request: Request,
     limit: int = 50,
     before: Optional[str] = None,
     current_user: str = Depends(get_current_user)
@@ -58,32 +91,72 @@ async def get_conversation(
         ]
     }
     
-    if before:
-        try:
-            query["_id"] = {"$lt": ObjectId(before)}
-        except:
-            pass
-    
-    # Get messages
-    messages = await db.messages.find(query).sort("timestamp", -1).limit(limit).to_list(limit)
+    # Get messages from the hot and cold tiers
+    messages = await message_store.fetch_history(
+        db,
+        message_store.direct_conversation_key(current_user, other_user_id),
+        query,
+        limit,
+        before
+    )
     
     # Format response
     result = []
     for msg in reversed(messages):
-        result.append({
+        row = {
             "id": str(msg["_id"]),
             "sender_id": msg["sender_id"],
             "recipient_id": msg.get("recipient_id"),
             "content": msg["content"],
             "timestamp": msg["timestamp"].isoformat(),
             "status": msg.get("status", "sent")
-        })
+        }
+        if msg.get("attachments"):
+            row["attachments"] = msg["attachments"]
+        result.append(row)
+    
+    return wire_format.render(request, result)
+
+@router.get("/search", dependencies=[Depends(rate_limit("search_messages"))])
+async def search_messages(
+    q: str,
+    offset: int = 0,
+    limit: int = 20,
+    prefix: bool = True,
+    current_user: str = Depends(get_current_user)
+):
+    db = get_database()
+    
+    limit = max(1, min(limit, 50))
+    group_ids = await group_members.group_ids_for_user(db, current_user)
+    hits = await search_index.search(db, current_user, group_ids, q, max(0, offset), limit, prefix)
+    
+    # Load the matching messages from whichever tier holds them
+    found = await message_store.fetch_by_ids(db, [(hit["conv"], hit["_id"]) for hit in hits])
+    
+    results = []
+    for hit in hits:
+        msg = found.get(hit["_id"])
+        if msg:
+            results.append({
+                "id": str(msg["_id"]),
+                "sender_id": msg["sender_id"],
+                "recipient_id": msg.get("recipient_id"),
+                "group_id": msg.get("group_id"),
+                "content": msg["content"],
+                "timestamp": msg["timestamp"].isoformat(),
+                "score": round(hit["score"], 4)
+            })
     
-    return result
+    return {
+        "results": results,
+        "next_offset": offset + limit if len(hits) == limit else None
+    }
 
 @router.get("/group/{group_id}")
 async def get_group_messages(
     group_id: str,
+    request: Request,
     limit: int = 50,
     before: Optional[str] = None,
     current_user: str = Depends(get_current_user)
@@ -92,14 +165,14 @@ async def get_group_messages(
     
     # Verify user is member of group
     try:
-        group = await db.groups.find_one({"_id": ObjectId(group_id)})
+        group = await db.groups.find_one({"_id": ObjectId(group_id)}, {"_id": 1})
     except:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Group not found"
         )
     
-    if not group or current_user not in group.get("members", []):
+    if not group or not await group_members.is_member(db, group_id, current_user):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not a member of this group"
@@ -108,31 +181,179 @@ async def get_group_messages(
     # Build query
     query = {"group_id": group_id}
     
-    if before:
-        try:
-            query["_id"] = {"$lt": ObjectId(before)}
-        except:
-            pass
+    # Get messages from the hot and cold tiers
+    messages = await message_store.fetch_history(
+        db,
+        message_store.group_conversation_key(group_id),
+        query,
+        limit,
+        before
+    )
+    seen = read_receipts.SeenCounter(await read_receipts.watermarks(db, group_id))
     
-    # Get messages
-    messages = await db.messages.find(query).sort("timestamp", -1).limit(limit).to_list(limit)
+    # Get sender names in one query
+    sender_ids = [ObjectId(sender_id) for sender_id in {msg["sender_id"] for msg in messages} if ObjectId.is_valid(sender_id)]
+    usernames = {}
+    async for sender in db.users.find({"_id": {"$in": sender_ids}}, {"username": 1}):
+        usernames[str(sender["_id"])] = sender["username"]
     
     # Format response
     result = []
     for msg in reversed(messages):
-        # Get sender info
-        sender = await db.users.find_one({"_id": ObjectId(msg["sender_id"])})
-        result.append({
+        row = {
             "id": str(msg["_id"]),
             "sender_id": msg["sender_id"],
-            "sender_username": sender["username"] if sender else "Unknown",
+            "sender_username": usernames.get(msg["sender_id"], "Unknown"),
             "group_id": msg.get("group_id"),
             "content": msg["content"],
             "timestamp": msg["timestamp"].isoformat(),
-            "status": msg.get("status", "sent")
-        })
+            "status": msg.get("status", "sent"),
+            "seen_by": seen.seen_by(msg["_id"], msg["sender_id"])
+        }
+        if msg.get("attachments"):
+            row["attachments"] = msg["attachments"]
+        result.append(row)
     
-    return result
+    return wire_format.render(request, result)
+
+def _read_position(message_id: str) -> ObjectId:
+    try:
+        position = ObjectId(message_id)
+    except:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid message id"
+        )
+    # Ids from the future can't belong to a message yet
+    return min(position, ObjectId())
+
+@router.put("/group/{group_id}/read")
+async def mark_group_read(
+    group_id: str,
+    message_id: str,
+    current_user: str = Depends(get_current_user)
+):
+    db = get_database()
+    
+    if not await group_members.is_member(db, group_id, current_user):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not a member of this group"
+        )
+    
+    # Everything up to and including message_id is now read
+    await read_receipts.mark_read(db, group_id, current_user, _read_position(message_id))
+    
+    return {"message": "Read position updated"}
+
+@router.get("/group/{group_id}/reads/{message_id}")
+async def get_group_message_readers(
+    group_id: str,
+    message_id: str,
+    current_user: str = Depends(get_current_user)
+):
+    db = get_database()
+    
+    if not await group_members.is_member(db, group_id, current_user):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not a member of this group"
+        )
+    
+    position = _read_position(message_id)
+    found = await message_store.fetch_by_ids(db, [(message_store.group_conversation_key(group_id), position)])
+    msg = found.get(position)
+    if not msg or msg.get("group_id") != group_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Message not found"
+        )
+    
+    # Members other than the sender whose read position is at or past the message
+    reader_ids = read_receipts.readers(await read_receipts.watermarks(db, group_id), position, msg["sender_id"])
+    users = await db.users.find(
+        {"_id": {"$in": [ObjectId(user_id) for user_id in reader_ids]}},
+        USER_CARD_PROJECTION
+    ).to_list(len(reader_ids))
+    
+    return {
+        "seen_by": len(reader_ids),
+        "readers": [user_card(user) for user in users]
+    }
+
+def _export_response(messages, fmt: str, filename: str):
+    if fmt not in message_export.FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid export format"
+        )
+    
+    extension = "ndjson.gz" if fmt == "gzip" else "ndjson"
+    return StreamingResponse(
+        message_export.encode(messages, fmt),
+        media_type=message_export.FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{extension}"'}
+    )
+
+def _export_position(after: Optional[str]):
+    # The position token is the id of the last message already received
+    if not after:
+        return None
+    try:
+        return ObjectId(after)
+    except:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid position token"
+        )
+
+@router.get("/export/conversation/{other_user_id}")
+async def export_conversation(
+    other_user_id: str,
+    format: str = "ndjson",
+    after: Optional[str] = None,
+    current_user: str = Depends(get_current_user)
+):
+    db = get_database()
+    
+    query = {
+        "$or": [
+            {"sender_id": current_user, "recipient_id": other_user_id},
+            {"sender_id": other_user_id, "recipient_id": current_user}
+        ]
+    }
+    messages = message_store.iter_conversation(
+        db,
+        message_store.direct_conversation_key(current_user, other_user_id),
+        query,
+        _export_position(after)
+    )
+    
+    return _export_response(messages, format, f"conversation-{other_user_id}")
+
+@router.get("/export/group/{group_id}")
+async def export_group(
+    group_id: str,
+    format: str = "ndjson",
+    after: Optional[str] = None,
+    current_user: str = Depends(get_current_user)
+):
+    db = get_database()
+    
+    if not await group_members.is_member(db, group_id, current_user):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not a member of this group"
+        )
+    
+    messages = message_store.iter_conversation(
+        db,
+        message_store.group_conversation_key(group_id),
+        {"group_id": group_id},
+        _export_position(after)
+    )
+    
+    return _export_response(messages, format, f"group-{group_id}")
 
 @router.put("/{message_id}/status")
 async def update_message_status(
@@ -161,9 +382,18 @@ async def update_message_status(
         )
     
     if result.matched_count == 0:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Message not found"
+        # Group messages have no single recipient; reading one moves the
+        # reader's watermark for the group instead
+        msg = await db.messages.find_one(
+            {"_id": ObjectId(message_id), "group_id": {"$ne": None}},
+            {"group_id": 1}
         )
+        if not msg or not await group_members.is_member(db, msg["group_id"], current_user):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Message not found"
+            )
+        if status_value == "read":
+            await read_receipts.mark_read(db, msg["group_id"], current_user, msg["_id"])
     
     return {"message": "Status updated"}
@@ -1,11 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, File, HTTPException, UploadFile, status
+from fastapi.responses import FileResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from typing import List
 from database import get_database
+from storage import get_storage
 from auth_utils import decode_token
-from models import User
+from models import User, UserBatch
 from pydantic import BaseModel
 from bson import ObjectId
+from response_cache import FRIENDS, GROUP, response_cache
+import group_members
+import avatar_store
+from friend_graph import friend_graph
+from rate_limit import rate_limit
 
 
 class UserUpdate(BaseModel):
@@ -15,6 +22,28 @@ class UserUpdate(BaseModel):
 router = APIRouter()
 security = HTTPBearer()
 
+# Fields needed to render a user card; avoids pulling anything else
+# (password hashes, legacy inline avatars) over the wire
+USER_CARD_PROJECTION = {"username": 1, "email": 1, "avatar_id": 1, "avatar": 1}
+
+def user_card(user: dict) -> dict:
+    # Takes a storage record or a raw users document
+    return {
+        "id": user["id"] if "id" in user else str(user["_id"]),
+        "username": user["username"],
+        "email": user["email"],
+        "avatar": avatar_store.avatar_url(user)
+    }
+
+def object_ids(ids: List[str]) -> List[ObjectId]:
+    # Ids that can't be ObjectIds can't match anything, so they are dropped
+    return [ObjectId(value) for value in ids if ObjectId.is_valid(value)]
+
+async def user_cards(user_ids: List[str]) -> List[dict]:
+    # Cards for the given ids in one query, in the same order; unknown ids
+    # are left out
+    return [user_card(user) for user in await get_storage().users.get_many(user_ids)]
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = decode_token(credentials.credentials)
@@ -31,39 +60,26 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             detail="Invalid authentication credentials"
         )
 
-@router.get("/search")
+@router.get("/search", dependencies=[Depends(rate_limit("search_users"))])
 async def search_users(q: str, current_user: str = Depends(get_current_user)):
     db = get_database()
     # Search by username or email
-    try:
-        exclude_id = ObjectId(current_user)
-    except:
-        exclude_id = current_user
-
-    users = await db.users.find({
-        "$or": [
-            {"username": {"$regex": q, "$options": "i"}},
-            {"email": {"$regex": q, "$options": "i"}}
-        ],
-        "_id": {"$ne": exclude_id}
-    }).limit(20).to_list(20)
+    users = await get_storage().users.search(q, exclude_id=current_user, limit=20)
     
-    # Format response
-    result = []
-    for user in users:
-        result.append({
-            "id": str(user["_id"]),
-            "username": user["username"],
-            "email": user["email"],
-            "avatar": user.get("avatar")
-        })
+    # Rank friends first, then people with the most friends in common
+    friends = await friend_graph.friends_of(db, current_user)
+    mutual_counts = await friend_graph.mutual_counts(db, current_user, [user["id"] for user in users])
+    users.sort(key=lambda user: (
+        user["id"] not in friends,
+        -mutual_counts[user["id"]]
+    ))
     
-    return result
+    # Format response
+    return [user_card(user) for user in users]
 
 @router.get("/me")
 async def get_current_user_info(current_user: str = Depends(get_current_user)):
-    db = get_database()
-    user = await db.users.find_one({"_id": ObjectId(current_user)})
+    user = await get_storage().users.get(current_user)
     
     if not user:
         raise HTTPException(
@@ -71,23 +87,15 @@ async def get_current_user_info(current_user: str = Depends(get_current_user)):
             detail="User not found"
         )
     
-    return {
-        "id": str(user["_id"]),
-        "username": user["username"],
-        "email": user["email"],
-        "avatar": user.get("avatar")
-    }
+    return user_card(user)
+
+@router.post("/batch")
+async def get_users_batch(batch: UserBatch, current_user: str = Depends(get_current_user)):
+    return await user_cards(batch.ids)
 
 @router.get("/{user_id}")
 async def get_user(user_id: str, current_user: str = Depends(get_current_user)):
-    db = get_database()
-    try:
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
-    except:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
+    user = await get_storage().users.get(user_id)
     
     if not user:
         raise HTTPException(
@@ -95,12 +103,7 @@ async def get_user(user_id: str, current_user: str = Depends(get_current_user)):
             detail="User not found"
         )
     
-    return {
-        "id": str(user["_id"]),
-        "username": user["username"],
-        "email": user["email"],
-        "avatar": user.get("avatar")
-    }
+    return user_card(user)
 
 
 @router.patch('/me')
@@ -108,19 +111,78 @@ async def update_current_user(info: UserUpdate, current_user: str = Depends(get_
     db = get_database()
 
     update_fields = {}
+    unset_fields = {}
     if info.username:
         if len(info.username.strip()) < 3:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Username too short')
         update_fields['username'] = info.username.strip()
-    if info.avatar is not None:
-        update_fields['avatar'] = info.avatar
+    if info.avatar == '':
+        unset_fields = {'avatar_id': '', 'avatar': ''}
+    elif info.avatar is not None:
+        # Legacy clients send the image inline as a data URL
+        try:
+            update_fields['avatar_id'] = await avatar_store.save_avatar(avatar_store.decode_data_url(info.avatar))
+        except avatar_store.InvalidAvatar as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        unset_fields = {'avatar': ''}
 
-    if not update_fields:
+    if not update_fields and not unset_fields:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='No fields to update')
 
-    result = await db.users.update_one({"_id": ObjectId(current_user)}, {"$set": update_fields})
+    update = {}
+    if update_fields:
+        update['$set'] = update_fields
+    if unset_fields:
+        update['$unset'] = unset_fields
+    result = await db.users.update_one({"_id": ObjectId(current_user)}, update)
     if result.matched_count == 0:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
 
-    user = await db.users.find_one({"_id": ObjectId(current_user)})
-    return {"id": str(user["_id"]), "username": user["username"], "email": user["email"], "avatar": user.get('avatar')}
+    if 'username' in update_fields:
+        await _invalidate_cached_lists(db, current_user)
+
+    user = await db.users.find_one({"_id": ObjectId(current_user)}, USER_CARD_PROJECTION)
+    return user_card(user)
+
+
+@router.put('/me/avatar')
+async def upload_avatar(file: UploadFile = File(...), current_user: str = Depends(get_current_user)):
+    db = get_database()
+
+    data = await file.read(avatar_store.MAX_AVATAR_BYTES + 1)
+    try:
+        avatar_id = await avatar_store.save_avatar(data)
+    except avatar_store.InvalidAvatar as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    result = await db.users.update_one(
+        {"_id": ObjectId(current_user)},
+        {"$set": {"avatar_id": avatar_id}, "$unset": {"avatar": ""}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
+
+    user = await db.users.find_one({"_id": ObjectId(current_user)}, USER_CARD_PROJECTION)
+    return user_card(user)
+
+
+@router.get('/avatars/{avatar_id}/{size}')
+async def get_avatar(avatar_id: str, size: int):
+    # Public and content-addressed, so <img> tags can load it directly and
+    # browsers never need to revalidate
+    path = avatar_store.avatar_path(avatar_id, size)
+    if not path:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Avatar not found')
+
+    return FileResponse(
+        path,
+        media_type='image/webp',
+        headers={'Cache-Control': 'public, max-age=31536000, immutable'}
+    )
+
+
+async def _invalidate_cached_lists(db, user_id: str):
+    # The username shows up in the friends list of every friend and in the
+    # member list of every group this user belongs to
+    await response_cache.invalidate(FRIENDS, await friend_graph.friends_of(db, user_id))
+    await response_cache.invalidate(GROUP, await group_members.group_ids_for_user(db, user_id))
@@ -0,0 +1,226 @@
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from collections import Counter
+from datetime import datetime
+from typing import Awaitable, Callable, List, Optional, Tuple
+import asyncio
+import math
+import re
+
+import message_store
+
+# Inverted index over message content. Every (term, message) pair is one
+# posting in db.message_terms, carrying enough of the conversation to
+# enforce access without touching db.messages:
+#   - direct messages store both participants in `members`
+#   - group messages store the conversation key in `conv`
+# Document frequencies live in db.term_stats and are maintained with the
+# postings, so ranking never has to count across the collection.
+
+MAX_TERM_LENGTH = 40
+MAX_QUERY_TERMS = 8
+MAX_RESULTS_WINDOW = 1000
+BACKFILL_BATCH_SIZE = 1000
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+async def ensure_indexes(db):
+    await db.message_terms.create_index([("term", ASCENDING), ("members", ASCENDING), ("ts", DESCENDING)])
+    await db.message_terms.create_index([("term", ASCENDING), ("conv", ASCENDING), ("ts", DESCENDING)])
+    await db.message_terms.create_index([("msg_id", ASCENDING)])
+    # Retention drops postings oldest first
+    await db.message_terms.create_index([("ts", ASCENDING), ("msg_id", ASCENDING)])
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if len(t) <= MAX_TERM_LENGTH]
+
+
+async def index_message(db, message: dict):
+    counts = Counter(tokenize(message.get("content") or ""))
+    if not counts:
+        return
+
+    conv = message_store.conversation_key(message)
+    members = [] if message.get("group_id") else sorted({message["sender_id"], message["recipient_id"]})
+    await db.message_terms.insert_many([
+        {
+            "term": term,
+            "conv": conv,
+            "members": members,
+            "msg_id": message["_id"],
+            "ts": message["timestamp"],
+            "tf": tf
+        }
+        for term, tf in counts.items()
+    ], ordered=False)
+    await db.term_stats.bulk_write([
+        UpdateOne({"_id": term}, {"$inc": {"df": 1}}, upsert=True)
+        for term in counts
+    ], ordered=False)
+    await db.search_stats.update_one({"_id": "messages"}, {"$inc": {"count": 1}}, upsert=True)
+
+
+def parse_query(q: str, prefix_last: bool = True) -> List[Tuple[str, bool]]:
+    # Returns (token, is_prefix) pairs; a trailing * always marks a prefix
+    parts = q.lower().split()
+    terms: List[Tuple[str, bool]] = []
+    for i, part in enumerate(parts):
+        tokens = tokenize(part)
+        if not tokens:
+            continue
+        is_prefix = part.endswith("*") or (prefix_last and i == len(parts) - 1)
+        terms.extend((token, False) for token in tokens[:-1])
+        terms.append((tokens[-1], is_prefix))
+    return list(dict.fromkeys(terms))[:MAX_QUERY_TERMS]
+
+
+async def _term_weight(db, token: str, is_prefix: bool, total: int) -> float:
+    if is_prefix:
+        pipeline = [
+            {"$match": {"_id": {"$regex": "^" + re.escape(token)}}},
+            {"$group": {"_id": None, "df": {"$sum": "$df"}}}
+        ]
+        stats = await db.term_stats.aggregate(pipeline).to_list(1)
+        df = stats[0]["df"] if stats else 0
+    else:
+        stats = await db.term_stats.find_one({"_id": token})
+        df = stats["df"] if stats else 0
+    return math.log(1 + total / (1 + df))
+
+
+def _term_match(token: str, is_prefix: bool) -> dict:
+    if is_prefix:
+        return {"term": {"$regex": "^" + re.escape(token)}}
+    return {"term": token}
+
+
+async def search(
+    db,
+    user_id: str,
+    group_ids: List[str],
+    q: str,
+    offset: int = 0,
+    limit: int = 20,
+    prefix: bool = True
+) -> List[dict]:
+    terms = parse_query(q, prefix_last=prefix)
+    if not terms or offset >= MAX_RESULTS_WINDOW:
+        return []
+
+    stats = await db.search_stats.find_one({"_id": "messages"})
+    total = stats["count"] if stats else 0
+    weights = await asyncio.gather(*[_term_weight(db, t, p, total) for t, p in terms])
+
+    # Check each posting against every query term, since one posting can
+    # satisfy several ("hello hel"); it counts once for each term it
+    # matched, and only messages that matched every term are kept
+    hits = []
+    for i, ((token, is_prefix), weight) in enumerate(zip(terms, weights)):
+        if is_prefix:
+            case = {"$eq": [{"$substrCP": ["$term", 0, len(token)]}, token]}
+        else:
+            case = {"$eq": ["$term", token]}
+        hits.append({"$cond": [case, [{"i": i, "w": weight}], []]})
+
+    access = [{"members": user_id}]
+    if group_ids:
+        access.append({"conv": {"$in": [message_store.group_conversation_key(g) for g in group_ids]}})
+
+    pipeline = [
+        {"$match": {"$and": [
+            {"$or": [_term_match(t, p) for t, p in terms]},
+            {"$or": access}
+        ]}},
+        {"$addFields": {"hit": {"$concatArrays": hits}}},
+        {"$unwind": "$hit"},
+        {"$group": {
+            "_id": "$msg_id",
+            "conv": {"$first": "$conv"},
+            "ts": {"$first": "$ts"},
+            "matched": {"$addToSet": "$hit.i"},
+            "score": {"$sum": {"$multiply": [{"$add": [1, {"$ln": "$tf"}]}, "$hit.w"]}}
+        }},
+        {"$match": {"matched": {"$size": len(terms)}}},
+        {"$sort": {"score": -1, "ts": -1}},
+        {"$skip": offset},
+        {"$limit": limit}
+    ]
+    return await db.message_terms.aggregate(pipeline, allowDiskUse=True).to_list(limit)
+
+
+async def expire_before(
+    db,
+    cutoff: datetime,
+    batch_size: int,
+    after_batch: Optional[Callable[[int], Awaitable[None]]] = None
+) -> int:
+    # Drops the postings of messages sent before cutoff, batch by batch,
+    # and takes them out of the document frequencies and message count
+    removed = 0
+    last_msg_id = None
+    while True:
+        batch = await db.message_terms.find(
+            {"ts": {"$lt": cutoff}}, {"term": 1, "msg_id": 1}
+        ).sort([("ts", ASCENDING), ("msg_id", ASCENDING)]).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        await db.message_terms.delete_many({"_id": {"$in": [posting["_id"] for posting in batch]}})
+        await db.term_stats.bulk_write([
+            UpdateOne({"_id": term}, {"$inc": {"df": -count}})
+            for term, count in Counter(posting["term"] for posting in batch).items()
+        ], ordered=False)
+        # A message whose postings straddle two batches is counted once
+        msg_ids = list(dict.fromkeys(posting["msg_id"] for posting in batch))
+        messages = len(msg_ids) - (msg_ids[0] == last_msg_id)
+        last_msg_id = msg_ids[-1]
+        await db.search_stats.update_one({"_id": "messages"}, {"$inc": {"count": -messages}})
+
+        removed += len(batch)
+        if after_batch:
+            await after_batch(len(batch))
+        if len(batch) < batch_size:
+            break
+
+    await db.term_stats.delete_many({"df": {"$lte": 0}})
+    return removed
+
+
+async def backfill(db, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    # Index messages written before search existed, resuming from the last
+    # message id recorded in search_stats
+    state = await db.search_stats.find_one({"_id": "backfill"})
+    query = {}
+    if state:
+        query["_id"] = {"$gt": state["last_id"]}
+
+    indexed = 0
+    async for message in db.messages.find(query).sort("_id", ASCENDING):
+        if not await db.message_terms.find_one({"msg_id": message["_id"]}, {"_id": 1}):
+            await index_message(db, message)
+        indexed += 1
+        if indexed % batch_size == 0:
+            await db.search_stats.update_one(
+                {"_id": "backfill"}, {"$set": {"last_id": message["_id"]}}, upsert=True
+            )
+            print(f"Indexed {indexed} messages")
+
+    if indexed:
+        await db.search_stats.update_one(
+            {"_id": "backfill"}, {"$set": {"last_id": message["_id"]}}, upsert=True
+        )
+    return indexed
+
+
+if __name__ == "__main__":
+    from database import connect_to_mongo, close_mongo_connection, get_database
+
+    async def main():
+        await connect_to_mongo()
+        db = get_database()
+        await ensure_indexes(db)
+        print(f"✅ Backfill complete: {await backfill(db)} messages checked")
+        await close_mongo_connection()
+
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Dict
+import asyncio
+import os
+import time
+
+from PIL import Image
+from friend_graph import friend_graph
+
+# Startup phases and warmup. Each phase is timed and printed, and the app
+# only reports ready (GET /readyz) once all of them have finished, so a new
+# replica doesn't take traffic while its connection pool and caches are
+# still cold.
+
+# Concurrent pings used to open connections in the Mongo pool up front
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "10"))
+# Users active within this window get their friend lists preloaded
+WARMUP_ACTIVE_HOURS = int(os.getenv("WARMUP_ACTIVE_HOURS", "1"))
+WARMUP_MAX_USERS = 5000
+WARMUP_BATCH = 500
+
+
+class Startup:
+    def __init__(self):
+        self.ready = False
+        self.phases: Dict[str, float] = {}
+        self._started = time.perf_counter()
+
+    @asynccontextmanager
+    async def phase(self, name: str):
+        started = time.perf_counter()
+        yield
+        elapsed = (time.perf_counter() - started) * 1000
+        self.phases[name] = round(elapsed, 1)
+        print(f"Startup: {name} took {elapsed:.0f} ms")
+
+    def finish(self):
+        total = (time.perf_counter() - self._started) * 1000
+        self.phases["total"] = round(total, 1)
+        self.ready = True
+        print(f"Startup: ready after {total:.0f} ms")
+
+
+startup = Startup()
+
+
+async def fill_connection_pool(client):
+    # Pings issued together each need their own connection
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(WARMUP_CONNECTIONS)))
+
+
+async def prime_caches(db):
+    # Load the friend graph for recently active users, in batches, so their
+    # first presence broadcast and friend checks don't wait on Mongo
+    since = datetime.utcnow() - timedelta(hours=WARMUP_ACTIVE_HOURS)
+    active = await db.messages.aggregate([
+        {"$match": {"timestamp": {"$gte": since}}},
+        {"$group": {"_id": "$sender_id"}},
+        {"$limit": WARMUP_MAX_USERS}
+    ]).to_list(WARMUP_MAX_USERS)
+    user_ids = [doc["_id"] for doc in active]
+    for i in range(0, len(user_ids), WARMUP_BATCH):
+        await friend_graph.preload(db, user_ids[i:i + WARMUP_BATCH])
+    return len(user_ids)
+
+
+def preload_modules():
+    # Pillow imports its image format plugins on first use; do it now
+    # rather than in the first avatar upload
+    Image.init()
@@ -0,0 +1,253 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+import os
+
+from database import get_database
+
+# Repository layer over the core data: users, friendships, friend requests,
+# groups with their members, and messages. Code that goes through
+# get_storage() doesn't depend on the engine behind it:
+#
+#   mongo   - the Motor database opened by connect_to_mongo (what the app runs on)
+#   memory  - plain dicts in this process, for tests and benchmarks
+#   sqlite  - a single SQLite file, for small single-node setups
+#
+# The server opens the engine named by STORAGE_BACKEND when it starts.
+# Only sign-up, sign-in, user lookups and the message send checks go
+# through the repositories so far; every other route still uses Motor
+# directly, so the server only accepts "mongo" there. The memory and SQLite
+# engines are for tests, benchmarks and code written against the
+# repositories alone.
+#
+# Every engine returns records as dicts keyed by a string "id" (ObjectId
+# hex, so ids sort by creation time everywhere) and must pass
+# test_storage.py, which runs the same checks against each of them.
+#
+# Records:
+#   user            id, username, email, avatar_id, created_at
+#   friend request  id, from_user_id, to_user_id, status, created_at
+#   group           id, name, created_by, member_count, created_at
+#   message         id, sender_id, recipient_id, group_id, content,
+#                   timestamp, status, client_message_id
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo").lower()
+SERVER_BACKENDS = ("mongo",)
+SQLITE_PATH = os.getenv("SQLITE_PATH", "chatterbox.db")
+HISTORY_PAGE_SIZE = 50
+MEMBER_PAGE_SIZE = 100
+
+
+class DuplicateError(Exception):
+    pass
+
+
+def pair_key(user_id: str, other_id: str) -> str:
+    # Same key whichever side of the pair sends or accepts
+    return ":".join(sorted([user_id, other_id]))
+
+
+def utcnow() -> datetime:
+    # MongoDB keeps milliseconds, so every engine does
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+class UserRepository(ABC):
+    @abstractmethod
+    async def create(self, username: str, email: str, password_hash: str) -> dict:
+        # Raises DuplicateError when the username or email is taken
+        ...
+
+    @abstractmethod
+    async def get(self, user_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def get_many(self, user_ids: Iterable[str]) -> List[dict]:
+        # In the order given, without repeats; unknown ids are left out
+        ...
+
+    @abstractmethod
+    async def get_login(self, username: str) -> Optional[dict]:
+        # The only lookup that returns the password hash, as {id, username, password}
+        ...
+
+    @abstractmethod
+    async def search(self, query: str, exclude_id: Optional[str] = None, limit: int = 20) -> List[dict]:
+        # Case-insensitive substring match on username or email
+        ...
+
+    @abstractmethod
+    async def set_avatar(self, user_id: str, avatar_id: Optional[str]) -> bool:
+        ...
+
+
+class FriendshipRepository(ABC):
+    @abstractmethod
+    async def add(self, user_id: str, other_id: str) -> bool:
+        # False if they were friends already
+        ...
+
+    @abstractmethod
+    async def remove(self, user_id: str, other_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def are_friends(self, user_id: str, other_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def friends_of(self, user_id: str) -> List[str]:
+        # Sorted friend ids
+        ...
+
+
+class FriendRequestRepository(ABC):
+    @abstractmethod
+    async def create(self, from_user_id: str, to_user_id: str) -> Optional[dict]:
+        # None if the pair already has a request, in either direction and
+        # whatever its status
+        ...
+
+    @abstractmethod
+    async def get(self, request_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def pending_for(self, user_id: str) -> List[dict]:
+        # Pending requests sent to the user, oldest first
+        ...
+
+    @abstractmethod
+    async def set_status(self, request_ids: Iterable[str], to_user_id: str, status: str,
+                         from_status: str = "pending") -> List[dict]:
+        # Moves the user's requests in `from_status` to `status` and returns
+        # every one of them now in `status`, so a retry returns the same
+        ...
+
+    @abstractmethod
+    async def delete_pair(self, user_id: str, other_id: str) -> bool:
+        ...
+
+
+class GroupRepository(ABC):
+    @abstractmethod
+    async def create(self, name: str, created_by: str, member_ids: Iterable[str] = ()) -> dict:
+        # The creator is always a member
+        ...
+
+    @abstractmethod
+    async def get(self, group_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def rename(self, group_id: str, name: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def add_members(self, group_id: str, user_ids: Iterable[str]) -> int:
+        # Number actually added; member_count moves by the same amount
+        ...
+
+    @abstractmethod
+    async def remove_members(self, group_id: str, user_ids: Iterable[str]) -> int:
+        ...
+
+    @abstractmethod
+    async def is_member(self, group_id: str, user_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def member_ids(self, group_id: str, after: Optional[str] = None,
+                         limit: int = MEMBER_PAGE_SIZE) -> List[str]:
+        # One page of member ids in id order, starting after `after`
+        ...
+
+    @abstractmethod
+    async def group_ids_for(self, user_id: str) -> List[str]:
+        ...
+
+
+class MessageRepository(ABC):
+    @abstractmethod
+    async def add(self, sender_id: str, content: str, recipient_id: Optional[str] = None,
+                  group_id: Optional[str] = None, client_message_id: Optional[str] = None) -> Tuple[dict, bool]:
+        # Returns the message and whether it was created; a repeated
+        # client_message_id from the same sender returns the original
+        ...
+
+    @abstractmethod
+    async def get(self, message_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def conversation(self, user_id: str, other_id: str, before: Optional[str] = None,
+                           limit: int = HISTORY_PAGE_SIZE) -> List[dict]:
+        # Direct messages between the pair older than `before`, newest first
+        ...
+
+    @abstractmethod
+    async def group_history(self, group_id: str, before: Optional[str] = None,
+                            limit: int = HISTORY_PAGE_SIZE) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def set_status(self, message_id: str, status: str) -> bool:
+        ...
+
+
+class Storage:
+    users: UserRepository
+    friendships: FriendshipRepository
+    friend_requests: FriendRequestRepository
+    groups: GroupRepository
+    messages: MessageRepository
+
+    async def setup(self):
+        # Create tables or indexes; safe to call on every start
+        pass
+
+    async def close(self):
+        pass
+
+
+def open_storage(backend: str, **options) -> Storage:
+    if backend == "memory":
+        from storage_memory import MemoryStorage
+        return MemoryStorage()
+    if backend == "sqlite":
+        from storage_sqlite import SqliteStorage
+        return SqliteStorage(options.get("path", SQLITE_PATH))
+    if backend == "mongo":
+        from storage_mongo import MongoStorage
+        return MongoStorage(options.get("db") or get_database())
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def open_server_storage(db) -> Storage:
+    # The engine named by STORAGE_BACKEND, for the server's lifespan
+    if STORAGE_BACKEND not in SERVER_BACKENDS:
+        raise RuntimeError(
+            f"STORAGE_BACKEND={STORAGE_BACKEND} can't run the server: most routes still need "
+            f"MongoDB, so it must be one of {', '.join(SERVER_BACKENDS)}"
+        )
+    return open_storage(STORAGE_BACKEND, db=db)
+
+
+_storage: Optional[Storage] = None
+
+
+def set_storage(storage: Optional[Storage]):
+    # Swap the engine, e.g. for an in-memory one in tests
+    global _storage
+    _storage = storage
+
+
+def get_storage() -> Storage:
+    if _storage is not None:
+        return _storage
+    # Outside the server's lifespan, e.g. in scripts: wraps whatever
+    # database connect_to_mongo opened; cheap to build
+    from storage_mongo import MongoStorage
+    return MongoStorage(get_database())
@@ -0,0 +1,251 @@
+from bson import ObjectId
+from typing import Dict, List, Optional, Set, Tuple
+
+from storage import (
+    DuplicateError, FriendRequestRepository, FriendshipRepository, GroupRepository,
+    HISTORY_PAGE_SIZE, MEMBER_PAGE_SIZE, MessageRepository, Storage, UserRepository,
+    pair_key, utcnow
+)
+
+# In-memory storage engine. Everything lives in dicts of this process and
+# is lost on exit; meant for tests and benchmarks. Methods never await, so
+# each one is atomic on the event loop. Records are copied on the way out
+# so callers can't change stored data by accident.
+
+
+def _new_id() -> str:
+    return str(ObjectId())
+
+
+class MemoryUsers(UserRepository):
+    def __init__(self):
+        self.users: Dict[str, dict] = {}
+        self.passwords: Dict[str, str] = {}
+
+    async def create(self, username, email, password_hash):
+        for user in self.users.values():
+            if user["username"] == username or user["email"] == email:
+                raise DuplicateError("Username or email already registered")
+        user = {"id": _new_id(), "username": username, "email": email, "avatar_id": None, "created_at": utcnow()}
+        self.users[user["id"]] = user
+        self.passwords[user["id"]] = password_hash
+        return dict(user)
+
+    async def get(self, user_id):
+        user = self.users.get(user_id)
+        return dict(user) if user else None
+
+    async def get_many(self, user_ids):
+        return [dict(self.users[user_id]) for user_id in dict.fromkeys(user_ids) if user_id in self.users]
+
+    async def get_login(self, username):
+        for user in self.users.values():
+            if user["username"] == username:
+                return {"id": user["id"], "username": username, "password": self.passwords[user["id"]]}
+        return None
+
+    async def search(self, query, exclude_id=None, limit=20):
+        query = query.lower()
+        found = []
+        for user in self.users.values():
+            if user["id"] != exclude_id and (query in user["username"].lower() or query in user["email"].lower()):
+                found.append(dict(user))
+                if len(found) == limit:
+                    break
+        return found
+
+    async def set_avatar(self, user_id, avatar_id):
+        if user_id not in self.users:
+            return False
+        self.users[user_id]["avatar_id"] = avatar_id
+        return True
+
+
+class MemoryFriendships(FriendshipRepository):
+    def __init__(self):
+        self.friends: Dict[str, Set[str]] = {}
+
+    async def add(self, user_id, other_id):
+        if other_id in self.friends.get(user_id, ()):
+            return False
+        self.friends.setdefault(user_id, set()).add(other_id)
+        self.friends.setdefault(other_id, set()).add(user_id)
+        return True
+
+    async def remove(self, user_id, other_id):
+        if other_id not in self.friends.get(user_id, ()):
+            return False
+        self.friends[user_id].discard(other_id)
+        self.friends[other_id].discard(user_id)
+        return True
+
+    async def are_friends(self, user_id, other_id):
+        return other_id in self.friends.get(user_id, ())
+
+    async def friends_of(self, user_id):
+        return sorted(self.friends.get(user_id, ()))
+
+
+class MemoryFriendRequests(FriendRequestRepository):
+    def __init__(self):
+        self.requests: Dict[str, dict] = {}
+        self.by_pair: Dict[str, str] = {}
+
+    async def create(self, from_user_id, to_user_id):
+        key = pair_key(from_user_id, to_user_id)
+        if key in self.by_pair:
+            return None
+        request = {
+            "id": _new_id(),
+            "from_user_id": from_user_id,
+            "to_user_id": to_user_id,
+            "status": "pending",
+            "created_at": utcnow()
+        }
+        self.requests[request["id"]] = request
+        self.by_pair[key] = request["id"]
+        return dict(request)
+
+    async def get(self, request_id):
+        request = self.requests.get(request_id)
+        return dict(request) if request else None
+
+    async def pending_for(self, user_id):
+        return [
+            dict(request) for request in self.requests.values()
+            if request["to_user_id"] == user_id and request["status"] == "pending"
+        ]
+
+    async def set_status(self, request_ids, to_user_id, status, from_status="pending"):
+        changed = []
+        for request_id in dict.fromkeys(request_ids):
+            request = self.requests.get(request_id)
+            if request is None or request["to_user_id"] != to_user_id:
+                continue
+            if request["status"] == from_status:
+                request["status"] = status
+            if request["status"] == status:
+                changed.append(dict(request))
+        return changed
+
+    async def delete_pair(self, user_id, other_id):
+        request_id = self.by_pair.pop(pair_key(user_id, other_id), None)
+        if request_id is None:
+            return False
+        del self.requests[request_id]
+        return True
+
+
+class MemoryGroups(GroupRepository):
+    def __init__(self):
+        self.groups: Dict[str, dict] = {}
+        self.members: Dict[str, Set[str]] = {}
+
+    async def create(self, name, created_by, member_ids=()):
+        group = {"id": _new_id(), "name": name, "created_by": created_by, "member_count": 0, "created_at": utcnow()}
+        self.groups[group["id"]] = group
+        self.members[group["id"]] = set()
+        await self.add_members(group["id"], [created_by, *member_ids])
+        return dict(group)
+
+    async def get(self, group_id):
+        group = self.groups.get(group_id)
+        return dict(group) if group else None
+
+    async def rename(self, group_id, name):
+        if group_id not in self.groups:
+            return False
+        self.groups[group_id]["name"] = name
+        return True
+
+    async def add_members(self, group_id, user_ids):
+        if group_id not in self.groups:
+            return 0
+        members = self.members[group_id]
+        added = set(user_ids) - members
+        members |= added
+        self.groups[group_id]["member_count"] += len(added)
+        return len(added)
+
+    async def remove_members(self, group_id, user_ids):
+        if group_id not in self.groups:
+            return 0
+        members = self.members[group_id]
+        removed = set(user_ids) & members
+        members -= removed
+        self.groups[group_id]["member_count"] -= len(removed)
+        return len(removed)
+
+    async def is_member(self, group_id, user_id):
+        return user_id in self.members.get(group_id, ())
+
+    async def member_ids(self, group_id, after=None, limit=MEMBER_PAGE_SIZE):
+        members = sorted(self.members.get(group_id, ()))
+        if after is not None:
+            members = [user_id for user_id in members if user_id > after]
+        return members[:limit]
+
+    async def group_ids_for(self, user_id):
+        return [group_id for group_id, members in self.members.items() if user_id in members]
+
+
+class MemoryMessages(MessageRepository):
+    def __init__(self):
+        # Kept in id order, which is also send order
+        self.messages: Dict[str, dict] = {}
+        self.by_client_id: Dict[Tuple[str, str], str] = {}
+
+    async def add(self, sender_id, content, recipient_id=None, group_id=None, client_message_id=None):
+        if client_message_id:
+            original = self.by_client_id.get((sender_id, client_message_id))
+            if original:
+                return dict(self.messages[original]), False
+        message = {
+            "id": _new_id(),
+            "sender_id": sender_id,
+            "recipient_id": recipient_id,
+            "group_id": group_id,
+            "content": content,
+            "timestamp": utcnow(),
+            "status": "sent",
+            "client_message_id": client_message_id
+        }
+        self.messages[message["id"]] = message
+        if client_message_id:
+            self.by_client_id[(sender_id, client_message_id)] = message["id"]
+        return dict(message), True
+
+    async def get(self, message_id):
+        message = self.messages.get(message_id)
+        return dict(message) if message else None
+
+    def _newest(self, matches, before: Optional[str], limit: int) -> List[dict]:
+        found = []
+        for message in reversed(self.messages.values()):
+            if (before is None or message["id"] < before) and matches(message):
+                found.append(dict(message))
+                if len(found) == limit:
+                    break
+        return found
+
+    async def conversation(self, user_id, other_id, before=None, limit=HISTORY_PAGE_SIZE):
+        pair = {(user_id, other_id), (other_id, user_id)}
+        return self._newest(lambda m: (m["sender_id"], m["recipient_id"]) in pair, before, limit)
+
+    async def group_history(self, group_id, before=None, limit=HISTORY_PAGE_SIZE):
+        return self._newest(lambda m: m["group_id"] == group_id, before, limit)
+
+    async def set_status(self, message_id, status):
+        if message_id not in self.messages:
+            return False
+        self.messages[message_id]["status"] = status
+        return True
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.users = MemoryUsers()
+        self.friendships = MemoryFriendships()
+        self.friend_requests = MemoryFriendRequests()
+        self.groups = MemoryGroups()
+        self.messages = MemoryMessages()
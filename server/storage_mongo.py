@@ -0,0 +1,312 @@
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from typing import List, Optional
+import re
+
+import group_members
+import message_store
+from storage import (
+    DuplicateError, FriendRequestRepository, FriendshipRepository, GroupRepository,
+    HISTORY_PAGE_SIZE, MEMBER_PAGE_SIZE, MessageRepository, Storage, UserRepository,
+    pair_key, utcnow
+)
+
+# MongoDB storage engine over the collections the app already uses.
+# Membership goes through group_members and history through message_store,
+# so the member_count, read receipts and cold-tier buckets keep working.
+
+USER_PROJECTION = {"username": 1, "email": 1, "avatar_id": 1, "avatar": 1, "created_at": 1}
+
+
+def _oid(value: str) -> Optional[ObjectId]:
+    return ObjectId(value) if ObjectId.is_valid(value) else None
+
+
+def _oids(values) -> List[ObjectId]:
+    return [ObjectId(value) for value in values if ObjectId.is_valid(value)]
+
+
+def _user(doc: dict) -> dict:
+    user = {
+        "id": str(doc["_id"]),
+        "username": doc["username"],
+        "email": doc["email"],
+        "avatar_id": doc.get("avatar_id"),
+        "created_at": doc.get("created_at")
+    }
+    # External avatar URLs from before the avatar store, see avatar_store.avatar_url
+    if doc.get("avatar"):
+        user["avatar"] = doc["avatar"]
+    return user
+
+
+def _request(doc: dict) -> dict:
+    return {
+        "id": str(doc["_id"]),
+        "from_user_id": doc["from_user_id"],
+        "to_user_id": doc["to_user_id"],
+        "status": doc["status"],
+        "created_at": doc.get("created_at")
+    }
+
+
+def _group(doc: dict) -> dict:
+    return {
+        "id": str(doc["_id"]),
+        "name": doc["name"],
+        "created_by": doc["created_by"],
+        "member_count": doc.get("member_count", 0),
+        "created_at": doc.get("created_at")
+    }
+
+
+def _message(doc: dict) -> dict:
+    return {
+        "id": str(doc["_id"]),
+        "sender_id": doc["sender_id"],
+        "recipient_id": doc.get("recipient_id"),
+        "group_id": doc.get("group_id"),
+        "content": doc["content"],
+        "timestamp": doc["timestamp"],
+        "status": doc.get("status", "sent"),
+        "client_message_id": doc.get("client_message_id")
+    }
+
+
+class MongoUsers(UserRepository):
+    def __init__(self, db):
+        self.db = db
+
+    async def create(self, username, email, password_hash):
+        existing = await self.db.users.find_one({"$or": [{"username": username}, {"email": email}]}, {"_id": 1})
+        if existing:
+            raise DuplicateError("Username or email already registered")
+        doc = {"username": username, "email": email, "password": password_hash, "created_at": utcnow()}
+        try:
+            await self.db.users.insert_one(doc)
+        except DuplicateKeyError:
+            raise DuplicateError("Username or email already registered")
+        return _user(doc)
+
+    async def get(self, user_id):
+        oid = _oid(user_id)
+        doc = await self.db.users.find_one({"_id": oid}, USER_PROJECTION) if oid else None
+        return _user(doc) if doc else None
+
+    async def get_many(self, user_ids):
+        user_ids = list(dict.fromkeys(user_ids))
+        found = {}
+        async for doc in self.db.users.find({"_id": {"$in": _oids(user_ids)}}, USER_PROJECTION):
+            found[str(doc["_id"])] = _user(doc)
+        return [found[user_id] for user_id in user_ids if user_id in found]
+
+    async def get_login(self, username):
+        doc = await self.db.users.find_one({"username": username}, {"username": 1, "password": 1})
+        return {"id": str(doc["_id"]), "username": doc["username"], "password": doc["password"]} if doc else None
+
+    async def search(self, query, exclude_id=None, limit=20):
+        pattern = {"$regex": re.escape(query), "$options": "i"}
+        conditions = {"$or": [{"username": pattern}, {"email": pattern}]}
+        if exclude_id and ObjectId.is_valid(exclude_id):
+            conditions["_id"] = {"$ne": ObjectId(exclude_id)}
+        docs = await self.db.users.find(conditions, USER_PROJECTION).sort("_id", 1).limit(limit).to_list(limit)
+        return [_user(doc) for doc in docs]
+
+    async def set_avatar(self, user_id, avatar_id):
+        oid = _oid(user_id)
+        if oid is None:
+            return False
+        result = await self.db.users.update_one({"_id": oid}, {"$set": {"avatar_id": avatar_id}})
+        return result.matched_count > 0
+
+
+class MongoFriendships(FriendshipRepository):
+    def __init__(self, db):
+        self.db = db
+
+    async def add(self, user_id, other_id):
+        key = pair_key(user_id, other_id)
+        try:
+            result = await self.db.friendships.update_one(
+                {"pair_key": key},
+                {"$setOnInsert": {"pair_key": key, "user1_id": user_id, "user2_id": other_id, "created_at": utcnow()}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return result.upserted_id is not None
+
+    async def remove(self, user_id, other_id):
+        result = await self.db.friendships.delete_one({"pair_key": pair_key(user_id, other_id)})
+        return result.deleted_count > 0
+
+    async def are_friends(self, user_id, other_id):
+        doc = await self.db.friendships.find_one({"pair_key": pair_key(user_id, other_id)}, {"_id": 1})
+        return doc is not None
+
+    async def friends_of(self, user_id):
+        friends = set()
+        async for doc in self.db.friendships.find(
+            {"$or": [{"user1_id": user_id}, {"user2_id": user_id}]},
+            {"user1_id": 1, "user2_id": 1}
+        ):
+            friends.add(doc["user2_id"] if doc["user1_id"] == user_id else doc["user1_id"])
+        return sorted(friends)
+
+
+class MongoFriendRequests(FriendRequestRepository):
+    def __init__(self, db):
+        self.db = db
+
+    async def create(self, from_user_id, to_user_id):
+        doc = {
+            "pair_key": pair_key(from_user_id, to_user_id),
+            "from_user_id": from_user_id,
+            "to_user_id": to_user_id,
+            "status": "pending",
+            "created_at": utcnow()
+        }
+        try:
+            result = await self.db.friend_requests.update_one(
+                {"pair_key": doc["pair_key"]}, {"$setOnInsert": doc}, upsert=True
+            )
+        except DuplicateKeyError:
+            return None
+        if result.upserted_id is None:
+            return None
+        return _request({**doc, "_id": result.upserted_id})
+
+    async def get(self, request_id):
+        oid = _oid(request_id)
+        doc = await self.db.friend_requests.find_one({"_id": oid}) if oid else None
+        return _request(doc) if doc else None
+
+    async def pending_for(self, user_id):
+        cursor = self.db.friend_requests.find({"to_user_id": user_id, "status": "pending"}).sort("_id", 1)
+        return [_request(doc) async for doc in cursor]
+
+    async def set_status(self, request_ids, to_user_id, status, from_status="pending"):
+        request_ids = list(dict.fromkeys(request_ids))
+        query = {"_id": {"$in": _oids(request_ids)}, "to_user_id": to_user_id}
+        await self.db.friend_requests.update_many(
+            {**query, "status": from_status}, {"$set": {"status": status, "responded_at": utcnow()}}
+        )
+        found = {}
+        async for doc in self.db.friend_requests.find({**query, "status": status}):
+            found[str(doc["_id"])] = _request(doc)
+        return [found[request_id] for request_id in request_ids if request_id in found]
+
+    async def delete_pair(self, user_id, other_id):
+        result = await self.db.friend_requests.delete_one({"pair_key": pair_key(user_id, other_id)})
+        return result.deleted_count > 0
+
+
+class MongoGroups(GroupRepository):
+    def __init__(self, db):
+        self.db = db
+
+    async def create(self, name, created_by, member_ids=()):
+        doc = {"name": name, "created_by": created_by, "member_count": 0, "created_at": utcnow()}
+        result = await self.db.groups.insert_one(doc)
+        doc["member_count"] = await group_members.add_members(self.db, str(result.inserted_id), [created_by, *member_ids])
+        return _group(doc)
+
+    async def get(self, group_id):
+        oid = _oid(group_id)
+        doc = await self.db.groups.find_one({"_id": oid}) if oid else None
+        return _group(doc) if doc else None
+
+    async def rename(self, group_id, name):
+        oid = _oid(group_id)
+        if oid is None:
+            return False
+        result = await self.db.groups.update_one({"_id": oid}, {"$set": {"name": name}})
+        return result.matched_count > 0
+
+    async def add_members(self, group_id, user_ids):
+        if not await self.get(group_id):
+            return 0
+        return await group_members.add_members(self.db, group_id, user_ids)
+
+    async def remove_members(self, group_id, user_ids):
+        if _oid(group_id) is None:
+            return 0
+        return await group_members.remove_members(self.db, group_id, user_ids)
+
+    async def is_member(self, group_id, user_id):
+        return await group_members.is_member(self.db, group_id, user_id)
+
+    async def member_ids(self, group_id, after=None, limit=MEMBER_PAGE_SIZE):
+        return await group_members.list_member_ids(self.db, group_id, after=after, limit=limit)
+
+    async def group_ids_for(self, user_id):
+        return await group_members.group_ids_for_user(self.db, user_id)
+
+
+class MongoMessages(MessageRepository):
+    def __init__(self, db):
+        self.db = db
+
+    async def add(self, sender_id, content, recipient_id=None, group_id=None, client_message_id=None):
+        doc = {
+            "sender_id": sender_id,
+            "recipient_id": recipient_id,
+            "group_id": group_id,
+            "content": content,
+            "timestamp": utcnow(),
+            "status": "sent"
+        }
+        if client_message_id:
+            doc["client_message_id"] = client_message_id
+        try:
+            await self.db.messages.insert_one(doc)
+        except DuplicateKeyError:
+            original = await self.db.messages.find_one({"sender_id": sender_id, "client_message_id": client_message_id})
+            if original is None:
+                raise
+            return _message(original), False
+        return _message(doc), True
+
+    async def get(self, message_id):
+        oid = _oid(message_id)
+        doc = await self.db.messages.find_one({"_id": oid}) if oid else None
+        return _message(doc) if doc else None
+
+    async def _history(self, key: str, query: dict, before: Optional[str], limit: int) -> List[dict]:
+        docs = await message_store.fetch_history(self.db, key, query, limit, before)
+        return [_message(doc) for doc in docs]
+
+    async def conversation(self, user_id, other_id, before=None, limit=HISTORY_PAGE_SIZE):
+        query = {"$or": [
+            {"sender_id": user_id, "recipient_id": other_id},
+            {"sender_id": other_id, "recipient_id": user_id}
+        ]}
+        return await self._history(message_store.direct_conversation_key(user_id, other_id), query, before, limit)
+
+    async def group_history(self, group_id, before=None, limit=HISTORY_PAGE_SIZE):
+        return await self._history(message_store.group_conversation_key(group_id), {"group_id": group_id}, before, limit)
+
+    async def set_status(self, message_id, status):
+        oid = _oid(message_id)
+        if oid is None:
+            return False
+        result = await self.db.messages.update_one({"_id": oid}, {"$set": {"status": status}})
+        return result.matched_count > 0
+
+
+class MongoStorage(Storage):
+    def __init__(self, db):
+        self.db = db
+        self.users = MongoUsers(db)
+        self.friendships = MongoFriendships(db)
+        self.friend_requests = MongoFriendRequests(db)
+        self.groups = MongoGroups(db)
+        self.messages = MongoMessages(db)
+
+    async def setup(self):
+        # The same indexes the app creates at startup
+        import message_ingest
+        from routes import friends
+        await group_members.ensure_indexes(self.db)
+        await friends.ensure_indexes(self.db)
+        await message_ingest.ensure_indexes(self.db)
@@ -0,0 +1,437 @@
+from bson import ObjectId
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, List, Optional
+import asyncio
+import sqlite3
+
+from storage import (
+    DuplicateError, FriendRequestRepository, FriendshipRepository, GroupRepository,
+    HISTORY_PAGE_SIZE, MEMBER_PAGE_SIZE, MessageRepository, Storage, UserRepository,
+    pair_key, utcnow
+)
+
+# SQLite storage engine for small single-node setups. The standard sqlite3
+# module is synchronous, so every call runs on one dedicated thread that
+# owns the connection; the event loop only awaits the result. With a single
+# writer thread each method body is one transaction, and there are no
+# database-level locking surprises between coroutines.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    email TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL,
+    avatar_id TEXT,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS friendships (
+    pair_key TEXT PRIMARY KEY,
+    user1_id TEXT NOT NULL,
+    user2_id TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS friendships_user1 ON friendships (user1_id);
+CREATE INDEX IF NOT EXISTS friendships_user2 ON friendships (user2_id);
+
+CREATE TABLE IF NOT EXISTS friend_requests (
+    id TEXT PRIMARY KEY,
+    pair_key TEXT NOT NULL UNIQUE,
+    from_user_id TEXT NOT NULL,
+    to_user_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS friend_requests_to ON friend_requests (to_user_id, status, id);
+
+CREATE TABLE IF NOT EXISTS chat_groups (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    created_by TEXT NOT NULL,
+    member_count INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS group_members (
+    group_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (group_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS group_members_user ON group_members (user_id, group_id);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    sender_id TEXT NOT NULL,
+    recipient_id TEXT,
+    group_id TEXT,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    status TEXT NOT NULL,
+    client_message_id TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_direct ON messages (sender_id, recipient_id, id);
+CREATE INDEX IF NOT EXISTS messages_group ON messages (group_id, id) WHERE group_id IS NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS messages_client_id ON messages (sender_id, client_message_id)
+    WHERE client_message_id IS NOT NULL;
+"""
+
+USER_COLUMNS = "id, username, email, avatar_id, created_at"
+REQUEST_COLUMNS = "id, from_user_id, to_user_id, status, created_at"
+GROUP_COLUMNS = "id, name, created_by, member_count, created_at"
+MESSAGE_COLUMNS = "id, sender_id, recipient_id, group_id, content, timestamp, status, client_message_id"
+
+
+def _new_id() -> str:
+    return str(ObjectId())
+
+
+def _record(row: sqlite3.Row) -> dict:
+    record = dict(row)
+    for field in ("created_at", "timestamp"):
+        if record.get(field):
+            record[field] = datetime.fromisoformat(record[field])
+    return record
+
+
+def _like(query: str) -> str:
+    # Substring pattern with LIKE's wildcards taken literally
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _placeholders(values: List) -> str:
+    return ",".join("?" * len(values))
+
+
+class SqliteRepository:
+    def __init__(self, storage: "SqliteStorage"):
+        self.storage = storage
+
+    async def _run(self, fn: Callable[[sqlite3.Connection], object]):
+        return await self.storage.run(fn)
+
+
+class SqliteUsers(SqliteRepository, UserRepository):
+    async def create(self, username, email, password_hash):
+        user = {"id": _new_id(), "username": username, "email": email, "avatar_id": None, "created_at": utcnow()}
+
+        def insert(conn):
+            try:
+                conn.execute(
+                    "INSERT INTO users (id, username, email, password, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (user["id"], username, email, password_hash, user["created_at"].isoformat())
+                )
+            except sqlite3.IntegrityError:
+                raise DuplicateError("Username or email already registered")
+
+        await self._run(insert)
+        return user
+
+    async def get(self, user_id):
+        row = await self._run(lambda conn: conn.execute(
+            f"SELECT {USER_COLUMNS} FROM users WHERE id = ?", (user_id,)
+        ).fetchone())
+        return _record(row) if row else None
+
+    async def get_many(self, user_ids):
+        user_ids = list(dict.fromkeys(user_ids))
+        rows = await self._run(lambda conn: conn.execute(
+            f"SELECT {USER_COLUMNS} FROM users WHERE id IN ({_placeholders(user_ids)})", user_ids
+        ).fetchall())
+        found = {row["id"]: _record(row) for row in rows}
+        return [found[user_id] for user_id in user_ids if user_id in found]
+
+    async def get_login(self, username):
+        row = await self._run(lambda conn: conn.execute(
+            "SELECT id, username, password FROM users WHERE username = ?", (username,)
+        ).fetchone())
+        return dict(row) if row else None
+
+    async def search(self, query, exclude_id=None, limit=20):
+        pattern = _like(query)
+        rows = await self._run(lambda conn: conn.execute(
+            f"SELECT {USER_COLUMNS} FROM users "
+            "WHERE (username LIKE ? ESCAPE '\\' OR email LIKE ? ESCAPE '\\') AND id IS NOT ? ORDER BY id LIMIT ?",
+            (pattern, pattern, exclude_id, limit)
+        ).fetchall())
+        return [_record(row) for row in rows]
+
+    async def set_avatar(self, user_id, avatar_id):
+        cursor = await self._run(lambda conn: conn.execute(
+            "UPDATE users SET avatar_id = ? WHERE id = ?", (avatar_id, user_id)
+        ))
+        return cursor.rowcount > 0
+
+
+class SqliteFriendships(SqliteRepository, FriendshipRepository):
+    async def add(self, user_id, other_id):
+        cursor = await self._run(lambda conn: conn.execute(
+            "INSERT OR IGNORE INTO friendships (pair_key, user1_id, user2_id, created_at) VALUES (?, ?, ?, ?)",
+            (pair_key(user_id, other_id), user_id, other_id, utcnow().isoformat())
+        ))
+        return cursor.rowcount > 0
+
+    async def remove(self, user_id, other_id):
+        cursor = await self._run(lambda conn: conn.execute(
+            "DELETE FROM friendships WHERE pair_key = ?", (pair_key(user_id, other_id),)
+        ))
+        return cursor.rowcount > 0
+
+    async def are_friends(self, user_id, other_id):
+        row = await self._run(lambda conn: conn.execute(
+            "SELECT 1 FROM friendships WHERE pair_key = ?", (pair_key(user_id, other_id),)
+        ).fetchone())
+        return row is not None
+
+    async def friends_of(self, user_id):
+        rows = await self._run(lambda conn: conn.execute(
+            "SELECT user2_id AS friend_id FROM friendships WHERE user1_id = ? "
+            "UNION SELECT user1_id FROM friendships WHERE user2_id = ? ORDER BY friend_id",
+            (user_id, user_id)
+        ).fetchall())
+        return [row["friend_id"] for row in rows]
+
+
+class SqliteFriendRequests(SqliteRepository, FriendRequestRepository):
+    async def create(self, from_user_id, to_user_id):
+        request = {
+            "id": _new_id(),
+            "from_user_id": from_user_id,
+            "to_user_id": to_user_id,
+            "status": "pending",
+            "created_at": utcnow()
+        }
+        cursor = await self._run(lambda conn: conn.execute(
+            "INSERT OR IGNORE INTO friend_requests (id, pair_key, from_user_id, to_user_id, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (request["id"], pair_key(from_user_id, to_user_id), from_user_id, to_user_id, "pending",
+             request["created_at"].isoformat())
+        ))
+        return request if cursor.rowcount > 0 else None
+
+    async def get(self, request_id):
+        row = await self._run(lambda conn: conn.execute(
+            f"SELECT {REQUEST_COLUMNS} FROM friend_requests WHERE id = ?", (request_id,)
+        ).fetchone())
+        return _record(row) if row else None
+
+    async def pending_for(self, user_id):
+        rows = await self._run(lambda conn: conn.execute(
+            f"SELECT {REQUEST_COLUMNS} FROM friend_requests WHERE to_user_id = ? AND status = 'pending' ORDER BY id",
+            (user_id,)
+        ).fetchall())
+        return [_record(row) for row in rows]
+
+    async def set_status(self, request_ids, to_user_id, status, from_status="pending"):
+        request_ids = list(dict.fromkeys(request_ids))
+        ids = _placeholders(request_ids)
+
+        def update(conn):
+            conn.execute(
+                f"UPDATE friend_requests SET status = ? WHERE id IN ({ids}) AND to_user_id = ? AND status = ?",
+                (status, *request_ids, to_user_id, from_status)
+            )
+            return conn.execute(
+                f"SELECT {REQUEST_COLUMNS} FROM friend_requests WHERE id IN ({ids}) AND to_user_id = ? AND status = ?",
+                (*request_ids, to_user_id, status)
+            ).fetchall()
+
+        found = {row["id"]: _record(row) for row in await self._run(update)}
+        return [found[request_id] for request_id in request_ids if request_id in found]
+
+    async def delete_pair(self, user_id, other_id):
+        cursor = await self._run(lambda conn: conn.execute(
+            "DELETE FROM friend_requests WHERE pair_key = ?", (pair_key(user_id, other_id),)
+        ))
+        return cursor.rowcount > 0
+
+
+class SqliteGroups(SqliteRepository, GroupRepository):
+    @staticmethod
+    def _add(conn: sqlite3.Connection, group_id: str, user_ids: List[str]) -> int:
+        cursor = conn.executemany(
+            "INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)",
+            [(group_id, user_id) for user_id in dict.fromkeys(user_ids)]
+        )
+        added = max(cursor.rowcount, 0)
+        conn.execute("UPDATE chat_groups SET member_count = member_count + ? WHERE id = ?", (added, group_id))
+        return added
+
+    async def create(self, name, created_by, member_ids=()):
+        group = {"id": _new_id(), "name": name, "created_by": created_by, "member_count": 0, "created_at": utcnow()}
+
+        def insert(conn):
+            conn.execute(
+                "INSERT INTO chat_groups (id, name, created_by, created_at) VALUES (?, ?, ?, ?)",
+                (group["id"], name, created_by, group["created_at"].isoformat())
+            )
+            return self._add(conn, group["id"], [created_by, *member_ids])
+
+        group["member_count"] = await self._run(insert)
+        return group
+
+    async def get(self, group_id):
+        row = await self._run(lambda conn: conn.execute(
+            f"SELECT {GROUP_COLUMNS} FROM chat_groups WHERE id = ?", (group_id,)
+        ).fetchone())
+        return _record(row) if row else None
+
+    async def rename(self, group_id, name):
+        cursor = await self._run(lambda conn: conn.execute(
+            "UPDATE chat_groups SET name = ? WHERE id = ?", (name, group_id)
+        ))
+        return cursor.rowcount > 0
+
+    async def add_members(self, group_id, user_ids):
+        user_ids = list(user_ids)
+
+        def add(conn):
+            if conn.execute("SELECT 1 FROM chat_groups WHERE id = ?", (group_id,)).fetchone() is None:
+                return 0
+            return self._add(conn, group_id, user_ids)
+
+        return await self._run(add)
+
+    async def remove_members(self, group_id, user_ids):
+        user_ids = list(dict.fromkeys(user_ids))
+
+        def remove(conn):
+            cursor = conn.execute(
+                f"DELETE FROM group_members WHERE group_id = ? AND user_id IN ({_placeholders(user_ids)})",
+                (group_id, *user_ids)
+            )
+            conn.execute(
+                "UPDATE chat_groups SET member_count = member_count - ? WHERE id = ?",
+                (cursor.rowcount, group_id)
+            )
+            return cursor.rowcount
+
+        return await self._run(remove)
+
+    async def is_member(self, group_id, user_id):
+        row = await self._run(lambda conn: conn.execute(
+            "SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?", (group_id, user_id)
+        ).fetchone())
+        return row is not None
+
+    async def member_ids(self, group_id, after=None, limit=MEMBER_PAGE_SIZE):
+        rows = await self._run(lambda conn: conn.execute(
+            "SELECT user_id FROM group_members WHERE group_id = ? AND user_id > ? ORDER BY user_id LIMIT ?",
+            (group_id, after or "", limit)
+        ).fetchall())
+        return [row["user_id"] for row in rows]
+
+    async def group_ids_for(self, user_id):
+        rows = await self._run(lambda conn: conn.execute(
+            "SELECT group_id FROM group_members WHERE user_id = ?", (user_id,)
+        ).fetchall())
+        return [row["group_id"] for row in rows]
+
+
+class SqliteMessages(SqliteRepository, MessageRepository):
+    async def add(self, sender_id, content, recipient_id=None, group_id=None, client_message_id=None):
+        message = {
+            "id": _new_id(),
+            "sender_id": sender_id,
+            "recipient_id": recipient_id,
+            "group_id": group_id,
+            "content": content,
+            "timestamp": utcnow(),
+            "status": "sent",
+            "client_message_id": client_message_id
+        }
+
+        def insert(conn):
+            try:
+                conn.execute(
+                    f"INSERT INTO messages ({MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (message["id"], sender_id, recipient_id, group_id, content,
+                     message["timestamp"].isoformat(), "sent", client_message_id)
+                )
+                return None
+            except sqlite3.IntegrityError:
+                return conn.execute(
+                    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE sender_id = ? AND client_message_id = ?",
+                    (sender_id, client_message_id)
+                ).fetchone()
+
+        original = await self._run(insert)
+        if original is not None:
+            return _record(original), False
+        return message, True
+
+    async def get(self, message_id):
+        row = await self._run(lambda conn: conn.execute(
+            f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE id = ?", (message_id,)
+        ).fetchone())
+        return _record(row) if row else None
+
+    async def _newest(self, where: str, params: tuple, before: Optional[str], limit: int) -> List[dict]:
+        if before:
+            where += " AND id < ?"
+            params += (before,)
+        rows = await self._run(lambda conn: conn.execute(
+            f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE {where} ORDER BY id DESC LIMIT ?",
+            (*params, limit)
+        ).fetchall())
+        return [_record(row) for row in rows]
+
+    async def conversation(self, user_id, other_id, before=None, limit=HISTORY_PAGE_SIZE):
+        # Two index range scans on (sender_id, recipient_id, id), merged
+        return await self._newest(
+            "((sender_id = ? AND recipient_id = ?) OR (sender_id = ? AND recipient_id = ?))",
+            (user_id, other_id, other_id, user_id),
+            before,
+            limit
+        )
+
+    async def group_history(self, group_id, before=None, limit=HISTORY_PAGE_SIZE):
+        return await self._newest("group_id = ?", (group_id,), before, limit)
+
+    async def set_status(self, message_id, status):
+        cursor = await self._run(lambda conn: conn.execute(
+            "UPDATE messages SET status = ? WHERE id = ?", (status, message_id)
+        ))
+        return cursor.rowcount > 0
+
+
+class SqliteStorage(Storage):
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+        self.users = SqliteUsers(self)
+        self.friendships = SqliteFriendships(self)
+        self.friend_requests = SqliteFriendRequests(self)
+        self.groups = SqliteGroups(self)
+        self.messages = SqliteMessages(self)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+        return self._conn
+
+    def _call(self, fn):
+        # One transaction per call: committed if fn returns, rolled back if it raises
+        conn = self._connect()
+        with conn:
+            return fn(conn)
+
+    async def run(self, fn):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn)
+
+    async def setup(self):
+        await self.run(lambda conn: conn.executescript(SCHEMA))
+
+    async def close(self):
+        def close(conn):
+            conn.close()
+            self._conn = None
+        if self._conn is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, close, self._conn)
+        self._executor.shutdown(wait=False)
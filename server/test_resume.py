@@ -0,0 +1,110 @@
+"""
+Device resume checks
+Reconnects devices against a scratch MongoDB database and checks what
+resume_session sends them:
+
+    python test_resume.py
+"""
+import asyncio
+import json
+import sys
+import traceback
+
+from bson import ObjectId
+
+import device_cursors
+import message_ingest
+from main import resume_session
+from websocket_manager import Session
+
+CHECKS = []
+
+
+def check(fn):
+    CHECKS.append(fn)
+    return fn
+
+
+class RecordingSocket:
+    # Stands in for a WebSocket and keeps every frame sent to it
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, text: str):
+        self.frames.append(json.loads(text))
+
+
+async def _resume(db, user_id: str, device_id: str):
+    session = Session(RecordingSocket(), device_id)
+    await resume_session(db, user_id, session)
+    return session, session.websocket.frames
+
+
+@check
+async def first_connection_replays_nothing(db):
+    alice, bob = str(ObjectId()), str(ObjectId())
+    await message_ingest.store_message(db, bob, alice, None, "before")
+    session, sent = await _resume(db, alice, "phone")
+    assert sent == [], sent
+    assert session.cursor is not None
+
+
+@check
+async def replays_missed_messages_in_order(db):
+    alice, bob = str(ObjectId()), str(ObjectId())
+    await device_cursors.save(db, alice, "phone", ObjectId())
+    first, _ = await message_ingest.store_message(db, bob, alice, None, "one")
+    second, _ = await message_ingest.store_message(db, alice, bob, None, "two")
+
+    session, sent = await _resume(db, alice, "phone")
+    assert [frame["type"] for frame in sent] == ["message", "message", "resumed"], sent
+    assert [frame["content"] for frame in sent[:2]] == ["one", "two"]
+    assert all(frame["replayed"] for frame in sent[:2])
+    assert sent[2] == {"type": "resumed", "count": 2, "complete": True}, sent[2]
+    assert session.cursor == second["_id"]
+
+
+@check
+async def replays_attachments(db):
+    alice, bob = str(ObjectId()), str(ObjectId())
+    await device_cursors.save(db, alice, "laptop", ObjectId())
+    refs = [{"id": str(ObjectId()), "filename": "notes.pdf", "content_type": "application/pdf", "size": 1024}]
+    await message_ingest.store_message(db, bob, alice, None, "see attached", attachments=refs)
+    await message_ingest.store_message(db, bob, alice, None, "no attachment")
+
+    _, sent = await _resume(db, alice, "laptop")
+    assert sent[0]["attachments"] == refs, sent[0]
+    assert sent[1]["attachments"] == [], sent[1]
+
+
+async def run_checks(db) -> int:
+    failed = 0
+    for fn in CHECKS:
+        try:
+            await fn(db)
+            print(f"   ✅ {fn.__name__}")
+        except Exception:
+            failed += 1
+            print(f"   ❌ {fn.__name__}")
+            traceback.print_exc()
+    return failed
+
+
+async def main():
+    from database import connect_to_mongo, close_mongo_connection, get_client, DATABASE_NAME
+    await connect_to_mongo()
+    name = f"{DATABASE_NAME}_resume_check"
+    try:
+        failed = await run_checks(get_client()[name])
+    finally:
+        await get_client().drop_database(name)
+        await close_mongo_connection()
+
+    print("\n" + "=" * 60)
+    print("All checks passed" if not failed else f"{failed} checks failed")
+    print("=" * 60)
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(1 if asyncio.run(main()) else 0)
@@ -0,0 +1,287 @@
+"""
+Storage engine conformance checks
+Runs the same checks against every storage engine, so they behave alike:
+
+    python test_storage.py            # memory and sqlite
+    python test_storage.py mongo      # also MongoDB, in a scratch database
+"""
+from datetime import datetime
+import asyncio
+import os
+import sys
+import tempfile
+import traceback
+
+from storage import (
+    DuplicateError, FriendRequestRepository, FriendshipRepository, GroupRepository,
+    MessageRepository, UserRepository, open_storage
+)
+
+CHECKS = []
+
+
+def check(fn):
+    CHECKS.append(fn)
+    return fn
+
+
+async def _users(storage, *names):
+    return [await storage.users.create(name, f"{name}@example.com", f"hash-{name}") for name in names]
+
+
+@check
+async def repositories(storage):
+    # Every repository implements its whole interface; a missing method
+    # already fails when the engine is opened
+    for attr, interface in [
+        ("users", UserRepository),
+        ("friendships", FriendshipRepository),
+        ("friend_requests", FriendRequestRepository),
+        ("groups", GroupRepository),
+        ("messages", MessageRepository)
+    ]:
+        assert isinstance(getattr(storage, attr), interface), attr
+
+
+@check
+async def users_create_and_get(storage):
+    alice, = await _users(storage, "alice")
+    assert set(alice) == {"id", "username", "email", "avatar_id", "created_at"}, alice
+    assert isinstance(alice["created_at"], datetime)
+    assert await storage.users.get(alice["id"]) == alice
+    assert await storage.users.get("0" * 24) is None
+    assert await storage.users.get("not-an-id") is None
+
+
+@check
+async def users_unique(storage):
+    await _users(storage, "bob")
+    for username, email in (("bob", "other@example.com"), ("other", "bob@example.com")):
+        try:
+            await storage.users.create(username, email, "hash")
+        except DuplicateError:
+            continue
+        raise AssertionError(f"created duplicate {username} / {email}")
+
+
+@check
+async def users_login(storage):
+    carol, = await _users(storage, "carol")
+    login = await storage.users.get_login("carol")
+    assert login == {"id": carol["id"], "username": "carol", "password": "hash-carol"}, login
+    assert await storage.users.get_login("nobody") is None
+    assert "password" not in await storage.users.get(carol["id"])
+
+
+@check
+async def users_get_many(storage):
+    a, b, c = await _users(storage, "gm_a", "gm_b", "gm_c")
+    found = await storage.users.get_many([c["id"], "bad", b["id"], c["id"], "0" * 24])
+    assert [user["id"] for user in found] == [c["id"], b["id"]], found
+    assert await storage.users.get_many([]) == []
+
+
+@check
+async def users_search(storage):
+    me, other, underscore = await _users(storage, "Searcher", "SEARCHED", "search_x")
+    found = [user["username"] for user in await storage.users.search("search", exclude_id=me["id"])]
+    assert found == ["SEARCHED", "search_x"], found
+    # Patterns are plain text, not regular expressions or LIKE wildcards
+    assert [user["username"] for user in await storage.users.search("h_x")] == ["search_x"]
+    assert await storage.users.search(".*") == []
+    assert await storage.users.search("%") == []
+    assert len(await storage.users.search("example.com", limit=2)) == 2
+
+
+@check
+async def users_avatar(storage):
+    dave, = await _users(storage, "dave")
+    assert await storage.users.set_avatar(dave["id"], "abc")
+    assert (await storage.users.get(dave["id"]))["avatar_id"] == "abc"
+    assert not await storage.users.set_avatar("0" * 24, "abc")
+
+
+@check
+async def friendships(storage):
+    a, b, c = await _users(storage, "f_a", "f_b", "f_c")
+    assert await storage.friendships.add(a["id"], b["id"])
+    assert not await storage.friendships.add(b["id"], a["id"])
+    assert await storage.friendships.add(c["id"], a["id"])
+    assert await storage.friendships.are_friends(b["id"], a["id"])
+    assert not await storage.friendships.are_friends(b["id"], c["id"])
+    assert await storage.friendships.friends_of(a["id"]) == sorted([b["id"], c["id"]])
+    assert await storage.friendships.remove(b["id"], a["id"])
+    assert not await storage.friendships.remove(a["id"], b["id"])
+    assert await storage.friendships.friends_of(a["id"]) == [c["id"]]
+    assert await storage.friendships.friends_of(b["id"]) == []
+
+
+@check
+async def friend_requests(storage):
+    a, b, c = await _users(storage, "r_a", "r_b", "r_c")
+    request = await storage.friend_requests.create(a["id"], b["id"])
+    assert request["status"] == "pending" and request["to_user_id"] == b["id"], request
+    assert await storage.friend_requests.get(request["id"]) == request
+    # One request per pair, whichever direction
+    assert await storage.friend_requests.create(b["id"], a["id"]) is None
+    other = await storage.friend_requests.create(c["id"], b["id"])
+    assert [r["id"] for r in await storage.friend_requests.pending_for(b["id"])] == [request["id"], other["id"]]
+    assert await storage.friend_requests.pending_for(a["id"]) == []
+
+
+@check
+async def friend_request_status(storage):
+    a, b, c = await _users(storage, "s_a", "s_b", "s_c")
+    first = await storage.friend_requests.create(a["id"], c["id"])
+    second = await storage.friend_requests.create(b["id"], c["id"])
+    wrong_user = await storage.friend_requests.create(a["id"], b["id"])
+
+    accepted = await storage.friend_requests.set_status(
+        [second["id"], first["id"], wrong_user["id"], "bad"], c["id"], "accepted"
+    )
+    assert [r["id"] for r in accepted] == [second["id"], first["id"]], accepted
+    assert all(r["status"] == "accepted" for r in accepted)
+    # Retrying returns the same, and an accepted request can't be rejected
+    assert [r["id"] for r in await storage.friend_requests.set_status([first["id"]], c["id"], "accepted")] == [first["id"]]
+    assert await storage.friend_requests.set_status([first["id"]], c["id"], "rejected") == []
+    assert (await storage.friend_requests.get(wrong_user["id"]))["status"] == "pending"
+
+    assert await storage.friend_requests.delete_pair(c["id"], a["id"])
+    assert not await storage.friend_requests.delete_pair(c["id"], a["id"])
+    assert await storage.friend_requests.get(first["id"]) is None
+    assert await storage.friend_requests.create(c["id"], a["id"]) is not None
+
+
+@check
+async def groups(storage):
+    a, b, c = await _users(storage, "g_a", "g_b", "g_c")
+    group = await storage.groups.create("Team", a["id"], [b["id"], a["id"]])
+    assert set(group) == {"id", "name", "created_by", "member_count", "created_at"}, group
+    assert group["member_count"] == 2
+    assert await storage.groups.get(group["id"]) == group
+    assert await storage.groups.get("0" * 24) is None
+
+    assert await storage.groups.rename(group["id"], "Renamed")
+    assert (await storage.groups.get(group["id"]))["name"] == "Renamed"
+    assert not await storage.groups.rename("0" * 24, "Nope")
+
+
+@check
+async def group_members(storage):
+    users = await _users(storage, *[f"m_{i}" for i in range(5)])
+    ids = [user["id"] for user in users]
+    group = await storage.groups.create("Members", ids[0])
+
+    assert await storage.groups.add_members(group["id"], [ids[1], ids[2], ids[1], ids[0]]) == 2
+    assert await storage.groups.add_members(group["id"], [ids[2], ids[3]]) == 1
+    assert await storage.groups.add_members("0" * 24, [ids[4]]) == 0
+    assert (await storage.groups.get(group["id"]))["member_count"] == 4
+    assert await storage.groups.is_member(group["id"], ids[3])
+    assert not await storage.groups.is_member(group["id"], ids[4])
+
+    assert await storage.groups.member_ids(group["id"]) == sorted(ids[:4])
+    assert await storage.groups.member_ids(group["id"], limit=2) == sorted(ids[:4])[:2]
+    assert await storage.groups.member_ids(group["id"], after=sorted(ids[:4])[1]) == sorted(ids[:4])[2:]
+
+    assert await storage.groups.remove_members(group["id"], [ids[3], ids[4], ids[3]]) == 1
+    assert (await storage.groups.get(group["id"]))["member_count"] == 3
+    assert not await storage.groups.is_member(group["id"], ids[3])
+
+    other = await storage.groups.create("Other", ids[1])
+    assert sorted(await storage.groups.group_ids_for(ids[1])) == sorted([group["id"], other["id"]])
+    assert await storage.groups.group_ids_for(ids[4]) == []
+
+
+@check
+async def messages_add(storage):
+    a, b = await _users(storage, "ma_a", "ma_b")
+    message, created = await storage.messages.add(a["id"], "hi", recipient_id=b["id"])
+    assert created
+    assert set(message) == {
+        "id", "sender_id", "recipient_id", "group_id", "content", "timestamp", "status", "client_message_id"
+    }, message
+    assert message["status"] == "sent" and message["group_id"] is None
+    assert await storage.messages.get(message["id"]) == message
+    assert await storage.messages.get("0" * 24) is None
+
+    # The same client id from the same sender returns the original
+    first, created = await storage.messages.add(a["id"], "once", recipient_id=b["id"], client_message_id="c1")
+    again, created_again = await storage.messages.add(a["id"], "once", recipient_id=b["id"], client_message_id="c1")
+    assert created and not created_again and again == first
+    other, created = await storage.messages.add(b["id"], "once", recipient_id=a["id"], client_message_id="c1")
+    assert created and other["id"] != first["id"]
+
+    assert await storage.messages.set_status(message["id"], "read")
+    assert (await storage.messages.get(message["id"]))["status"] == "read"
+    assert not await storage.messages.set_status("0" * 24, "read")
+
+
+@check
+async def messages_history(storage):
+    a, b, c = await _users(storage, "mh_a", "mh_b", "mh_c")
+    sent = []
+    for i in range(7):
+        sender, recipient = (a, b) if i % 2 else (b, a)
+        message, _ = await storage.messages.add(sender["id"], f"m{i}", recipient_id=recipient["id"])
+        sent.append(message["id"])
+    await storage.messages.add(a["id"], "elsewhere", recipient_id=c["id"])
+    group = await storage.groups.create("History", a["id"], [b["id"]])
+    in_group = [(await storage.messages.add(b["id"], f"g{i}", group_id=group["id"]))[0]["id"] for i in range(3)]
+
+    page = await storage.messages.conversation(a["id"], b["id"], limit=3)
+    assert [m["id"] for m in page] == sent[::-1][:3], page
+    older = await storage.messages.conversation(b["id"], a["id"], before=page[-1]["id"], limit=10)
+    assert [m["id"] for m in older] == sent[::-1][3:], older
+    assert await storage.messages.conversation(a["id"], b["id"], before=sent[0]) == []
+
+    history = await storage.messages.group_history(group["id"])
+    assert [m["id"] for m in history] == in_group[::-1], history
+    assert [m["id"] for m in await storage.messages.group_history(group["id"], before=in_group[1])] == in_group[:1]
+
+
+async def run_checks(name: str, storage) -> int:
+    print("\n" + "=" * 60)
+    print(f"Storage engine: {name}")
+    print("=" * 60)
+    failed = 0
+    await storage.setup()
+    try:
+        for fn in CHECKS:
+            try:
+                await fn(storage)
+                print(f"   ✅ {fn.__name__}")
+            except Exception:
+                failed += 1
+                print(f"   ❌ {fn.__name__}")
+                traceback.print_exc()
+    finally:
+        await storage.close()
+    return failed
+
+
+async def main(engines):
+    failed = 0
+    failed += await run_checks("memory", open_storage("memory"))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        failed += await run_checks("sqlite", open_storage("sqlite", path=os.path.join(tmp, "check.db")))
+
+    if "mongo" in engines:
+        from database import connect_to_mongo, close_mongo_connection, get_client, DATABASE_NAME
+        await connect_to_mongo()
+        name = f"{DATABASE_NAME}_storage_check"
+        db = get_client()[name]
+        try:
+            failed += await run_checks("mongo", open_storage("mongo", db=db))
+        finally:
+            await get_client().drop_database(name)
+            await close_mongo_connection()
+
+    print("\n" + "=" * 60)
+    print("All checks passed" if not failed else f"{failed} checks failed")
+    print("=" * 60)
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(1 if asyncio.run(main(sys.argv[1:])) else 0)
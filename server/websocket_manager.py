@@ -1,48 +1,131 @@
 from fastapi import WebSocket
-from typing import Dict, Set
+from bson import ObjectId
+from bson.errors import InvalidId
+from typing import Callable, Dict, Iterable, List, Optional, Set
+import asyncio
 import json
+import random
+import uuid
+
+# Smallest retry delay handed out when draining
+DRAIN_MIN_RETRY_MS = 500
+
+class Session:
+    # One WebSocket connection. device_id is chosen by the client and stays
+    # the same across reconnects, cursor is the newest message delivered
+    __slots__ = ("session_id", "websocket", "device_id", "cursor")
+
+    def __init__(self, websocket: WebSocket, device_id: Optional[str] = None):
+        self.session_id = uuid.uuid4().hex
+        self.websocket = websocket
+        self.device_id = device_id
+        self.cursor: Optional[ObjectId] = None
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+        # user_id -> session_id -> Session; a user is online while they
+        # have at least one session
+        self.active_connections: Dict[str, Dict[str, Session]] = {}
         self.group_connections: Dict[str, Set[str]] = {}
+        # Set while shutting down; closing sessions then don't announce
+        # users as offline, since they are about to reconnect
+        self.draining = False
 
-    async def connect(self, user_id: str, websocket: WebSocket):
+    async def connect(self, user_id: str, websocket: WebSocket, audience: Optional[Iterable[str]] = None,
+                      device_id: Optional[str] = None, announce: bool = True) -> Session:
         await websocket.accept()
-        self.active_connections[user_id] = websocket
-        # Broadcast user is online
-        await self.broadcast_user_status(user_id, "online")
+        session = Session(websocket, device_id)
+        sessions = self.active_connections.setdefault(user_id, {})
+        sessions[session.session_id] = session
+        # Broadcast user is online when their first session opens
+        if len(sessions) == 1 and announce:
+            await self.broadcast_user_status(user_id, "online", audience)
+        return session
+
+    def disconnect(self, user_id: str, session_id: str) -> bool:
+        # Returns True when that was the user's last session
+        sessions = self.active_connections.get(user_id)
+        if sessions is None:
+            return False
+        sessions.pop(session_id, None)
+        if sessions:
+            return False
+        del self.active_connections[user_id]
+        return True
+
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self.active_connections
+
+    def online_among(self, user_ids: Iterable[str]) -> List[str]:
+        return [user_id for user_id in user_ids if user_id in self.active_connections]
 
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
+    async def drain(self, spread_ms: int, resume_token: Callable[[str, Session], str]):
+        # Close every session with 1012 (service restart). Each client gets
+        # its own random retry delay, so they don't all reconnect at once,
+        # and a resume token to reconnect without a presence broadcast.
+        self.draining = True
 
-    async def send_personal_message(self, message: str, user_id: str):
-        if user_id in self.active_connections:
+        async def close(user_id: str, session: Session):
+            retry_ms = random.randint(DRAIN_MIN_RETRY_MS, max(DRAIN_MIN_RETRY_MS, spread_ms))
             try:
-                await self.active_connections[user_id].send_text(message)
+                await session.websocket.send_text(json.dumps({
+                    "type": "reconnect",
+                    "retry_after_ms": retry_ms,
+                    "resume_token": resume_token(user_id, session)
+                }))
+                await session.websocket.close(code=1012, reason=f"retry={retry_ms}")
             except Exception as e:
-                print(f"Error sending message to {user_id}: {e}")
+                print(f"Error draining session of {user_id}: {e}")
 
-    async def broadcast_user_status(self, user_id: str, status: str):
+        await asyncio.gather(*(
+            close(user_id, session)
+            for user_id, sessions in list(self.active_connections.items())
+            for session in list(sessions.values())
+        ))
+
+    async def _send(self, session: Session, message: str, user_id: str):
+        try:
+            await session.websocket.send_text(message)
+        except Exception as e:
+            print(f"Error sending message to {user_id}: {e}")
+
+    async def send_personal_message(self, message: str, user_id: str, exclude: Optional[str] = None):
+        # Delivered to every session of the user, except `exclude`
+        for session in list(self.active_connections.get(user_id, {}).values()):
+            if session.session_id != exclude:
+                await self._send(session, message, user_id)
+
+    def mark_delivered(self, user_id: str, message_id: Optional[str]):
+        # Advance the cursors of the user's sessions past a delivered message.
+        # Only pass ids of messages the server stored; ids from the future
+        # can't be real messages, so they are ignored.
+        if not message_id:
+            return
+        try:
+            oid = ObjectId(message_id)
+        except (InvalidId, TypeError):
+            return
+        if oid > ObjectId():
+            return
+        for session in self.active_connections.get(user_id, {}).values():
+            if session.cursor is None or oid > session.cursor:
+                session.cursor = oid
+
+    async def broadcast_user_status(self, user_id: str, status: str, audience: Optional[Iterable[str]] = None):
+        # Without an audience the status goes to every connected user
         status_message = json.dumps({
             "type": "user_status",
             "user_id": user_id,
             "status": status
         })
-        
-        for uid, connection in self.active_connections.items():
+
+        recipients = self.active_connections.keys() if audience is None else audience
+        for uid in list(recipients):
             if uid != user_id:
-                try:
-                    await connection.send_text(status_message)
-                except Exception as e:
-                    print(f"Error broadcasting status to {uid}: {e}")
+                await self.send_personal_message(status_message, uid)
 
     async def send_group_message(self, message: str, group_id: str, sender_id: str, member_ids: list):
         # Send to actual group members only (excluding sender)
         for member_id in member_ids:
             if member_id != sender_id and member_id in self.active_connections:
-                try:
-                    await self.active_connections[member_id].send_text(message)
-                except Exception as e:
-                    print(f"Error sending group message to {member_id}: {e}")
+                await self.send_personal_message(message, member_id)
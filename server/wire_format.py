@@ -0,0 +1,152 @@
+from fastapi import Request, Response
+from starlette.middleware.gzip import GZipMiddleware
+from typing import Dict, List, Optional, Tuple
+import json
+import os
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content negotiation for message history pages. Clients pick the shape
+# and encoding with the Accept header:
+#
+#   application/json                           rows, one object per message (default)
+#   application/vnd.chatterbox.columns+json    one array per field, see columns()
+#   application/msgpack                        rows as MessagePack
+#   application/vnd.chatterbox.columns+msgpack columns as MessagePack
+#
+# The MessagePack types are only offered when the msgpack package is
+# installed. Bodies of at least COMPRESS_MIN_BYTES are brotli-compressed
+# here when the client accepts br and the brotli package is installed;
+# otherwise CompressionMiddleware compresses them with gzip.
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+BROTLI_QUALITY = 5
+
+JSON = "application/json"
+COLUMNS_JSON = "application/vnd.chatterbox.columns+json"
+MSGPACK = "application/msgpack"
+COLUMNS_MSGPACK = "application/vnd.chatterbox.columns+msgpack"
+
+# Responses under these paths are never compressed
+UNCOMPRESSED_PREFIXES = ("/api/attachments/",)
+
+# Fields that repeat across a page, sent once per distinct value
+DICTIONARY_FIELDS = ("sender_id", "sender_username", "recipient_id", "group_id", "status")
+
+
+def _dumps_json(payload) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _dumps_msgpack(payload) -> bytes:
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+# media type -> (columnar, encoder)
+FORMATS = {JSON: (False, _dumps_json), COLUMNS_JSON: (True, _dumps_json)}
+if msgpack is not None:
+    FORMATS[MSGPACK] = (False, _dumps_msgpack)
+    FORMATS[COLUMNS_MSGPACK] = (True, _dumps_msgpack)
+# application/x-msgpack is still what many clients send
+ALIASES = {"application/x-msgpack": MSGPACK}
+
+
+def _parse_accept(header: str) -> List[Tuple[str, float]]:
+    accepted = []
+    for part in header.split(","):
+        media_type, _, params = part.partition(";")
+        media_type = media_type.strip().lower()
+        if not media_type:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted.append((ALIASES.get(media_type, media_type), q))
+    return accepted
+
+
+def negotiate(accept: Optional[str]) -> str:
+    # Highest q wins, ties go to the order in the header; wildcards and
+    # anything we don't offer fall back to plain JSON
+    best, best_q = JSON, 0.0
+    for media_type, q in _parse_accept(accept or ""):
+        if media_type in FORMATS and q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+def columns(rows: List[dict]) -> dict:
+    # {"count": 3,
+    #  "columns": {"id": [...], "content": [...], ...},
+    #  "dictionary": {"sender_id": {"values": ["a", "b"], "index": [0, 1, 0]}},
+    #  "constant": {"group_id": "g"}}
+    # Fields missing from a row come back as null.
+    fields = list(dict.fromkeys(field for row in rows for field in row))
+    payload = {"count": len(rows), "columns": {}, "dictionary": {}, "constant": {}}
+    for field in fields:
+        values = [row.get(field) for row in rows]
+        if field not in DICTIONARY_FIELDS:
+            payload["columns"][field] = values
+            continue
+        positions: Dict[object, int] = {}
+        index = [positions.setdefault(value, len(positions)) for value in values]
+        if len(positions) == 1:
+            payload["constant"][field] = values[0]
+        else:
+            payload["dictionary"][field] = {"values": list(positions), "index": index}
+    return payload
+
+
+def rows_from_columns(payload: dict) -> List[dict]:
+    # The inverse of columns(), for tests and Python clients
+    count = payload["count"]
+    fields = dict(payload["columns"])
+    for field, encoded in payload["dictionary"].items():
+        fields[field] = [encoded["values"][i] for i in encoded["index"]]
+    for field, value in payload["constant"].items():
+        fields[field] = [value] * count
+    return [{field: values[i] for field, values in fields.items()} for i in range(count)]
+
+
+def _accepts_brotli(request: Request) -> bool:
+    for coding, q in _parse_accept(request.headers.get("accept-encoding", "")):
+        if coding == "br" and q > 0:
+            return True
+    return False
+
+
+def encode(rows: List[dict], media_type: str) -> bytes:
+    columnar, dumps = FORMATS[media_type]
+    return dumps(columns(rows) if columnar else rows)
+
+
+def render(request: Request, rows: List[dict]) -> Response:
+    media_type = negotiate(request.headers.get("accept"))
+    body = encode(rows, media_type)
+    headers = {"Vary": "Accept"}
+    if brotli is not None and len(body) >= COMPRESS_MIN_BYTES and _accepts_brotli(request):
+        body = brotli.compress(body, quality=BROTLI_QUALITY)
+        headers.update({"Content-Encoding": "br", "Vary": "Accept, Accept-Encoding"})
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+class CompressionMiddleware(GZipMiddleware):
+    # GZipMiddleware for everything outside UNCOMPRESSED_PREFIXES
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(UNCOMPRESSED_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)